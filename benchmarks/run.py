@@ -0,0 +1,213 @@
+"""Benchmarks for the overhead of cfn_custom_resource itself.
+
+python benchmarks/run.py [--output results.json] [--compare baseline.json]
+
+Each benchmark is run for a number of rounds, and the results (the best and
+median time per call, in microseconds) are written as JSON, along with the
+Python version, platform, and package version, so that runs can be compared.
+With --compare, benchmarks whose best time regressed by more than --threshold
+against a previous result file are reported, and the exit code is 1.
+
+This Source Code Form is subject to the terms of the Mozilla Public
+License, v. 2.0. If a copy of the MPL was not distributed with this
+file, You can obtain one at http://mozilla.org/MPL/2.0/.
+"""
+from __future__ import absolute_import, print_function, division
+
+import argparse
+import json
+import logging
+import os.path
+import platform
+import subprocess
+import sys
+import timeit
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import cfn_custom_resource
+from cfn_custom_resource import CloudFormationCustomResource, utils
+from cfn_custom_resource.cfn_custom_resource import _unwrap_record, _plainify
+
+BENCHMARKS = []
+
+def benchmark(func):
+    """Register a function returning a zero-argument function to time, or None
+    if the benchmark can't run here."""
+    BENCHMARKS.append(func)
+    return func
+
+class BenchmarkResource(CloudFormationCustomResource):
+    RESOURCE_TYPE_SPEC = None
+
+    def create(self):
+        return {'Value': self.resource_properties.get('Value')}
+
+    def update(self):
+        pass
+
+    def delete(self):
+        pass
+
+class LargeOutputsResource(BenchmarkResource):
+    def create(self):
+        return dict(('Output{}'.format(i), {'Key': 'value' * 10, 'List': list(range(5))}) for i in range(20))
+
+def _request(request_type='create', properties=None):
+    return utils.generate_request(request_type, 'Custom::BenchmarkResource', properties or {'Value': 'value'},
+                                  CloudFormationCustomResource.DUMMY_RESPONSE_URL_SILENT,
+                                  old_properties={})
+
+@benchmark
+def handle():
+    event = _request()
+    context = utils.MockLambdaContext()
+    def run():
+        BenchmarkResource().handle(event, context)
+    return run
+
+@benchmark
+def handle_reused_instance():
+    event = _request()
+    context = utils.MockLambdaContext()
+    resource = BenchmarkResource()
+    def run():
+        resource.handle(event, context)
+    return run
+
+@benchmark
+def cfn_response_large_outputs():
+    resource = LargeOutputsResource()
+    resource.handle(_request(), utils.MockLambdaContext())
+    def run():
+        resource.finish_function(resource)
+    return run
+
+@benchmark
+def generate_unique_id():
+    resource = BenchmarkResource()
+    resource.handle(_request(), utils.MockLambdaContext())
+    def run():
+        resource.generate_unique_id(max_len=resource.PHYSICAL_RESOURCE_ID_MAX_LEN)
+    return run
+
+@benchmark
+def sns_unwrap():
+    record = utils.generate_sns_event(json.dumps(_request(properties={'Key{}'.format(i): 'value' for i in range(20)})))['Records'][0]
+    def run():
+        _unwrap_record(record)
+    return run
+
+@benchmark
+def plainify_context():
+    context = utils.MockLambdaContext()
+    def run():
+        _plainify(context)
+    return run
+
+@benchmark
+def boto3_client_cache_hit():
+    try:
+        import boto3
+    except ImportError:
+        return None
+    CloudFormationCustomResource.get_boto3_client('s3', region_name='us-east-1')
+    def run():
+        CloudFormationCustomResource.get_boto3_client('s3', region_name='us-east-1')
+    return run
+
+def _time_subprocess(code, repeat):
+    times = []
+    for _ in range(repeat):
+        start = timeit.default_timer()
+        subprocess.check_call([sys.executable, '-c', code], cwd=os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+        times.append(timeit.default_timer() - start)
+    return times
+
+def cold_import(repeat):
+    """The time to import the package in a new interpreter, less the time to
+    start the interpreter, which is measured the same way."""
+    baseline = _time_subprocess('pass', repeat)
+    times = _time_subprocess('import cfn_custom_resource', repeat)
+    return [max(0, t - min(baseline)) for t in times]
+
+def _time(func, rounds, min_time):
+    timer = timeit.Timer(func)
+    number, _ = timer.autorange() if hasattr(timer, 'autorange') else (1000, None)
+    number = max(1, int(number * min_time / 0.2))
+    return [t / number for t in timer.repeat(repeat=rounds, number=number)], number
+
+def _summarize(times, number):
+    times = sorted(times)
+    return {
+        'best_us': times[0] * 1e6,
+        'median_us': times[len(times) // 2] * 1e6,
+        'rounds': len(times),
+        'calls_per_round': number,
+    }
+
+def run(names=None, rounds=5, min_time=0.2, import_repeat=10):
+    results = {}
+    for func in BENCHMARKS:
+        if names and func.__name__ not in names:
+            continue
+        bench = func()
+        if bench is None:
+            continue
+        times, number = _time(bench, rounds, min_time)
+        results[func.__name__] = _summarize(times, number)
+    if not names or 'cold_import' in names:
+        results['cold_import'] = _summarize(cold_import(import_repeat), 1)
+    return {
+        'python': platform.python_version(),
+        'implementation': platform.python_implementation(),
+        'platform': platform.platform(),
+        'version': cfn_custom_resource.__version__,
+        'json_backend': CloudFormationCustomResource.JSON_SERIALIZER.backend,
+        'results': results,
+    }
+
+def compare(results, baseline, threshold):
+    """Return (name, baseline us, current us) for each benchmark whose best
+    time increased by more than threshold, a fraction."""
+    regressions = []
+    for name, result in sorted(results['results'].items()):
+        previous = baseline['results'].get(name)
+        if not previous:
+            continue
+        if result['best_us'] > previous['best_us'] * (1 + threshold):
+            regressions.append((name, previous['best_us'], result['best_us']))
+    return regressions
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark cfn_custom_resource')
+    parser.add_argument('names', nargs='*', help='Benchmarks to run (default all)')
+    parser.add_argument('--output', '-o', help='Write the results to this file')
+    parser.add_argument('--rounds', type=int, default=5)
+    parser.add_argument('--min-time', type=float, default=0.2, help='Seconds per round')
+    parser.add_argument('--compare', help='A previous result file to compare against')
+    parser.add_argument('--threshold', type=float, default=0.2, help='Allowed slowdown, as a fraction')
+    args = parser.parse_args()
+
+    logging.disable(logging.CRITICAL)
+
+    results = run(args.names, rounds=args.rounds, min_time=args.min_time)
+
+    for name, result in sorted(results['results'].items()):
+        print('{:<28} {:>12.2f} us best {:>12.2f} us median'.format(name, result['best_us'], result['median_us']))
+
+    if args.output:
+        with open(args.output, 'w') as fp:
+            json.dump(results, fp, indent=2, sort_keys=True)
+
+    if args.compare:
+        with open(args.compare) as fp:
+            baseline = json.load(fp)
+        regressions = compare(results, baseline, args.threshold)
+        for name, previous, current in regressions:
+            print('REGRESSION {}: {:.2f} us -> {:.2f} us'.format(name, previous, current))
+        if regressions:
+            sys.exit(1)
+
+if __name__ == '__main__':
+    main()
@@ -11,13 +11,30 @@ file, You can obtain one at http://mozilla.org/MPL/2.0/.
 
 from __future__ import absolute_import
 
+import sys
+
 def _get_version():
-    import pkg_resources, codecs
-    if not pkg_resources.resource_exists(__name__, '_version'):
+    # pkgutil rather than pkg_resources, which is very slow to import
+    import pkgutil
+    try:
+        data = pkgutil.get_data(__name__, '_version')
+    except (IOError, OSError):
+        data = None
+    if not data:
         return '0.0.0'
-    with pkg_resources.resource_stream(__name__, '_version') as fp:
-        return codecs.getreader('utf-8')(fp).read().strip()
-__version__ = _get_version()
+    return data.decode('utf-8').strip()
+
+if sys.version_info >= (3, 7):
+    def __getattr__(name):
+        if name == '__version__':
+            global __version__
+            __version__ = _get_version()
+            return __version__
+        raise AttributeError('module {!r} has no attribute {!r}'.format(__name__, name))
+else:
+    __version__ = _get_version()
 
-from .cfn_custom_resource import CloudFormationCustomResource
+from .cfn_custom_resource import (CloudFormationCustomResource, InProgress, Boto3Cache, PropertyDiff,
+                                  Property, PropertyBag, PropertyValidationError, JsonSerializer,
+                                  Boto3CallStats)
 from . import utils
\ No newline at end of file
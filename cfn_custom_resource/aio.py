@@ -0,0 +1,145 @@
+"""Base class for custom resources whose lifecycle methods are coroutines.
+
+This module requires Python 3.5 or later.
+
+# For resources of type Custom::MyCustomResource
+class MyCustomResource(AsyncCloudFormationCustomResource):
+    async def create(self):
+        client = self.get_async_boto3_client('ssm')
+        responses = await asyncio.gather(*[
+            client.get_parameter(Name=name)
+            for name in self.resource_properties['Names']])
+        # ...
+
+    async def update(self):
+        # ...
+
+    async def delete(self):
+        # ...
+
+handler = MyCustomResource.get_handler()
+
+This Source Code Form is subject to the terms of the Mozilla Public
+License, v. 2.0. If a copy of the MPL was not distributed with this
+file, You can obtain one at http://mozilla.org/MPL/2.0/.
+"""
+from __future__ import absolute_import, print_function
+
+import asyncio
+import functools
+import threading
+
+from .cfn_custom_resource import CloudFormationCustomResource, _run_with_boto3_call_stats
+
+class AsyncBoto3Client(object):
+    """Wraps a boto3 client so that its methods are coroutines, running the
+    underlying blocking call in the executor of the resource."""
+    def __init__(self, client, resource):
+        self._client = client
+        self._resource = resource
+
+    @property
+    def client(self):
+        """The underlying boto3 client."""
+        return self._client
+
+    def __getattr__(self, name):
+        attr = getattr(self._client, name)
+        if not callable(attr):
+            return attr
+        @functools.wraps(attr)
+        async def method(*args, **kwargs):
+            return await self._resource.run_in_executor(attr, *args, **kwargs)
+        return method
+
+class AsyncCloudFormationCustomResource(CloudFormationCustomResource):
+    """Base class for custom resources whose create(), update(), and delete()
+    methods are coroutines, so that a resource can overlap independent I/O
+    (for example, with asyncio.gather()).
+
+    This works like CloudFormationCustomResource, and get_handler() (including
+    batch handling) and get_sqs_handler() can be used as usual; handle() runs
+    the request on an event loop kept for the calling thread, so warm
+    invocations reuse it. validate() and populate() are still plain methods.
+
+    Blocking calls should not be made directly from the coroutines. Use
+    get_async_boto3_client(), whose methods are coroutines that run the
+    botocore call in a thread pool, or run_in_executor() for anything else.
+    The thread pool is shared by the class, and has up to ASYNC_MAX_WORKERS
+    threads. The response to CloudFormation is also sent from the thread
+    pool, so the event loop is never blocked.
+    """
+    ASYNC_MAX_WORKERS = 16
+
+    _EXECUTOR = None
+    _EXECUTOR_LOCK = threading.Lock()
+    _LOOPS = threading.local()
+
+    async def create(self):
+        raise NotImplementedError
+
+    async def update(self):
+        raise NotImplementedError
+
+    async def delete(self):
+        raise NotImplementedError
+
+    @classmethod
+    def get_executor(cls):
+        """Return the thread pool used to run blocking calls, creating it on
+        first use."""
+        if cls._EXECUTOR is None:
+            with cls._EXECUTOR_LOCK:
+                if cls._EXECUTOR is None:
+                    from concurrent import futures
+                    cls._EXECUTOR = futures.ThreadPoolExecutor(max_workers=cls.ASYNC_MAX_WORKERS)
+        return cls._EXECUTOR
+
+    @classmethod
+    def _get_event_loop(cls):
+        loop = getattr(cls._LOOPS, 'loop', None)
+        if loop is None or loop.is_closed():
+            loop = asyncio.new_event_loop()
+            cls._LOOPS.loop = loop
+        return loop
+
+    async def run_in_executor(self, func, *args, **kwargs):
+        """Run a blocking function in the thread pool and return its result."""
+        loop = asyncio.get_event_loop()
+        if self.boto3_stats is not None:
+            # record the calls made in the pool with those of this request
+            func = functools.partial(_run_with_boto3_call_stats, self.boto3_stats, func)
+        return await loop.run_in_executor(self.get_executor(), functools.partial(func, *args, **kwargs))
+
+    def get_async_boto3_client(self, name, **kwargs):
+        """Return the cached boto3 client (see get_boto3_client(), which takes
+        the same arguments), wrapped so that its methods are coroutines."""
+        return AsyncBoto3Client(self.get_boto3_client(name, **kwargs), self)
+
+    def handle(self, event, context):
+        """Use the get_handler class method to get a handler that calls this method."""
+        return self._get_event_loop().run_until_complete(self.handle_async(event, context))
+
+    async def handle_async(self, event, context):
+        """The coroutine equivalent of handle(), for use within an existing event loop."""
+        try:
+            self._start_request(event, context)
+
+            if self._replay_stored_response():
+                return
+
+            try:
+                self._prepare_request()
+                with self._timed('dispatch'):
+                    if self.profiling:
+                        with self._profiled():
+                            outputs = await self._dispatch_request()
+                    else:
+                        outputs = await self._dispatch_request()
+                self._set_outputs(outputs)
+            except Exception as e:
+                self._set_exception(e)
+
+            await self.run_in_executor(self._finish_request)
+        finally:
+            self._clear_boto3_call_stats()
@@ -27,6 +27,7 @@ class MyCustomResource(CloudFormationCustomResource):
         #   self.resource_properties
         # To check what's changed, compare with
         #   self.old_resource_properties
+        # or use self.has_property_changed() or self.property_diff
         # If you set attributes in create(), you need to set them here too  
 
     def delete(self):
@@ -39,15 +40,767 @@ file, You can obtain one at http://mozilla.org/MPL/2.0/.
 
 import logging
 import json
+import os
+import base64
+import hashlib
+import sys
+import threading
 import traceback
 import random
-import string
+import time
+import collections
+import contextlib
+import copy
 import six
 
 from six.moves import http_client
 
-import boto3
-import requests
+# boto3 and requests are imported on first use rather than here, since they
+# dominate the import time of this module and many invocations never need them
+
+# a clock that can't go backwards, for timing phases of a request
+_monotonic = getattr(time, 'monotonic', time.time)
+
+def _config_key(config):
+    """Return a hashable key for a botocore Config object."""
+    if config is None:
+        return None
+    options = getattr(config, '_user_provided_options', None)
+    if options is None:
+        return id(config)
+    return tuple(sorted((k, repr(v)) for k, v in six.iteritems(options)))
+
+class Boto3Cache(object):
+    """A thread-safe cache for boto3 clients and resources, with optional LRU
+    eviction when max_size is set, and counters for hits, misses, and
+    evictions.
+
+    Creation of new objects is serialized, since boto3 sessions are not
+    thread-safe, and this also guarantees that concurrent requests for the
+    same key create only one object."""
+    def __init__(self, max_size=None):
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._items = collections.OrderedDict()
+        self._lock = threading.RLock()
+
+    def get(self, key, factory):
+        """Return the cached value for the key, calling factory() to create it
+        if it is not present."""
+        with self._lock:
+            try:
+                value = self._items.pop(key)
+            except KeyError:
+                self.misses += 1
+                value = factory()
+            else:
+                self.hits += 1
+            self._items[key] = value
+            if self.max_size:
+                while len(self._items) > self.max_size:
+                    self._items.popitem(last=False)
+                    self.evictions += 1
+            return value
+
+    def clear(self):
+        with self._lock:
+            self._items.clear()
+
+    def __len__(self):
+        return len(self._items)
+
+    def stats(self):
+        with self._lock:
+            return {
+                'size': len(self._items),
+                'max_size': self.max_size,
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+            }
+
+class JsonSerializer(object):
+    """Serializes and parses JSON with the fastest available backend: orjson,
+    then ujson, then the standard library json module. A backend can be forced
+    by name, and the default one by the CFN_CUSTOM_RESOURCE_JSON_BACKEND
+    environment variable. The backend is imported on first use.
+
+    The output of dumps() is the same whatever the backend: compact, with
+    non-ASCII characters not escaped. Values the fast backends can't handle
+    (e.g., non-string keys) are serialized with the standard library."""
+    BACKENDS = ('orjson', 'ujson', 'json')
+
+    def __init__(self, backend=None):
+        if backend is not None and backend not in self.BACKENDS:
+            raise ValueError('unknown JSON backend {}, expected one of {}'.format(backend, ', '.join(self.BACKENDS)))
+        self._requested_backend = backend
+        self._backend = None
+        self._dumps = None
+        self._loads = None
+
+    @property
+    def backend(self):
+        """The name of the backend in use."""
+        if self._backend is None:
+            self._load_backend()
+        return self._backend
+
+    def _load_backend(self):
+        backends = [self._requested_backend] if self._requested_backend else self.BACKENDS
+        for backend in backends:
+            if backend == 'orjson':
+                try:
+                    import orjson
+                except ImportError:
+                    continue
+                self._dumps = lambda value: orjson.dumps(value).decode('utf-8')
+                self._loads = orjson.loads
+            elif backend == 'ujson':
+                try:
+                    import ujson
+                except ImportError:
+                    continue
+                self._dumps = lambda value: ujson.dumps(value, ensure_ascii=False, escape_forward_slashes=False)
+                self._loads = ujson.loads
+            else:
+                self._dumps = self._stdlib_dumps
+                self._loads = json.loads
+            self._backend = backend
+            return
+        raise ImportError('JSON backend {} is not installed'.format(self._requested_backend))
+
+    @staticmethod
+    def _stdlib_dumps(value, indent=None):
+        separators = (',', ': ') if indent else (',', ':')
+        return json.dumps(value, ensure_ascii=False, indent=indent, separators=separators)
+
+    def dumps(self, value, indent=None):
+        """Serialize the value to a JSON string, indented if indent is given."""
+        if indent:
+            return self._stdlib_dumps(value, indent)
+        if self._dumps is None:
+            self._load_backend()
+        try:
+            return self._dumps(value)
+        except (TypeError, OverflowError, ValueError):
+            if self._dumps == self._stdlib_dumps:
+                raise
+            return self._stdlib_dumps(value)
+
+    def loads(self, data):
+        """Parse a JSON string or UTF-8 encoded bytes."""
+        if self._loads is None:
+            self._load_backend()
+        return self._loads(data)
+
+json_serializer = JsonSerializer(os.environ.get('CFN_CUSTOM_RESOURCE_JSON_BACKEND') or None)
+
+class Boto3CallStats(object):
+    """Counts, latencies, retries, and throttles of the boto3 calls made during
+    a request, by operation (e.g., 's3.PutObject'). Latencies are in
+    milliseconds, and each operation has a histogram of them, with the
+    upper bounds of the buckets in LATENCY_BUCKETS_MS."""
+    LATENCY_BUCKETS_MS = (5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000)
+    THROTTLE_ERROR_CODES = frozenset([
+        'Throttling', 'ThrottlingException', 'ThrottledException', 'RequestThrottledException',
+        'TooManyRequestsException', 'ProvisionedThroughputExceededException',
+        'TransactionInProgressException', 'RequestLimitExceeded', 'BandwidthLimitExceeded',
+        'LimitExceededException', 'RequestThrottled', 'SlowDown', 'EC2ThrottledException',
+    ])
+
+    def __init__(self):
+        self.operations = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def _get(self, operation):
+        stats = self.operations.get(operation)
+        if stats is None:
+            stats = self.operations[operation] = {
+                'calls': 0,
+                'errors': 0,
+                'retries': 0,
+                'throttles': 0,
+                'total_ms': 0.,
+                'max_ms': 0.,
+                'histogram': [0] * (len(self.LATENCY_BUCKETS_MS) + 1),
+            }
+        return stats
+
+    def record_call(self, operation, latency_ms, retries=0, error=False):
+        bucket = len(self.LATENCY_BUCKETS_MS)
+        for i, bound in enumerate(self.LATENCY_BUCKETS_MS):
+            if latency_ms <= bound:
+                bucket = i
+                break
+        with self._lock:
+            stats = self._get(operation)
+            stats['calls'] += 1
+            stats['errors'] += 1 if error else 0
+            stats['retries'] += retries
+            stats['total_ms'] += latency_ms
+            stats['max_ms'] = max(stats['max_ms'], latency_ms)
+            stats['histogram'][bucket] += 1
+
+    def record_throttle(self, operation):
+        with self._lock:
+            self._get(operation)['throttles'] += 1
+
+    def total(self, field):
+        """The sum of a field (e.g., 'calls') over all operations."""
+        return sum(stats[field] for stats in self.operations.values())
+
+    def to_dict(self):
+        """The stats by operation, with the non-empty histogram buckets
+        labeled by their upper bound."""
+        labels = ['<={}'.format(bound) for bound in self.LATENCY_BUCKETS_MS]
+        labels.append('>{}'.format(self.LATENCY_BUCKETS_MS[-1]))
+        result = collections.OrderedDict()
+        with self._lock:
+            for operation, stats in six.iteritems(self.operations):
+                stats = dict(stats)
+                stats['histogram'] = collections.OrderedDict(
+                    (label, count) for label, count in zip(labels, stats['histogram']) if count)
+                result[operation] = stats
+        return result
+
+# the Boto3CallStats of the request being handled by each thread
+_boto3_call_stats = threading.local()
+
+_BOTO3_CALL_CONTEXT_KEY = 'cfn_custom_resource_call'
+
+def _get_boto3_call_stats():
+    return getattr(_boto3_call_stats, 'current', None)
+
+def _run_with_boto3_call_stats(stats, func, *args, **kwargs):
+    """Call func with stats collecting the boto3 calls of the current thread,
+    for work done in other threads on behalf of a request."""
+    previous = _get_boto3_call_stats()
+    _boto3_call_stats.current = stats
+    try:
+        return func(*args, **kwargs)
+    finally:
+        _boto3_call_stats.current = previous
+
+def _on_boto3_before_parameter_build(model=None, context=None, **kwargs):
+    if context is not None and _get_boto3_call_stats() is not None:
+        operation = '{}.{}'.format(model.service_model.service_name, model.name)
+        context[_BOTO3_CALL_CONTEXT_KEY] = (operation, _monotonic())
+
+def _on_boto3_after_call(parsed=None, context=None, **kwargs):
+    stats = _get_boto3_call_stats()
+    call = context.pop(_BOTO3_CALL_CONTEXT_KEY, None) if context is not None else None
+    if stats is None or call is None:
+        return
+    operation, start = call
+    parsed = parsed or {}
+    retries = parsed.get('ResponseMetadata', {}).get('RetryAttempts', 0)
+    stats.record_call(operation, (_monotonic() - start) * 1000, retries, error='Error' in parsed)
+
+def _on_boto3_after_call_error(context=None, **kwargs):
+    stats = _get_boto3_call_stats()
+    call = context.pop(_BOTO3_CALL_CONTEXT_KEY, None) if context is not None else None
+    if stats is None or call is None:
+        return
+    operation, start = call
+    stats.record_call(operation, (_monotonic() - start) * 1000, error=True)
+
+def _on_boto3_needs_retry(response=None, operation=None, **kwargs):
+    stats = _get_boto3_call_stats()
+    if stats is None or response is None or operation is None:
+        return
+    http_response, parsed = response
+    code = (parsed or {}).get('Error', {}).get('Code')
+    if getattr(http_response, 'status_code', None) == 429 or code in Boto3CallStats.THROTTLE_ERROR_CODES:
+        stats.record_throttle('{}.{}'.format(operation.service_model.service_name, operation.name))
+
+def _instrument_boto3_client(client):
+    """Register the handlers that record calls in the current Boto3CallStats
+    on the client's events, once. They do nothing when there are no stats
+    for the thread."""
+    meta = getattr(client, 'meta', None)
+    events = getattr(meta, 'events', None)
+    if events is None or getattr(meta, '_cfn_custom_resource_instrumented', False):
+        return
+    # before-call can be short-circuited by other handlers (e.g., botocore's
+    # Stubber), but every handler sees before-parameter-build
+    events.register('before-parameter-build', _on_boto3_before_parameter_build,
+                    unique_id='cfn-custom-resource-before-parameter-build')
+    events.register('after-call', _on_boto3_after_call, unique_id='cfn-custom-resource-after-call')
+    events.register('after-call-error', _on_boto3_after_call_error, unique_id='cfn-custom-resource-after-call-error')
+    events.register('needs-retry', _on_boto3_needs_retry, unique_id='cfn-custom-resource-needs-retry')
+    meta._cfn_custom_resource_instrumented = True
+
+def _is_true(value):
+    """Whether a flag from an environment variable or a property, where
+    CloudFormation passes booleans as strings, is set."""
+    if isinstance(value, six.string_types):
+        return value.strip().lower() in ('1', 'true', 'yes', 'on')
+    return bool(value)
+
+def _plainify(obj):
+    """Convert an object (e.g., the Lambda context) to a JSON-serializable dict."""
+    d = {}
+    for field, value in six.iteritems(vars(obj)):
+        if field.startswith('_'):
+            continue
+        d[field] = _plainify_value(value)
+    return d
+
+def _plainify_value(value):
+    if isinstance(value, (float, bool, type(None)) + six.integer_types + six.string_types):
+        return value
+    elif isinstance(value, (list, tuple)):
+        return [_plainify_value(v) for v in value]
+    elif isinstance(value, dict):
+        return dict((k, _plainify_value(v)) for k, v in six.iteritems(value))
+    elif hasattr(value, '__dict__'):
+        return _plainify(value)
+    return repr(value)
+
+def _truncate_for_log(value, max_size):
+    """Return a copy of a JSON-serializable value with long strings truncated."""
+    if isinstance(value, six.string_types):
+        if max_size and len(value) > max_size:
+            return '{}...<{} more characters>'.format(value[:max_size], len(value) - max_size)
+        return value
+    if isinstance(value, _Lazy):
+        return _truncate_for_log(value(), max_size)
+    if isinstance(value, dict):
+        return collections.OrderedDict((k, _truncate_for_log(v, max_size)) for k, v in six.iteritems(value))
+    if isinstance(value, (list, tuple)):
+        return [_truncate_for_log(v, max_size) for v in value]
+    return value
+
+class _Lazy(object):
+    """A value that is computed only when needed, e.g., when a log record is emitted."""
+    def __init__(self, func, *args):
+        self._func = func
+        self._args = args
+
+    def __call__(self):
+        return self._func(*self._args)
+
+class _LazyJson(object):
+    """Serializes the value (after applying transform, if given) only when the
+    log record is formatted, i.e., if it is actually emitted. The result is
+    kept, since each handler formats the record separately."""
+    def __init__(self, value, transform=None):
+        self._value = value
+        self._transform = transform
+        self._str = None
+
+    def __str__(self):
+        if self._str is None:
+            value = self._value
+            if self._transform:
+                value = self._transform(value)
+            self._str = json_serializer.dumps(value)
+        return self._str
+
+def _normalize_property_value(value):
+    """CloudFormation passes scalar property values as strings, so compare them
+    that way."""
+    if isinstance(value, bool):
+        return 'true' if value else 'false'
+    if isinstance(value, six.integer_types + (float,)):
+        return str(value)
+    return value
+
+class PropertyDiff(object):
+    """The differences between two sets of resource properties, computed once.
+
+    Paths are tuples of dict keys and list indexes, e.g., ('Tags', 0, 'Value').
+    The sets added, removed, and changed hold the paths where a value was
+    added, removed, or replaced (including by a value of a different type).
+    Scalars are compared as CloudFormation passes them, as strings, so, e.g.,
+    True and 'true' are equal.
+
+    has_changed() answers whether anything at or below a path changed, or the
+    value containing it was, in time proportional to the depth of the path, so
+    it can be called freely by update handlers."""
+    def __init__(self, old, new):
+        self.added = set()
+        self.removed = set()
+        self.changed = set()
+        self._compare((), old, new)
+
+        self._changed_paths = set()
+        self._changed_prefixes = set()
+        for path in self.paths:
+            path = self._normalize_path(path)
+            self._changed_paths.add(path)
+            for i in range(len(path) + 1):
+                self._changed_prefixes.add(path[:i])
+
+    @property
+    def paths(self):
+        """All paths that were added, removed, or changed."""
+        return self.added | self.removed | self.changed
+
+    def _compare(self, path, old, new):
+        if isinstance(old, dict) and isinstance(new, dict):
+            for key in old:
+                if key not in new:
+                    self.removed.add(path + (key,))
+            for key, value in six.iteritems(new):
+                if key not in old:
+                    self.added.add(path + (key,))
+                else:
+                    self._compare(path + (key,), old[key], value)
+        elif isinstance(old, list) and isinstance(new, list):
+            for i in range(min(len(old), len(new))):
+                self._compare(path + (i,), old[i], new[i])
+            for i in range(len(new), len(old)):
+                self.removed.add(path + (i,))
+            for i in range(len(old), len(new)):
+                self.added.add(path + (i,))
+        elif _normalize_property_value(old) != _normalize_property_value(new):
+            self.changed.add(path)
+
+    @classmethod
+    def _normalize_path(cls, path):
+        if path is None:
+            return ()
+        if isinstance(path, six.string_types):
+            return tuple(path.split('.'))
+        return tuple(str(p) for p in path)
+
+    def _has_changed(self, path):
+        if path in self._changed_prefixes:
+            return True
+        # the path may be below a value that was added, removed, or replaced
+        return any(path[:i] in self._changed_paths for i in range(1, len(path)))
+
+    def has_changed(self, path=None):
+        """Return True if anything at, above, or below the path changed. The
+        path is a tuple, a single key, or a dot-separated string, e.g.,
+        'Tags.0.Value'. A string is checked as a single top-level key first, so
+        keys containing dots still work. With no path, returns True if anything
+        changed at all."""
+        if isinstance(path, six.string_types):
+            return self._has_changed((path,)) or self._has_changed(self._normalize_path(path))
+        if isinstance(path, (tuple, list)) or path is None:
+            return self._has_changed(self._normalize_path(path))
+        return self._has_changed((str(path),))
+
+    def __bool__(self):
+        return bool(self._changed_prefixes)
+    __nonzero__ = __bool__
+
+    def __repr__(self):
+        return 'PropertyDiff(added={!r}, removed={!r}, changed={!r})'.format(
+            sorted(self.added), sorted(self.removed), sorted(self.changed))
+
+class PropertyValidationError(ValueError):
+    """Raised when the resource properties do not match PROPERTIES_SCHEMA. The
+    errors field is a list of messages, one for each invalid property."""
+    def __init__(self, errors):
+        super(PropertyValidationError, self).__init__('invalid properties: ' + '; '.join(errors))
+        self.errors = errors
+
+class PropertyBag(dict):
+    """A dict whose keys can also be accessed as attributes."""
+    def __getattr__(self, name):
+        try:
+            return self[name]
+        except KeyError:
+            raise AttributeError(name)
+
+_MISSING = object()
+
+class Property(object):
+    """Declares a property in PROPERTIES_SCHEMA.
+
+    The type is one of:
+    * str, int, float, or bool: scalars, converted from the strings that
+        CloudFormation passes (e.g., 'true' or '123')
+    * list or dict: any list or dict, unchanged
+    * a list with a single element type, e.g., [int], for a list of that type
+    * a dict with str as its single key, e.g., {str: int}, for a map of that type
+    * a dict of property names to Property objects (or types), for a nested object
+    * any other callable, which is called to convert the value
+    Anywhere a Property is expected, a bare type can be given instead.
+
+    A property that is not required and has no default is None if missing.
+    """
+    def __init__(self, type, required=False, default=_MISSING):
+        self.type = type
+        self.required = required
+        self.default = default
+
+def _describe(value):
+    return '{!r} ({})'.format(value, type(value).__name__)
+
+def _compile_property_type(type_spec):
+    """Compile a type spec into a function taking (value, path, errors) and
+    returning the converted value, appending any messages to errors."""
+    if isinstance(type_spec, Property):
+        type_spec = type_spec.type
+
+    if type_spec is bool:
+        def coerce(value, path, errors):
+            if isinstance(value, bool):
+                return value
+            if isinstance(value, six.string_types) and value.lower() in ('true', 'false'):
+                return value.lower() == 'true'
+            errors.append('{}: expected a boolean, got {}'.format(path, _describe(value)))
+        return coerce
+
+    if type_spec in (int, float):
+        def coerce(value, path, errors):
+            if not isinstance(value, bool):
+                try:
+                    return type_spec(value)
+                except (TypeError, ValueError):
+                    pass
+            errors.append('{}: expected {}, got {}'.format(path, type_spec.__name__, _describe(value)))
+        return coerce
+
+    if type_spec is str or type_spec in six.string_types:
+        def coerce(value, path, errors):
+            if isinstance(value, six.string_types):
+                return value
+            if isinstance(value, (bool, float) + six.integer_types):
+                return _normalize_property_value(value)
+            errors.append('{}: expected a string, got {}'.format(path, _describe(value)))
+        return coerce
+
+    if type_spec in (list, dict):
+        def coerce(value, path, errors):
+            if isinstance(value, type_spec):
+                return value
+            errors.append('{}: expected a {}, got {}'.format(path, type_spec.__name__, _describe(value)))
+        return coerce
+
+    if isinstance(type_spec, list):
+        if len(type_spec) != 1:
+            raise TypeError('list type must have a single element type')
+        coerce_item = _compile_property_type(type_spec[0])
+        def coerce(value, path, errors):
+            if not isinstance(value, list):
+                errors.append('{}: expected a list, got {}'.format(path, _describe(value)))
+                return
+            return [coerce_item(item, '{}.{}'.format(path, i), errors) for i, item in enumerate(value)]
+        return coerce
+
+    if isinstance(type_spec, dict):
+        if len(type_spec) == 1 and list(type_spec.keys())[0] in (str,) + six.string_types:
+            coerce_item = _compile_property_type(list(type_spec.values())[0])
+            def coerce(value, path, errors):
+                if not isinstance(value, dict):
+                    errors.append('{}: expected a map, got {}'.format(path, _describe(value)))
+                    return
+                return PropertyBag((k, coerce_item(v, '{}.{}'.format(path, k), errors)) for k, v in six.iteritems(value))
+            return coerce
+        return _compile_schema(type_spec)
+
+    if callable(type_spec):
+        def coerce(value, path, errors):
+            try:
+                return type_spec(value)
+            except Exception as e:
+                errors.append('{}: {}'.format(path, e))
+        return coerce
+
+    raise TypeError('invalid property type {!r}'.format(type_spec))
+
+def _compile_schema(schema):
+    """Compile a dict of property names to Property objects into a function
+    taking (value, path, errors) and returning a PropertyBag. Properties not
+    in the schema are passed through unchanged."""
+    fields = []
+    for name, prop in six.iteritems(schema):
+        if not isinstance(prop, Property):
+            prop = Property(prop)
+        fields.append((name, prop, _compile_property_type(prop.type)))
+
+    def coerce(value, path, errors):
+        if not isinstance(value, dict):
+            errors.append('{}: expected an object, got {}'.format(path, _describe(value)))
+            return
+        result = PropertyBag(value)
+        for name, prop, coerce_field in fields:
+            field_path = '{}.{}'.format(path, name)
+            if name in value:
+                result[name] = coerce_field(value[name], field_path, errors)
+            elif prop.required:
+                errors.append('{}: required'.format(field_path))
+            elif prop.default is not _MISSING:
+                result[name] = copy.deepcopy(prop.default)
+            else:
+                result[name] = None
+        return result
+    return coerce
+
+def compile_properties_schema(schema):
+    """Compile a schema (see Property) into a function that takes the resource
+    properties and returns them as a PropertyBag with the declared
+    properties converted, raising PropertyValidationError if they are invalid."""
+    coerce = _compile_schema(schema)
+    def validate(properties):
+        errors = []
+        result = coerce(properties, 'Properties', errors)
+        if errors:
+            raise PropertyValidationError(errors)
+        return result
+    return validate
+
+ID_SUFFIX_LEN = 12
+
+_ID_PARTS_CACHE = {}
+_ID_PARTS_CACHE_MAX_SIZE = 1024
+
+def _parse_stack_id(stack_id):
+    """Return the fields available to physical resource id templates from a
+    stack ARN (arn:aws:cloudformation:region:account:stack/name/guid)."""
+    arn_parts = stack_id.split(':')
+    stack_name = arn_parts[-1]
+    if '/' in stack_name:
+        stack_name = stack_name.split('/')[1]
+    return {
+        'region': arn_parts[3] if len(arn_parts) > 5 else '',
+        'account_id': arn_parts[4] if len(arn_parts) > 5 else '',
+        'stack_name': stack_name,
+    }
+
+def _get_id_parts(stack_id, logical_resource_id, template, prefix, separator, max_len, suffix_len):
+    """Return the text that goes before and after the suffix of a physical
+    resource id. This only depends on the stack and resource, so it is cached."""
+    key = (stack_id, logical_resource_id, template, prefix, separator, max_len, suffix_len)
+    parts = _ID_PARTS_CACHE.get(key)
+    if parts is not None:
+        return parts
+
+    fields = _parse_stack_id(stack_id)
+    template_head, template_tail = '', ''
+    if template:
+        if '{id}' not in template:
+            raise ValueError('physical resource id template {!r} does not contain {{id}}'.format(template))
+        template_head, template_tail = template.format(
+            id='\0', logical_id=logical_resource_id, **fields).split('\0', 1)
+    head = template_head + prefix
+    stack_part = fields['stack_name'].replace('-', '')
+    logical_part = logical_resource_id
+
+    if max_len:
+        len_of_parts = max_len - len(head) - len(template_tail) - suffix_len - 2 * len(separator)
+        if len_of_parts < 0:
+            raise ValueError('a physical resource id with prefix {!r} cannot fit in {} characters'.format(
+                head + template_tail, max_len))
+        len_of_parts_diff = (len(stack_part) + len(logical_part)) - len_of_parts
+        if len_of_parts_diff > 0:
+            # take the excess from both, but no more than either has
+            len_of_stack_part = min(len(stack_part), max(0, len(stack_part) - len_of_parts_diff // 2), len_of_parts)
+            len_of_logical_part = len_of_parts - len_of_stack_part
+            stack_part = stack_part[:len_of_stack_part]
+            logical_part = logical_part[:len_of_logical_part]
+
+    parts = (head + stack_part + separator + logical_part + separator, template_tail)
+    if len(_ID_PARTS_CACHE) >= _ID_PARTS_CACHE_MAX_SIZE:
+        _ID_PARTS_CACHE.clear()
+    _ID_PARTS_CACHE[key] = parts
+    return parts
+
+def _encode_id_suffix(data):
+    return base64.b32encode(data).decode('ascii')[:ID_SUFFIX_LEN]
+
+def random_id_suffix(resource):
+    """A random physical resource id suffix, from the system CSPRNG."""
+    return _encode_id_suffix(os.urandom(8))
+
+def deterministic_id_suffix(resource):
+    """A physical resource id suffix that is a hash of the stack id, logical
+    resource id, and request id, so that handling the same request again
+    (for example, after a retry or a duplicate delivery) gives the same id."""
+    data = '\n'.join([resource.stack_id, resource.logical_resource_id, resource.request_id])
+    return _encode_id_suffix(hashlib.sha256(data.encode('utf-8')).digest())
+
+PHYSICAL_RESOURCE_ID_STRATEGIES = {
+    'random': random_id_suffix,
+    'deterministic': deterministic_id_suffix,
+}
+
+class InProgress(object):
+    """Return an instance of this from create(), update(), or delete() to
+    indicate that the work is not finished. Rather than sending a response, the
+    Lambda function is invoked again, asynchronously, with the same request,
+    and the same method is called with self.checkpoint set to the given
+    checkpoint, which must be JSON-serializable."""
+    def __init__(self, checkpoint=None):
+        self.checkpoint = checkpoint
+
+    def __repr__(self):
+        return 'InProgress({!r})'.format(self.checkpoint)
+
+def _unwrap_record(record):
+    """Return the CloudFormation request carried in an SNS or SQS record."""
+    if 'Sns' in record:
+        return json_serializer.loads(record['Sns']['Message'])
+    body = json_serializer.loads(record['body'])
+    if body.get('Type') == 'Notification' and 'Message' in body:
+        body = json_serializer.loads(body['Message'])
+    return body
+
+def _get_record_id(record):
+    if 'Sns' in record:
+        return record['Sns'].get('MessageId')
+    return record.get('messageId')
+
+def _handle_records(records, context, create_resource, max_workers):
+    """Handle each record with the resource that create_resource() returns for
+    the request it carries, on a pool of up to max_workers threads, and return
+    the outcomes."""
+    def handle_record(record):
+        return _handle_record(record, context, create_resource)
+
+    max_workers = min(max_workers, len(records))
+    if max_workers <= 1:
+        return [handle_record(record) for record in records]
+
+    from concurrent import futures
+    with futures.ThreadPoolExecutor(max_workers=max_workers) as executor:
+        return list(executor.map(handle_record, records))
+
+def _handle_record(record, context, create_resource):
+    outcome = {
+        'RecordId': None,
+        'RequestId': None,
+        'LogicalResourceId': None,
+        'Status': None,
+        'Reason': None,
+        'ResponseSent': False,
+    }
+    try:
+        outcome['RecordId'] = _get_record_id(record)
+        event = _unwrap_record(record)
+        outcome['RequestId'] = event.get('RequestId')
+        outcome['LogicalResourceId'] = event.get('LogicalResourceId')
+
+        resource = create_resource(event)
+        resource.handle(event, context)
+
+        outcome['Status'] = resource.status
+        outcome['Reason'] = resource.failure_reason
+        outcome['ResponseSent'] = resource.response_error is None
+    except Exception as e:
+        logging.getLogger('CloudFormationCustomResource').error(
+            'Handling record {} failed: {}'.format(outcome['RecordId'], e))
+        outcome['Status'] = CloudFormationCustomResource.STATUS_FAILED
+        outcome['Reason'] = str(e)
+    return outcome
+
+def _get_batch_item_failures(outcomes):
+    """Return the SQS partial batch response for the outcomes of handling the
+    records, listing the messages for which no response could be sent."""
+    return {
+        'batchItemFailures': [{'itemIdentifier': outcome['RecordId']}
+                              for outcome in outcomes if not outcome['ResponseSent']],
+    }
+
+_class_metadata = collections.namedtuple('_class_metadata',
+        ['resource_type_spec', 'resource_types', 'logger', 'base_logger', 'properties_validator'])
 
 class CloudFormationCustomResource(object):
     """Base class for CloudFormation custom resource classes.
@@ -64,6 +817,11 @@ class CloudFormationCustomResource(object):
     incoming requests against types other than the class name, set
     RESOURCE_TYPE_SPEC to be a string or a list of strings.
 
+    The handler also accepts CloudFormation requests delivered through SNS. If an
+    SNS event contains several records, they are handled concurrently by
+    handle_batch(), each by its own instance, and each sends its own response.
+    To consume requests from an SQS queue instead, use get_sqs_handler().
+
     Child classes must implement the create(), update(), and delete() methods.
     Each of these methods can indicate success or failure in one of two ways:
     * Simply return or raise an exception
@@ -75,6 +833,14 @@ class CloudFormationCustomResource(object):
     is a dict, that is merged into resource_outputs. If it is not a dict, the value
     is stored under the 'result' key.
     
+    Work that takes longer than a single invocation can be split up: the method
+    returns InProgress(checkpoint), and the function is invoked again with the same
+    request, calling the same method with self.checkpoint set to the checkpoint
+    (and self.continuation_count to the number of continuations so far). The
+    response is sent once the method returns anything else. The invocation is done
+    by continuation_invoker_function (see below), and MAX_CONTINUATIONS can limit
+    the number of continuations.
+
     By default, before create is called, self.physical_resource_id is set to a value
     that is generated similar to how CloudFormation does it:
     {stack_id}-{logical resource id}-{random string}. This value should be used to
@@ -84,19 +850,36 @@ class CloudFormationCustomResource(object):
     should set the class field DISABLE_PHYSICAL_RESOURCE_ID_GENERATION=True, and 
     set self.physical_resource_id yourself within the create method.
 
+    Child classes may declare PROPERTIES_SCHEMA, a dict of property names to Property
+    objects, giving their types, defaults, and whether they are required. The schema
+    is compiled once per class, and before dispatch the properties are validated
+    and converted from the strings CloudFormation passes, and stored in
+    self.properties (and self.old_properties) as a PropertyBag, whose fields can be
+    accessed as attributes. Invalid properties fail the request with a
+    PropertyValidationError listing every problem, before any method is called,
+    except on Delete, where a warning is logged and self.properties is left None.
+
     Child classes may implement validate() and/or populate(). validate() should return
     True if self.resource_properties is valid. populate() can transfer the contents of
     self.resource_properties into object fields, if this is not done by validate().
 
     The class provides methods get_boto3_client() and get_boto3_resource() that cache
     the clients/resources in the class, reducing overhead in the Lambda invocations.
+    They accept region_name, endpoint_url, config, and other keyword arguments for
+    the client, and cache separately for each combination. The cache, BOTO3_CACHE,
+    is a Boto3Cache shared by all subclasses and safe to use from multiple threads;
+    a subclass can set its own, e.g., Boto3Cache(max_size=16) for LRU eviction.
+    For compatibility, BOTO3_CLIENTS and BOTO3_RESOURCES, dicts from service name
+    to client or resource, are still checked first when no keyword arguments are
+    given, so subclasses that preload them (e.g., with mocks) keep working. They
+    are no longer filled in by the methods; new code should use BOTO3_CACHE.
     These also rely on the get_boto3_session() method, which in turn uses
     BOTO3_SESSION_FACTORY if it is set, allowing overriding with mock sessions for
     testing. Similarly, BOTO3_CLIENT_FACTORY and BOTO3_RESOURCE_FACTORY, both of which
-    can be set to callables that take a session and a name, can be set to override
-    client and resource creation.
+    can be set to callables that take a session and a name (and any keyword
+    arguments), can be set to override client and resource creation.
 
-    Some hooks are provided to override behavior. The first four are instance fields,
+    Some hooks are provided to override behavior. All but the last are instance fields,
     since they may be set to functions that rely on instance fields. The last
     is a class field, since it is called by a class method.
     * finish_function, normally set to CloudFormationCustomResource.cfn_response, takes
@@ -105,7 +888,11 @@ class CloudFormationCustomResource(object):
     * send_function, used within CloudFormationCustomResource.cfn_response, takes as
         input the custom resource object, a url, and the response_content dictionary.
         Normally this is set to CloudFormationCustomResource.send_response, which uses
-        requests to send the content to its destination.
+        requests to send the content to its destination, retrying transient failures
+        (see the RESPONSE_* class fields) within the remaining Lambda time. The
+        requests session comes from get_requests_session(), which caches it in the
+        class so connections are kept alive across warm invocations, and uses
+        REQUESTS_SESSION_FACTORY if it is set.
     * generate_unique_id_prefix_function can be set to put a prefix on the id returned
         by generate_unique_id, for example if the physical resource
         id needs to be an ARN.
@@ -115,15 +902,26 @@ class CloudFormationCustomResource(object):
         set to CloudFormationCustomResource.generate_unique_id, which
         generates a physical resource id like CloudFormation:
         {stack_id}-{logical resource id}-{random string}
+        (see PHYSICAL_RESOURCE_ID_STRATEGY and PHYSICAL_RESOURCE_ID_TEMPLATE).
         It also provides two keyword arguments:
         * prefix: if for example the physical resource id must be an arn
         * separator: defaulting to '-'.
+    * metrics_function takes as input the custom resource object, when EMIT_METRICS
+        is True, once the request is finished. It is normally set to
+        CloudFormationCustomResource.emit_metrics, which prints get_metrics() to stdout.
+    * profile_function takes as input the custom resource object and a cProfile.Profile
+        of the create(), update(), or delete() call, when profiling is enabled (see
+        PROFILE). It is normally set to CloudFormationCustomResource.log_profile.
+    * continuation_invoker_function takes as input the custom resource object and the
+        event for the next invocation, when a method has returned InProgress. This is
+        normally set to CloudFormationCustomResource.invoke_continuation, which invokes
+        the running Lambda function asynchronously.
     * BOTO3_SESSION_FACTORY takes no input and returns an object that acts like a boto3 session.
         If this class field is not None, it is used by get_boto3_session() instead of creating
         a regular boto3 session. This could be made to use placebo for testing
         https://github.com/garnaat/placebo
 
-    The class provides four configuration options that can be overridden in child
+    The class provides configuration options that can be overridden in child
     classes:
     * DELETE_LOGS_ON_STACK_DELETION: A boolean which, when True, will cause a successful
         stack deletion to trigger the deletion of the CloudWatch log group on stack
@@ -137,11 +935,87 @@ class CloudFormationCustomResource(object):
         self.physical_resource_id in the create() method.
     * PHYSICAL_RESOURCE_ID_MAX_LEN: An int used by generate_unique_id
         when generating a physical resource id.
+    * PHYSICAL_RESOURCE_ID_STRATEGY: How generate_unique_id creates the suffix of
+        the id. 'random' (the default) uses the system CSPRNG. 'deterministic' hashes
+        the stack id, logical resource id, and request id, so that handling a request
+        again yields the same id rather than orphaning a new resource. This can also
+        be a function taking the custom resource object and returning the suffix.
+    * PHYSICAL_RESOURCE_ID_TEMPLATE: A format string to put the generated id in,
+        for example if it must be an ARN, containing {id} and optionally {region},
+        {account_id}, {stack_name}, and {logical_id}, for example
+        'arn:aws:sns:{region}:{account_id}:{id}'. The id is shortened so that the
+        whole result fits within PHYSICAL_RESOURCE_ID_MAX_LEN.
+    * REUSE_INSTANCE: If True, get_handler() creates a single instance up front
+        and reuses it for every invocation of a warm container, rather than
+        creating a new instance per call. handle() resets the per-request
+        fields, but anything a child class stores on the instance itself
+        will persist between requests.
+    * PREWARM_CLIENTS, PREWARM_RESOURCES: boto3 clients and resources to create in
+        on_init(), which get_handler() calls during the Lambda init phase, so the
+        first request doesn't pay for their construction.
+    * JSON_SERIALIZER: The JsonSerializer used for the response body, logging, and
+        continuation payloads, which uses orjson or ujson if they are installed.
+        SNS and SQS messages are parsed with the module's default serializer.
+        Stringified outputs (see STRINGIFY_OUTPUT) always use the json module, so that
+        their format doesn't depend on which backend is installed.
+    * INSTRUMENT_BOTO3: If True, clients and resources from get_boto3_client() and
+        get_boto3_resource() have handlers registered on their botocore events that
+        record, in self.boto3_stats (a Boto3CallStats), the number of calls, latency
+        histogram, errors, retries, and throttles of each operation called while
+        handling the request. These are logged when the request finishes, and
+        their totals are added to the metrics (see EMIT_METRICS). Calls made from
+        other threads are not recorded, except by AsyncCloudFormationCustomResource.
+    * EMIT_METRICS: If True, the time taken by each phase of the request (kept in
+        self.timings, in seconds, either way) is emitted after the response as an
+        EMF log line, in the METRICS_NAMESPACE namespace, with the response attempts,
+        status, and ids; see get_metrics(). utils.parse_metrics() reads them back.
+    * PROFILE: If True, the call to create(), update(), or delete() is profiled with
+        cProfile, and the profile is passed to profile_function, which by default logs
+        the top PROFILE_LIMIT functions sorted by PROFILE_SORT and, if PROFILE_BLOB_STORE
+        is set (see RESPONSE_BLOB_STORE), stores the full profile there. Profiling is
+        also enabled by setting the environment variable named by
+        PROFILE_ENVIRONMENT_VARIABLE, or for a single resource by setting its
+        PROFILE_PROPERTY property to true. That property is removed from the
+        properties before they are seen by any other code. When profiling is not
+        enabled, nothing is imported or set up for it.
+    * STRUCTURED_LOGGING: If True, the request, dispatch, and response are each logged
+        as a single JSON line (see log_structured()) with the request id and stack id,
+        and strings longer than LOG_MAX_VALUE_SIZE are truncated. In either mode,
+        events, contexts and responses are only serialized if the log level is
+        enabled.
+    * RESPONSE_STORE: An object with get(key) and put(key, response_content) methods,
+        such as the stores in cfn_custom_resource.stores. If set, every response is
+        recorded under the RequestId and LogicalResourceId, and when the same request
+        is delivered again (CloudFormation and SNS both retry), the stored response
+        is sent again without calling create(), update(), or delete(). Concurrent
+        duplicates may still both be handled.
+    * RESPONSE_BLOB_STORE: CloudFormation rejects responses over 4 KB
+        (MAX_RESPONSE_SIZE). If this is set to an object with a put(key, value)
+        method returning a reference, such as the blob stores in
+        cfn_custom_resource.stores, outputs are offloaded to it, largest first,
+        until the response fits, and the attributes hold the references instead.
+        The reason is also truncated if needed, and a response that still doesn't
+        fit is turned into a failure explaining why.
+    * BATCH_MAX_WORKERS: The maximum number of threads handle_batch() uses to
+        handle records concurrently.
+    * TIMEOUT_WATCHDOG_MARGIN_MILLIS: If set, and the request is still being
+        handled this many milliseconds before the Lambda times out, a watchdog
+        thread sends the response with status TIMEOUT_STATUS (by default,
+        STATUS_FAILED) and a reason saying where the handler was stuck, rather
+        than leaving CloudFormation to wait for an hour. The handler keeps running
+        until it finishes or the Lambda times out, so the margin should cover the
+        time to send the response, e.g., 1000. Defaults to None, disabling the
+        watchdog.
+
+    The normalized resource type spec and the loggers are computed once per
+    class, on first instantiation, rather than for every instance.
     """
     DELETE_LOGS_ON_STACK_DELETION = False
 
     DISABLE_PHYSICAL_RESOURCE_ID_GENERATION = False
     PHYSICAL_RESOURCE_ID_MAX_LEN = 128
+    PHYSICAL_RESOURCE_ID_STRATEGY = 'random'
+    PHYSICAL_RESOURCE_ID_TEMPLATE = None
 
     STATUS_SUCCESS = 'SUCCESS'
     STATUS_FAILED = 'FAILED'
@@ -158,30 +1032,72 @@ class CloudFormationCustomResource(object):
 
     STRINGIFY_OUTPUT = True
 
+    REUSE_INSTANCE = False
+
+    PROPERTIES_SCHEMA = None
+
+    RESPONSE_STORE = None
+
+    STRUCTURED_LOGGING = False
+    LOG_MAX_VALUE_SIZE = 1024
+
+    JSON_SERIALIZER = json_serializer
+
+    EMIT_METRICS = False
+    METRICS_NAMESPACE = 'CfnCustomResource'
+
+    PROFILE = False
+    PROFILE_ENVIRONMENT_VARIABLE = 'CFN_CUSTOM_RESOURCE_PROFILE'
+    PROFILE_PROPERTY = 'CfnCustomResourceProfile'
+    PROFILE_SORT = 'cumulative'
+    PROFILE_LIMIT = 25
+    PROFILE_BLOB_STORE = None
+
+    TIMEOUT_WATCHDOG_MARGIN_MILLIS = None
+    TIMEOUT_STATUS = STATUS_FAILED
+
+    CONTINUATION_KEY = 'CfnCustomResourceContinuation'
+    MAX_CONTINUATIONS = None
+
     def __init__(self, logger=None):
+        metadata = self._get_class_metadata()
+
         if logger:
             self.logger = logger
         else:
-            self.logger = logging.getLogger(self.__class__.__name__)
+            self.logger = metadata.logger
 
-        self._base_logger = logging.getLogger('CloudFormationCustomResource')
-        if self.BASE_LOGGER_LEVEL:
-            self._base_logger.setLevel(self.BASE_LOGGER_LEVEL)
+        self._base_logger = metadata.base_logger
 
-        resource_type_spec = getattr(self, 'RESOURCE_TYPE_SPEC', self.__class__.__name__)
+        self._properties_validator = metadata.properties_validator
 
-        def process_resource_type_spec(resource_type_spec):
-            if not (resource_type_spec.startswith('Custom::') or resource_type_spec == 'AWS::CloudFormation::CustomResource'):
-                resource_type_spec = 'Custom::' + resource_type_spec
-            return resource_type_spec
+        if 'RESOURCE_TYPE_SPEC' in vars(self):
+            # set on the instance before this was called, so the per-class
+            # metadata doesn't apply
+            self.resource_type_spec = self._process_resource_type_spec(self.RESOURCE_TYPE_SPEC)
+            self._resource_types = self._get_resource_types(self.resource_type_spec)
+        else:
+            self.resource_type_spec = metadata.resource_type_spec
+            self._resource_types = metadata.resource_types
 
-        if isinstance(resource_type_spec, (list, tuple)):
-            resource_type_spec = [process_resource_type_spec(rt) for rt in resource_type_spec]
-        elif isinstance(resource_type_spec, six.string_types):
-            resource_type_spec = process_resource_type_spec(resource_type_spec)
+        self._finish_lock = threading.Lock()
+        self._reset_request_state()
 
-        self.resource_type_spec = resource_type_spec
+        self.finish_function = self.cfn_response
+        self.send_response_function = self.send_response
 
+        self.generate_unique_id_prefix_function = None
+        self.generate_physical_resource_id_function = self.generate_unique_id
+
+        self.continuation_invoker_function = self.invoke_continuation
+
+        self.metrics_function = self.emit_metrics
+
+        self.profile_function = self.log_profile
+
+    def _reset_request_state(self):
+        """Clear everything that is specific to a single request, so that an
+        instance can be reused across invocations."""
         self.event = None
         self.context = None
 
@@ -195,24 +1111,83 @@ class CloudFormationCustomResource(object):
         self.physical_resource_id = None
         self.resource_properties = None
         self.old_resource_properties = None
+        self._property_diff = None
+        self.properties = None
+        self.old_properties = None
 
         self.status = None
         self.failure_reason = None
         self.resource_outputs = {}
 
-        self.finish_function = self.cfn_response
-        self.send_response_function = self.send_response
+        self.response_attempts = 0
+        self.response_error = None
+        self.offloaded_outputs = {}
 
-        self.generate_unique_id_prefix_function = None
-        self.generate_physical_resource_id_function = self.generate_unique_id
+        self.checkpoint = None
+        self.continuation_count = 0
+        self.continuation = None
+
+        self.replayed = False
+        self.timed_out = False
+        self._watchdog = None
+        self._finished = False
+
+        self.timings = collections.OrderedDict()
+        self._request_start = None
+        self.boto3_stats = None
+        self.profiling = False
+
+    @classmethod
+    def _get_class_metadata(cls):
+        """Return the per-class metadata, computing it on first use. This is
+        stored on the class itself (not inherited), so each subclass
+        computes its own exactly once."""
+        metadata = cls.__dict__.get('_CLASS_METADATA')
+        if metadata is None:
+            resource_type_spec = cls._process_resource_type_spec(
+                    getattr(cls, 'RESOURCE_TYPE_SPEC', cls.__name__))
+
+            base_logger = logging.getLogger('CloudFormationCustomResource')
+            if cls.BASE_LOGGER_LEVEL:
+                base_logger.setLevel(cls.BASE_LOGGER_LEVEL)
+
+            metadata = _class_metadata(
+                resource_type_spec=resource_type_spec,
+                resource_types=cls._get_resource_types(resource_type_spec),
+                logger=logging.getLogger(cls.__name__),
+                base_logger=base_logger,
+                properties_validator=(compile_properties_schema(cls.PROPERTIES_SCHEMA)
+                                      if cls.PROPERTIES_SCHEMA is not None else None),
+            )
+            cls._CLASS_METADATA = metadata
+        return metadata
+
+    @classmethod
+    def _process_resource_type_spec(cls, resource_type_spec):
+        def process_resource_type_spec(resource_type_spec):
+            if not (resource_type_spec.startswith('Custom::') or resource_type_spec == 'AWS::CloudFormation::CustomResource'):
+                resource_type_spec = 'Custom::' + resource_type_spec
+            return resource_type_spec
+
+        if isinstance(resource_type_spec, (list, tuple)):
+            resource_type_spec = [process_resource_type_spec(rt) for rt in resource_type_spec]
+        elif isinstance(resource_type_spec, six.string_types):
+            resource_type_spec = process_resource_type_spec(resource_type_spec)
+        return resource_type_spec
+
+    @classmethod
+    def _get_resource_types(cls, resource_type_spec):
+        if not resource_type_spec:
+            return None
+        if isinstance(resource_type_spec, (list, tuple)):
+            return frozenset(resource_type_spec)
+        return frozenset([resource_type_spec])
 
     def validate_resource_type(self, resource_type):
         """Return True if resource_type is valid"""
-        if not self.resource_type_spec:
+        if self._resource_types is None:
             return True
-        if isinstance(self.resource_type_spec, (list, tuple)):
-            return resource_type in self.resource_type_spec
-        return resource_type == self.resource_type_spec
+        return resource_type in self._resource_types
 
     def validate(self):
         """Return True if self.resource_properties is valid."""
@@ -232,47 +1207,79 @@ class CloudFormationCustomResource(object):
     def delete(self):
         raise NotImplementedError
 
+    @property
+    def property_diff(self):
+        """The PropertyDiff between self.old_resource_properties (empty during
+        create) and self.resource_properties, computed on first use and then
+        kept for the rest of the request."""
+        if self._property_diff is None:
+            self._property_diff = PropertyDiff(self.old_resource_properties or {}, self.resource_properties or {})
+        return self._property_diff
+
     def has_property_changed(self, property_name):
-        """Test if a property has changed. Will return true during create."""
+        """Test if a property has changed. Will return true during create.
+        property_name is checked as a top-level property first, and can also
+        be a path to a nested property, see PropertyDiff.has_changed()."""
         return (self.old_resource_properties is None
-            or self.old_resource_properties.get(property_name) != self.resource_properties.get(property_name)) 
+            or self.property_diff.has_changed(property_name))
 
     BOTO3_SESSION_FACTORY = None
     BOTO3_CLIENT_FACTORY = None
     BOTO3_RESOURCE_FACTORY = None
 
     BOTO3_SESSION = None
+    BOTO3_CACHE = Boto3Cache()
     BOTO3_CLIENTS = {}
     BOTO3_RESOURCES = {}
+    INSTRUMENT_BOTO3 = False
+    _BOTO3_SESSION_LOCK = threading.Lock()
 
     @classmethod
     def get_boto3_session(cls):
         if cls.BOTO3_SESSION is None:
-            if cls.BOTO3_SESSION_FACTORY:
-                cls.BOTO3_SESSION = cls.BOTO3_SESSION_FACTORY()
-            else:
-                cls.BOTO3_SESSION = boto3.session.Session()
+            with cls._BOTO3_SESSION_LOCK:
+                if cls.BOTO3_SESSION is None:
+                    if cls.BOTO3_SESSION_FACTORY:
+                        cls.BOTO3_SESSION = cls.BOTO3_SESSION_FACTORY()
+                    else:
+                        import boto3.session
+                        cls.BOTO3_SESSION = boto3.session.Session()
         return cls.BOTO3_SESSION
 
     @classmethod
-    def get_boto3_client(cls, name):
-        if name not in cls.BOTO3_CLIENTS:
-            if cls.BOTO3_CLIENT_FACTORY:
-                client = cls.BOTO3_CLIENT_FACTORY(cls.get_boto3_session(), name)
-            else:
-                client = cls.get_boto3_session().client(name)
-            cls.BOTO3_CLIENTS[name] = client
-        return cls.BOTO3_CLIENTS[name]
+    def _get_boto3_object(cls, kind, factory, name, kwargs):
+        session = cls.get_boto3_session()
+        kwargs = dict((k, v) for k, v in six.iteritems(kwargs) if v is not None)
+        obj = None
+        if not kwargs:
+            obj = (cls.BOTO3_CLIENTS if kind == 'client' else cls.BOTO3_RESOURCES).get(name)
+        if obj is None:
+            # the key holds the session itself, so that its id can't be reused
+            # by a new session while clients from the old one are cached
+            key = (kind, session, factory, name,
+                   tuple(sorted((k, v if k != 'config' else _config_key(v)) for k, v in six.iteritems(kwargs))))
+            def create():
+                if factory:
+                    return factory(session, name, **kwargs)
+                return getattr(session, kind)(name, **kwargs)
+            obj = cls.BOTO3_CACHE.get(key, create)
+        if cls.INSTRUMENT_BOTO3:
+            _instrument_boto3_client(obj.meta.client if kind == 'resource' and hasattr(obj, 'meta') else obj)
+        return obj
 
     @classmethod
-    def get_boto3_resource(cls, name):
-        if name not in cls.BOTO3_RESOURCES:
-            if cls.BOTO3_RESOURCE_FACTORY:
-                resource = cls.BOTO3_RESOURCE_FACTORY(cls.get_boto3_session(), name)
-            else:
-                resource = cls.get_boto3_session().resource(name)
-            cls.BOTO3_RESOURCES[name] = resource
-        return cls.BOTO3_RESOURCES[name]
+    def get_boto3_client(cls, name, region_name=None, endpoint_url=None, config=None, **kwargs):
+        """Return a boto3 client from the cache, creating it if needed. Clients
+        are cached separately for each session, region, endpoint, and config."""
+        kwargs.update(region_name=region_name, endpoint_url=endpoint_url, config=config)
+        return cls._get_boto3_object('client', cls.BOTO3_CLIENT_FACTORY, name, kwargs)
+
+    @classmethod
+    def get_boto3_resource(cls, name, region_name=None, endpoint_url=None, config=None, **kwargs):
+        """Return a boto3 resource from the cache, creating it if needed. Resources
+        are cached separately for each session, region, endpoint, and config."""
+        kwargs.update(region_name=region_name, endpoint_url=endpoint_url, config=config)
+        return cls._get_boto3_object('resource', cls.BOTO3_RESOURCE_FACTORY, name, kwargs)
 
     @classmethod
     def get_handler(cls, *args, **kwargs):
@@ -280,34 +1287,195 @@ class CloudFormationCustomResource(object):
         instance of the class in every call, passing any arguments given to
         get_handler.
 
+        If REUSE_INSTANCE is True, a single instance is created up front and
+        used for every call instead.
+
+        Events with multiple records are passed to handle_batch(), which
+        uses a new instance for each record.
+
+        get_handler() also calls on_init() (once per class), so that work like
+        creating the PREWARM_CLIENTS is done in the Lambda init phase, when
+        get_handler() is called at module import.
+
         Use like:
         handler = MyCustomResource.get_handler()"""
+        cls._init_class()
+        if cls.REUSE_INSTANCE:
+            instance = cls(*args, **kwargs)
+            def handler(event, context):
+                if cls._is_batch_event(event):
+                    return cls.handle_batch(event['Records'], context, *args, **kwargs)
+                return instance.handle(event, context)
+        else:
+            def handler(event, context):
+                if cls._is_batch_event(event):
+                    return cls.handle_batch(event['Records'], context, *args, **kwargs)
+                return cls(*args, **kwargs).handle(event, context)
+        return handler
+
+    BATCH_MAX_WORKERS = 8
+
+    PREWARM_CLIENTS = ()
+    PREWARM_RESOURCES = ()
+
+    @classmethod
+    def on_init(cls):
+        """Called once per class by get_handler(), i.e., during the Lambda init
+        phase if the handler is created at module level. Override this to do
+        any expensive setup ahead of the first request; call the parent
+        method to keep the prewarming of boto3 clients and resources.
+
+        By default, this creates the boto3 clients listed in PREWARM_CLIENTS
+        and the resources listed in PREWARM_RESOURCES. Each entry is either a
+        service name or a tuple of the service name and a dict of keyword
+        arguments, e.g., ('s3', {'region_name': 'us-west-2'})."""
+        for kind, names, get in [
+                ('client', cls.PREWARM_CLIENTS, cls.get_boto3_client),
+                ('resource', cls.PREWARM_RESOURCES, cls.get_boto3_resource)]:
+            for name in names:
+                kwargs = {}
+                if isinstance(name, (list, tuple)):
+                    name, kwargs = name
+                try:
+                    get(name, **kwargs)
+                except Exception as e:
+                    # don't fail the import; the request will hit the error
+                    logging.getLogger('CloudFormationCustomResource').warning(
+                        'Prewarming boto3 {} {} failed: {}'.format(kind, name, e))
+
+    @classmethod
+    def _init_class(cls):
+        if cls.__dict__.get('_INITIALIZED'):
+            return
+        cls._INITIALIZED = True
+        cls.on_init()
+
+    @classmethod
+    def _is_batch_event(cls, event):
+        return 'Records' in event and len(event['Records']) > 1
+
+    @classmethod
+    def get_sqs_handler(cls, *args, **kwargs):
+        """Returns a handler suitable for Lambda to call with events from an SQS
+        event source. Each message body can be a CloudFormation request, or an
+        SNS notification carrying one (i.e., an SNS topic subscribed to the
+        queue without raw message delivery).
+
+        The messages in the batch are handled concurrently by handle_batch(),
+        and the handler returns the partial batch response, listing the
+        messages for which no response could be sent to CloudFormation, so
+        that only those are redelivered. This requires the event source
+        mapping to have ReportBatchItemFailures enabled.
+
+        Use like:
+        handler = MyCustomResource.get_sqs_handler()"""
+        cls._init_class()
         def handler(event, context):
-            return cls(*args, **kwargs).handle(event, context)
+            if 'Records' not in event:
+                # e.g., a continuation, which invokes the function directly
+                return cls(*args, **kwargs).handle(event, context)
+            outcomes = cls.handle_batch(event['Records'], context, *args, **kwargs)
+            return _get_batch_item_failures(outcomes)
         return handler
 
+    @classmethod
+    def handle_batch(cls, records, context, *args, **kwargs):
+        """Handle a list of records (e.g., the Records of an SNS event), each
+        carrying a CloudFormation request.
+
+        Each record is handled by its own instance of the class, created with
+        the given arguments, on a pool of up to BATCH_MAX_WORKERS threads, and
+        sends its own response. A failure in one record does not affect the
+        others. Returns a list of the outcome of each record, in order, as
+        dicts with the fields RecordId, RequestId, LogicalResourceId, Status,
+        Reason, and ResponseSent."""
+        return _handle_records(records, context, lambda event: cls(*args, **kwargs), cls.BATCH_MAX_WORKERS)
+
     def handle(self, event, context):
         """Use the get_handler class method to get a handler that calls this method."""
-        self._base_logger.info('REQUEST RECEIVED: {}'.format(json.dumps(event)))
-        def plainify(obj):
-            d = {}
-            for field, value in six.iteritems(vars(obj)):
-                if field.startswith('_'):
-                    continue
-                if isinstance(value, (float, bool, type(None)) + six.integer_types + six.string_types):
-                    d[field] = value
-                elif isinstance(value, (list, tuple)):
-                    d[field] = [plainify(v) for v in value]
-                elif isinstance(value, dict):
-                    d[field] = dict((k, plainify(v)) for k, v in six.iteritems(value))
-                else:
-                    d[field] = repr(value)
-            return d
-        self._base_logger.info('LambdaContext: %s' % json.dumps(plainify(context)))
+        try:
+            self._start_request(event, context)
+
+            if self._replay_stored_response():
+                return
+
+            try:
+                self._prepare_request()
+                with self._timed('dispatch'):
+                    if self.profiling:
+                        with self._profiled():
+                            outputs = self._dispatch_request()
+                    else:
+                        outputs = self._dispatch_request()
+                self._set_outputs(outputs)
+            except Exception as e:
+                self._set_exception(e)
+
+            self._finish_request()
+        finally:
+            self._clear_boto3_call_stats()
+
+    @contextlib.contextmanager
+    def _profiled(self):
+        """Profile the block with cProfile, and pass the profiler to
+        profile_function afterwards."""
+        import cProfile
+        profiler = cProfile.Profile()
+        profiler.enable()
+        try:
+            yield
+        finally:
+            profiler.disable()
+            try:
+                self.profile_function(self, profiler)
+            except Exception as e:
+                self._base_logger.warning("Reporting the profile failed: {}".format(e))
+
+    @classmethod
+    def log_profile(cls, resource, profiler):
+        """Log the top PROFILE_LIMIT functions of the profile, sorted by
+        PROFILE_SORT, and put the full profile in PROFILE_BLOB_STORE if set."""
+        import pstats
+        stream = six.StringIO()
+        pstats.Stats(profiler, stream=stream).strip_dirs().sort_stats(cls.PROFILE_SORT).print_stats(cls.PROFILE_LIMIT)
+        resource._base_logger.info("Profile of %s:\n%s", resource.request_type.lower(), stream.getvalue())
+        if cls.PROFILE_BLOB_STORE is not None:
+            stream = six.StringIO()
+            pstats.Stats(profiler, stream=stream).sort_stats(cls.PROFILE_SORT).print_stats()
+            key = '{}/{}/{}/profile-{}.txt'.format(resource.stack_id.split(':')[-1],
+                                                   resource.logical_resource_id,
+                                                   resource.request_id,
+                                                   resource.continuation_count)
+            reference = cls.PROFILE_BLOB_STORE.put(key, stream.getvalue())
+            resource._base_logger.info("Stored the full profile at %s", reference)
+
+    @contextlib.contextmanager
+    def _timed(self, phase):
+        """Add the time spent in the block to self.timings[phase]."""
+        start = _monotonic()
+        try:
+            yield
+        finally:
+            self.timings[phase] = self.timings.get(phase, 0) + (_monotonic() - start)
+
+    def _start_request(self, event, context):
+        """Log the request and populate the per-request fields from it."""
+        request_start = _monotonic()
+        if not self.STRUCTURED_LOGGING:
+            self._base_logger.info('REQUEST RECEIVED: %s', _LazyJson(event))
+            self._base_logger.info('LambdaContext: %s', _LazyJson(context, _plainify))
 
         # handle an event nested inside of an SNS event
-        if 'Records' in event and len(event['Records']) == 1:
-            event = json.loads(event['Records'][0]['Sns']['Message'])
+        if 'Records' in event:
+            if len(event['Records']) != 1:
+                raise ValueError('Event contains {} records, use handle_batch()'.format(len(event['Records'])))
+            event = _unwrap_record(event['Records'][0])
+
+        self._reset_request_state()
+        self._request_start = request_start
+        if self.INSTRUMENT_BOTO3:
+            self.boto3_stats = Boto3CallStats()
+            _boto3_call_stats.current = self.boto3_stats
 
         self.event = event
         self.context = context
@@ -323,54 +1491,352 @@ class CloudFormationCustomResource(object):
         self.resource_properties = event.get('ResourceProperties', {})
         self.old_resource_properties = event.get('OldResourceProperties')
 
-        self.status = None
-        self.failure_reason = None
-        self.resource_outputs = {}
+        self.profiling = self.PROFILE or _is_true(os.environ.get(self.PROFILE_ENVIRONMENT_VARIABLE))
+        if self.PROFILE_PROPERTY in self.resource_properties:
+            self.resource_properties = dict(self.resource_properties)
+            self.profiling = self.profiling or _is_true(self.resource_properties.pop(self.PROFILE_PROPERTY))
+        if self.old_resource_properties and self.PROFILE_PROPERTY in self.old_resource_properties:
+            self.old_resource_properties = dict(self.old_resource_properties)
+            del self.old_resource_properties[self.PROFILE_PROPERTY]
+
+        continuation = event.get(self.CONTINUATION_KEY)
+        if continuation:
+            self.checkpoint = continuation.get('Checkpoint')
+            self.continuation_count = continuation['Count']
+
+        if self.STRUCTURED_LOGGING:
+            self.log_structured(logging.INFO, 'request',
+                                event=event,
+                                context=_Lazy(_plainify, context))
+
+        self.timings['start'] = _monotonic() - request_start
+
+        self._start_watchdog()
+
+    def log_structured(self, level, phase, **fields):
+        """Log a single JSON line for a phase of the request, with the request
+        and stack ids. The fields are only serialized if the record is
+        emitted; a field can be a _Lazy to defer computing it as well.
+        Strings in the fields longer than LOG_MAX_VALUE_SIZE are truncated."""
+        if not self._base_logger.isEnabledFor(level):
+            return
+        entry = collections.OrderedDict([
+            ('phase', phase),
+            ('request_id', self.request_id),
+            ('stack_id', self.stack_id),
+            ('logical_resource_id', self.logical_resource_id),
+            ('resource_type', self.resource_type),
+            ('request_type', self.request_type),
+        ])
+        max_size = self.LOG_MAX_VALUE_SIZE
+        def build(fields):
+            entry.update((k, _truncate_for_log(v, max_size)) for k, v in sorted(fields.items()))
+            return entry
+        self._base_logger.log(level, '%s', _LazyJson(fields, build))
+
+    def _start_watchdog(self):
+        """Arm a timer to send the response if the request is about to run
+        past the Lambda timeout."""
+        if self.TIMEOUT_WATCHDOG_MARGIN_MILLIS is None:
+            return
+        get_remaining_time = getattr(self.context, 'get_remaining_time_in_millis', None)
+        if not get_remaining_time:
+            return
+        delay_millis = get_remaining_time() - self.TIMEOUT_WATCHDOG_MARGIN_MILLIS
+        if delay_millis <= 0:
+            self._base_logger.debug("Not enough time remaining for the timeout watchdog")
+            return
+        self._watchdog = threading.Timer(delay_millis / 1000., self._on_timeout,
+                                         args=(threading.current_thread().ident,))
+        self._watchdog.daemon = True
+        self._watchdog.start()
+
+    def _stop_watchdog(self):
+        if self._watchdog:
+            self._watchdog.cancel()
+            self._watchdog = None
+
+    def _on_timeout(self, thread_ident):
+        """Called by the watchdog in its own thread. Sends the response with
+        TIMEOUT_STATUS, and a reason saying where the handler was stuck,
+        unless the response has already been sent."""
+        with self._finish_lock:
+            if self._finished:
+                return
+            self._finished = True
+
+        self.timed_out = True
+
+        frame = sys._current_frames().get(thread_ident)
+        location = 'an unknown location'
+        if frame:
+            # report the innermost method of this object, e.g., create(),
+            # and the innermost frame overall
+            innermost = frame
+            while frame and frame.f_locals.get('self') is not self:
+                frame = frame.f_back
+            frame = frame or innermost
+            location = '{} ({}:{})'.format(frame.f_code.co_name, frame.f_code.co_filename, frame.f_lineno)
+            if frame is not innermost:
+                location += ', in {} ({}:{})'.format(
+                        innermost.f_code.co_name, innermost.f_code.co_filename, innermost.f_lineno)
+            stack = ''.join(traceback.format_stack(innermost))
+        else:
+            stack = ''
+
+        self.status = self.TIMEOUT_STATUS
+        self.failure_reason = 'Custom resource {} was about to time out in {}.'.format(self.__class__.__name__, location)
+        self._base_logger.error(self.failure_reason)
+        self._base_logger.debug("Stack at timeout:\n{}".format(stack))
 
         try:
+            with self._timed('response'):
+                self.finish_function(self)
+        except Exception as e:
+            self._base_logger.error("Sending response on timeout failed: {}".format(e))
+            self._base_logger.debug(traceback.format_exc())
+        finally:
+            self._send_metrics()
+
+    def _clear_boto3_call_stats(self):
+        """Stop counting boto3 calls made on this thread against this request."""
+        if self.boto3_stats is not None and _get_boto3_call_stats() is self.boto3_stats:
+            _boto3_call_stats.current = None
+
+    def _send_metrics(self):
+        """Record the total time, log the boto3 calls, and pass the metrics to
+        metrics_function if EMIT_METRICS is set."""
+        if self._request_start is not None:
+            self.timings['total'] = _monotonic() - self._request_start
+        if self.boto3_stats is not None:
+            self._clear_boto3_call_stats()
+            if self.STRUCTURED_LOGGING:
+                self.log_structured(logging.INFO, 'boto3', calls=_Lazy(self.boto3_stats.to_dict))
+            else:
+                self._base_logger.info('boto3 calls: %s', _LazyJson(self.boto3_stats, Boto3CallStats.to_dict))
+        if not self.EMIT_METRICS:
+            return
+        try:
+            self.metrics_function(self)
+        except Exception as e:
+            self._base_logger.warning("Emitting metrics failed: {}".format(e))
+
+    def get_metrics(self):
+        """Return an EMF (CloudWatch Embedded Metric Format) record of the
+        request, as a dict: the time of each phase in milliseconds, and the
+        number of response attempts, with the resource type and request type
+        as dimensions, and the status and ids as properties."""
+        if self.timed_out:
+            status = 'TIMED_OUT'
+        elif self.continuation is not None and not self.status:
+            status = 'CONTINUED'
+        else:
+            status = self.status
+        record = collections.OrderedDict([
+            ('_aws', {
+                'Timestamp': int(time.time() * 1000),
+                'CloudWatchMetrics': [{
+                    'Namespace': self.METRICS_NAMESPACE,
+                    'Dimensions': [['ResourceType', 'RequestType']],
+                    'Metrics': [],
+                }],
+            }),
+            ('ResourceType', self.resource_type),
+            ('RequestType', self.request_type),
+            ('Status', status),
+            ('RequestId', self.request_id),
+            ('StackId', self.stack_id),
+            ('LogicalResourceId', self.logical_resource_id),
+            ('Continuations', self.continuation_count),
+        ])
+        metrics = record['_aws']['CloudWatchMetrics'][0]['Metrics']
+        for phase, seconds in six.iteritems(self.timings):
+            name = ''.join(part.capitalize() for part in phase.split('_')) + 'Time'
+            metrics.append({'Name': name, 'Unit': 'Milliseconds'})
+            record[name] = round(seconds * 1000, 3)
+        metrics.append({'Name': 'ResponseAttempts', 'Unit': 'Count'})
+        record['ResponseAttempts'] = self.response_attempts
+        if self.boto3_stats is not None:
+            for name, field, unit in [
+                    ('Boto3Calls', 'calls', 'Count'),
+                    ('Boto3Errors', 'errors', 'Count'),
+                    ('Boto3Retries', 'retries', 'Count'),
+                    ('Boto3Throttles', 'throttles', 'Count'),
+                    ('Boto3Time', 'total_ms', 'Milliseconds')]:
+                metrics.append({'Name': name, 'Unit': unit})
+                record[name] = self.boto3_stats.total(field)
+        return record
+
+    @classmethod
+    def emit_metrics(cls, resource):
+        """Print the EMF record from get_metrics() as a single line, which
+        CloudWatch Logs turns into metrics without any API calls."""
+        six.print_(cls.JSON_SERIALIZER.dumps(resource.get_metrics()))
+        sys.stdout.flush()
+
+    def _get_response_store_key(self):
+        return '{}:{}'.format(self.request_id, self.logical_resource_id)
+
+    def _replay_stored_response(self):
+        """If RESPONSE_STORE has a response for this request, i.e., this is a
+        duplicate delivery, send it again instead of handling the request, and
+        send the metrics. Returns True if the response was replayed."""
+        if self.RESPONSE_STORE is None:
+            return False
+        try:
+            response_content = self.RESPONSE_STORE.get(self._get_response_store_key())
+        except Exception as e:
+            self._base_logger.warning("Looking up stored response failed: {}".format(e))
+            return False
+        if response_content is None:
+            return False
+
+        self._stop_watchdog()
+        with self._finish_lock:
+            self._finished = True
+
+        self.replayed = True
+        self.status = response_content['Status']
+        self.failure_reason = response_content.get('Reason')
+        self.physical_resource_id = response_content.get('PhysicalResourceId')
+        self.resource_outputs = dict(response_content.get('Data') or {})
+        self._base_logger.info("Replaying stored response for duplicate request {}".format(self.request_id))
+        try:
+            with self._timed('response'):
+                self.send_response_function(self, self.response_url, response_content)
+        except Exception as e:
+            self.response_error = e
+            self._base_logger.error("send response failed: {}".format(e))
+            self._base_logger.debug(traceback.format_exc())
+        finally:
+            self._send_metrics()
+        return True
+
+    def _prepare_request(self):
+        """Validate the request and populate the fields needed for dispatch."""
+        with self._timed('validate'):
             if not self.validate_resource_type(self.resource_type):
                 raise Exception('invalid resource type')
 
+            if self._properties_validator:
+                try:
+                    self.properties = self._properties_validator(self.resource_properties)
+                except PropertyValidationError as e:
+                    if self.request_type != self.REQUEST_DELETE:
+                        raise
+                    # failing a delete would leave the resource stuck in the stack
+                    self._base_logger.warning("Properties do not match the schema: {}".format(e))
+                if self.old_resource_properties is not None:
+                    try:
+                        self.old_properties = self._properties_validator(self.old_resource_properties)
+                    except PropertyValidationError as e:
+                        # the schema may have changed since; the update can go ahead
+                        self._base_logger.warning("Old properties do not match the schema: {}".format(e))
+
             if not self.validate():
                 pass
 
+        with self._timed('populate'):
             if not self.physical_resource_id and not self.DISABLE_PHYSICAL_RESOURCE_ID_GENERATION:
                 self.physical_resource_id = self.generate_physical_resource_id_function(max_len=self.PHYSICAL_RESOURCE_ID_MAX_LEN)
 
             self.populate()
 
-            method_name = self.request_type.lower()
-            self._base_logger.debug("Dispatching to subclass: {}".format(method_name))
-            outputs = getattr(self, method_name)()
+    def _dispatch_request(self):
+        """Call the create(), update(), or delete() method, returning its result."""
+        method_name = self.request_type.lower()
+        if self.STRUCTURED_LOGGING:
+            self.log_structured(logging.DEBUG, 'dispatch', method=method_name)
+        else:
+            self._base_logger.debug("Dispatching to subclass: %s", method_name)
+        return getattr(self, method_name)()
 
-            if outputs:
-                if not isinstance(outputs, dict):
-                    outputs = {'Value': outputs}
-                self.resource_outputs.update(outputs)
+    def _set_outputs(self, outputs):
+        if isinstance(outputs, InProgress):
+            self.continuation = outputs
+            return
 
-            if not self.status:
-                self.status = self.STATUS_SUCCESS
-         
-        except Exception as e:
-            if not self.status:
-                self.status = self.STATUS_FAILED
-                self.failure_reason = 'Custom resource {} failed due to exception "{}".'.format(self.__class__.__name__, e)
-            if self.failure_reason:
-                self._base_logger.error(str(self.failure_reason))
-            self._base_logger.debug(traceback.format_exc())
+        if outputs:
+            if not isinstance(outputs, dict):
+                outputs = {'Value': outputs}
+            self.resource_outputs.update(outputs)
+
+        if not self.status:
+            self.status = self.STATUS_SUCCESS
+
+    def _set_exception(self, e):
+        if not self.status:
+            self.status = self.STATUS_FAILED
+            self.failure_reason = 'Custom resource {} failed due to exception "{}".'.format(self.__class__.__name__, e)
+        if self.failure_reason:
+            self._base_logger.error(str(self.failure_reason))
+        self._base_logger.debug(traceback.format_exc())
+
+    def _finish_request(self):
+        """Clean up and send the response."""
+        self._stop_watchdog()
+        with self._finish_lock:
+            if self._finished:
+                self._base_logger.warning("Response was already sent by the timeout watchdog")
+                return
+            self._finished = True
 
-        if self.request_type == self.REQUEST_DELETE:
-            if self.status == self.STATUS_SUCCESS and self.DELETE_LOGS_ON_STACK_DELETION:
-                logging.disable(logging.CRITICAL)
-                logs_client = self.get_boto3_client('logs')
-                logs_client.delete_log_group(
-                    logGroupName=context.log_group_name)
+        try:
+            if self.continuation is not None and not self.status:
+                try:
+                    with self._timed('continue'):
+                        self._continue()
+                    return
+                except Exception as e:
+                    self.status = self.STATUS_FAILED
+                    self.failure_reason = 'Custom resource {} failed to continue: {}'.format(self.__class__.__name__, e)
+                    self._base_logger.error(self.failure_reason)
+                    self._base_logger.debug(traceback.format_exc())
+
+            if self.request_type == self.REQUEST_DELETE:
+                if self.status == self.STATUS_SUCCESS and self.DELETE_LOGS_ON_STACK_DELETION:
+                    with self._timed('delete_logs'):
+                        logging.disable(logging.CRITICAL)
+                        logs_client = self.get_boto3_client('logs')
+                        logs_client.delete_log_group(
+                            logGroupName=self.context.log_group_name)
+
+            with self._timed('response'):
+                self.finish_function(self)
+        finally:
+            self._send_metrics()
+
+    def _continue(self):
+        """Invoke the function again with the request and the checkpoint."""
+        count = self.continuation_count + 1
+        if self.MAX_CONTINUATIONS is not None and count > self.MAX_CONTINUATIONS:
+            raise Exception('exceeded the maximum of {} continuations'.format(self.MAX_CONTINUATIONS))
+
+        event = dict(self.event)
+        if self.physical_resource_id:
+            # keep a generated id, since the next invocation would generate another
+            event['PhysicalResourceId'] = self.physical_resource_id
+        event[self.CONTINUATION_KEY] = {
+            'Checkpoint': self.continuation.checkpoint,
+            'Count': count,
+        }
+        self._base_logger.info("Continuing {} (continuation {})".format(self.request_type, count))
+        self.continuation_invoker_function(self, event)
 
-        self.finish_function(self)
+    @classmethod
+    def invoke_continuation(cls, resource, event):
+        """Asynchronously invoke the running Lambda function with the event."""
+        lambda_client = cls.get_boto3_client('lambda')
+        lambda_client.invoke(
+            FunctionName=resource.context.invoked_function_arn,
+            InvocationType='Event',
+            Payload=cls.JSON_SERIALIZER.dumps(event).encode('utf-8'))
 
     def generate_unique_id(self, prefix=None, separator='-', max_len=None):
         """Generate a unique id similar to how CloudFormation generates
-        physical resource ids"""
+        physical resource ids, using PHYSICAL_RESOURCE_ID_STRATEGY for the
+        suffix and PHYSICAL_RESOURCE_ID_TEMPLATE, if set, around the id.
+        The result is never longer than max_len."""
 
         if prefix is None:
             if self.generate_unique_id_prefix_function:
@@ -378,52 +1844,185 @@ class CloudFormationCustomResource(object):
             else:
                 prefix = ''
 
-        stack_id = self.stack_id.split(':')[-1]
-        if '/' in stack_id:
-            stack_id = stack_id.split('/')[1]
-        stack_id = stack_id.replace('-', '')
-
-        logical_resource_id = self.logical_resource_id
-
-        len_of_rand = 12
-
-        rand = ''.join(random.choice(string.ascii_uppercase + string.digits) for _ in range(len_of_rand))
-
-        if max_len:
-            max_len = max_len - len(prefix)
-            len_of_parts = max_len - len_of_rand - 2 * len(separator)
-            len_of_parts_diff = (len(stack_id) + len(logical_resource_id)) - len_of_parts
-            if len_of_parts_diff > 0:
-                len_of_stack_id = min(len(stack_id), len(stack_id) - len_of_parts_diff // 2)
-                len_of_resource = len_of_parts - len_of_stack_id
-                stack_id = stack_id[:len_of_stack_id]
-                logical_resource_id = logical_resource_id[:len_of_resource]
-        return '{prefix}{stack_id}{separator}{logical_id}{separator}{rand}'.format(
-            prefix=prefix,
-            separator=separator,
-            stack_id=stack_id,
-            logical_id=logical_resource_id,
-            rand=rand,
-            )
+        strategy = self.PHYSICAL_RESOURCE_ID_STRATEGY
+        if not callable(strategy):
+            strategy = PHYSICAL_RESOURCE_ID_STRATEGIES[strategy]
+        suffix = strategy(self)
+
+        head, tail = _get_id_parts(self.stack_id, self.logical_resource_id,
+                                   self.PHYSICAL_RESOURCE_ID_TEMPLATE,
+                                   prefix, separator, max_len, len(suffix))
+        return head + suffix + tail
+
+    REQUESTS_SESSION_FACTORY = None
+    REQUESTS_SESSION = None
+    REQUESTS_POOL_SIZE = 10
+
+    RESPONSE_TIMEOUT = 10
+    RESPONSE_MAX_ATTEMPTS = 8
+    RESPONSE_RETRY_BASE_DELAY = 0.25
+    RESPONSE_RETRY_MAX_DELAY = 5
+    RESPONSE_DEADLINE_MARGIN_MILLIS = 500
+
+    @classmethod
+    def get_requests_session(cls):
+        """Return a requests session, cached in the class so that warm
+        invocations reuse its pooled keep-alive connections."""
+        if cls.REQUESTS_SESSION is None:
+            if cls.REQUESTS_SESSION_FACTORY:
+                cls.REQUESTS_SESSION = cls.REQUESTS_SESSION_FACTORY()
+            else:
+                import requests
+                import requests.adapters
+                session = requests.Session()
+                adapter = requests.adapters.HTTPAdapter(
+                    pool_connections=cls.REQUESTS_POOL_SIZE,
+                    pool_maxsize=cls.REQUESTS_POOL_SIZE)
+                session.mount('https://', adapter)
+                session.mount('http://', adapter)
+                cls.REQUESTS_SESSION = session
+        return cls.REQUESTS_SESSION
+
+    @classmethod
+    def _get_response_deadline(cls, resource):
+        """Return the time by which the response must be sent, based on the
+        remaining time of the Lambda invocation, or None if unknown."""
+        get_remaining_time = getattr(resource.context, 'get_remaining_time_in_millis', None)
+        if not get_remaining_time:
+            return None
+        remaining_millis = get_remaining_time() - cls.RESPONSE_DEADLINE_MARGIN_MILLIS
+        return time.time() + max(remaining_millis, 0) / 1000.
 
     @classmethod
     def send_response(cls, resource, url, response_content):
+        """Send the response to CloudFormation.
+
+        The PUT is retried on connection errors, timeouts, throttling, and
+        server errors, with exponential backoff and full jitter, for up to
+        RESPONSE_MAX_ATTEMPTS attempts and no later than the end of the
+        Lambda invocation (less RESPONSE_DEADLINE_MARGIN_MILLIS). If it does
+        not succeed, the last error is raised."""
         if url == cls.DUMMY_RESPONSE_URL_SILENT:
             return
         elif url == cls.DUMMY_RESPONSE_URL_PRINT:
-            six.print_(json.dumps(response_content, indent=2))
-        else:
-            put_response = requests.put(url,
-                                        data=json.dumps(response_content))
-            status_code = put_response.status_code
-            response_text = put_response.text
-            
-            body_text = ""
-            if status_code // 100 != 2:
-                body_text = "\n" + response_text
-            resource._base_logger.debug("Status code: {} {}{}".format(put_response.status_code, http_client.responses[put_response.status_code], body_text))
-
-        return put_response
+            six.print_(cls.JSON_SERIALIZER.dumps(response_content, indent=2))
+            return
+
+        import requests
+
+        session = cls.get_requests_session()
+        data = cls.JSON_SERIALIZER.dumps(response_content).encode('utf-8')
+        deadline = cls._get_response_deadline(resource)
+
+        attempt = 0
+        while True:
+            attempt += 1
+            resource.response_attempts = attempt
+
+            timeout = cls.RESPONSE_TIMEOUT
+            if deadline is not None:
+                timeout = max(min(timeout, deadline - time.time()), 0.1)
+
+            try:
+                put_response = session.put(url, data=data, timeout=timeout)
+            except (requests.ConnectionError, requests.Timeout) as e:
+                error = e
+            else:
+                status_code = put_response.status_code
+
+                body_text = ""
+                if status_code // 100 != 2:
+                    body_text = "\n" + put_response.text
+                resource._base_logger.debug("Status code: {} {}{}".format(status_code, http_client.responses.get(status_code, ''), body_text))
+
+                if status_code // 100 == 2:
+                    return put_response
+                error = requests.HTTPError('{} error: {}'.format(
+                        status_code, http_client.responses.get(status_code, '')), response=put_response)
+                if status_code != 429 and status_code // 100 != 5:
+                    raise error
+
+            delay = random.uniform(0, min(cls.RESPONSE_RETRY_MAX_DELAY, cls.RESPONSE_RETRY_BASE_DELAY * 2 ** (attempt - 1)))
+            if cls.RESPONSE_MAX_ATTEMPTS and attempt >= cls.RESPONSE_MAX_ATTEMPTS:
+                raise error
+            if deadline is not None and time.time() + delay >= deadline:
+                raise error
+            resource._base_logger.warning("send response attempt {} failed, retrying in {:.2f}s: {}".format(attempt, delay, error))
+            time.sleep(delay)
+
+    MAX_RESPONSE_SIZE = 4096
+    MIN_REASON_LENGTH = 128
+    RESPONSE_BLOB_STORE = None
+
+    @classmethod
+    def _get_response_size(cls, response_content):
+        return len(cls.JSON_SERIALIZER.dumps(response_content).encode('utf-8'))
+
+    @classmethod
+    def _fit_response_size(cls, resource, response_content):
+        """Make the response fit within MAX_RESPONSE_SIZE bytes, which is the
+        limit CloudFormation enforces. First, if RESPONSE_BLOB_STORE is set,
+        outputs are offloaded to it, largest first, and replaced with the
+        references it returns; if the store fails, offloading stops. Then the
+        reason is truncated, down to MIN_REASON_LENGTH characters. If the
+        response is still too large, it is replaced with a failure saying so."""
+        size = cls._get_response_size(response_content)
+        if size <= cls.MAX_RESPONSE_SIZE:
+            return response_content
+        original_size = size
+
+        data = response_content['Data']
+        if cls.RESPONSE_BLOB_STORE is not None and data:
+            key_prefix = '{}/{}/{}'.format(resource.stack_id.split(':')[-1],
+                                           resource.logical_resource_id,
+                                           resource.request_id)
+            by_size = sorted(data, key=lambda k: len(cls.JSON_SERIALIZER.dumps(data[k])), reverse=True)
+            for output_key in by_size:
+                if size <= cls.MAX_RESPONSE_SIZE:
+                    break
+                value = data[output_key]
+                if not isinstance(value, six.string_types):
+                    value = cls.JSON_SERIALIZER.dumps(value)
+                try:
+                    reference = cls.RESPONSE_BLOB_STORE.put('{}/{}'.format(key_prefix, output_key), value)
+                except Exception as e:
+                    # a response must still be sent, so fall back to failing
+                    # for the size below
+                    resource._base_logger.error("Offloading output {} to the blob store failed: {}".format(output_key, e))
+                    resource._base_logger.debug(traceback.format_exc())
+                    break
+                data[output_key] = reference
+                resource.offloaded_outputs[output_key] = reference
+                size = cls._get_response_size(response_content)
+            if resource.offloaded_outputs:
+                resource._base_logger.info("Offloaded outputs {} to the blob store".format(
+                    ', '.join(sorted(resource.offloaded_outputs))))
+
+        reason = response_content['Reason']
+        if size > cls.MAX_RESPONSE_SIZE and len(reason) > cls.MIN_REASON_LENGTH:
+            suffix = '... (truncated)'
+            length = len(reason)
+            excess = size - cls.MAX_RESPONSE_SIZE + len(suffix)
+            # the size is in bytes, so this may take more than one pass, but
+            # the length kept shrinks each time until it reaches the minimum
+            while size > cls.MAX_RESPONSE_SIZE and length > cls.MIN_REASON_LENGTH:
+                length = max(cls.MIN_REASON_LENGTH, length - excess)
+                response_content['Reason'] = reason[:length] + suffix
+                size = cls._get_response_size(response_content)
+                excess = max(size - cls.MAX_RESPONSE_SIZE, 1)
+
+        if size > cls.MAX_RESPONSE_SIZE:
+            message = 'Custom resource {} response of {} bytes exceeds the limit of {} bytes'.format(
+                resource.__class__.__name__, original_size, cls.MAX_RESPONSE_SIZE)
+            if cls.RESPONSE_BLOB_STORE is None:
+                message += '; set RESPONSE_BLOB_STORE to offload large outputs'
+            resource._base_logger.error(message)
+            resource.status = cls.STATUS_FAILED
+            resource.failure_reason = message
+            response_content['Status'] = cls.STATUS_FAILED
+            response_content['Reason'] = message
+            response_content['Data'] = {}
+        return response_content
 
     @classmethod
     def cfn_response(cls, resource):
@@ -432,8 +2031,12 @@ class CloudFormationCustomResource(object):
             physical_resource_id = resource.context.log_stream_name
         default_reason = ("See the details in CloudWatch Log Stream: {}".format(resource.context.log_stream_name))
         outputs = {}
-        for key, value in six.iteritems(resource.resource_outputs):
+        # copy the outputs first, since on timeout the handler may still be
+        # adding to them in another thread
+        for key, value in six.iteritems(dict(resource.resource_outputs)):
             if resource.STRINGIFY_OUTPUT and not isinstance(value, six.string_types):
+                # outputs are visible in the stack, so keep their format stable
+                # regardless of the JSON backend
                 value = json.dumps(value)
             outputs[key] = value
         response_content = {
@@ -445,12 +2048,23 @@ class CloudFormationCustomResource(object):
             "LogicalResourceId": resource.event['LogicalResourceId'],
             "Data": outputs
         }
-        resource._base_logger.debug("Response body: {}".format(json.dumps(response_content)))
+        response_content = cls._fit_response_size(resource, response_content)
+        if resource.STRUCTURED_LOGGING:
+            resource.log_structured(logging.INFO, 'response', response=response_content)
+        else:
+            resource._base_logger.debug("Response body: %s", _LazyJson(response_content))
+        if resource.RESPONSE_STORE is not None:
+            try:
+                resource.RESPONSE_STORE.put(resource._get_response_store_key(), response_content)
+            except Exception as e:
+                resource._base_logger.warning("Storing response failed: {}".format(e))
         if cls.RAISE_ON_FAILURE and resource.status == cls.STATUS_FAILED:
             raise Exception(resource.failure_reason)
         try:
-            return resource.send_response_function(resource, resource.response_url, response_content)
+            with resource._timed('send'):
+                return resource.send_response_function(resource, resource.response_url, response_content)
         except Exception as e:
+            resource.response_error = e
             resource._base_logger.error("send response failed: {}".format(e))
             resource._base_logger.debug(traceback.format_exc())
 
@@ -17,14 +17,20 @@ class DecoratorHandler(CloudFormationCustomResource):
     #Disable resource type validity checking
     RESOURCE_TYPE_SPEC = None
     
+    def _call(self, field):
+        func = getattr(self.__class__, field)
+        if func is None:
+            raise NotImplementedError('no {} function registered'.format(self.request_type.lower()))
+        return func(self)
+    
     def create(self):
-        return self.__class__._create_func(self)
+        return self._call('_create_func')
 
     def update(self):
-        return self.__class__._update_func(self)
+        return self._call('_update_func')
     
     def delete(self):
-        return self.__class__._delete_func(self)
+        return self._call('_delete_func')
     
 def create(func):
     DecoratorHandler._create_func = func
@@ -7,13 +7,42 @@ file, You can obtain one at http://mozilla.org/MPL/2.0/.
 
 import argparse
 import sys, os.path
-import pkg_resources
+import pkgutil
 import six
 import json
-import shutil
+import hashlib
 import collections
+import fnmatch
+import zipfile
+import re
 
-def create_resource_and_output(name, code_uri, handler, set_function_name=False, runtime=None, policies=None, properties=None):
+SNAP_START_MIN_PYTHON = (3, 12)
+
+def check_function_options(runtime=None, provisioned_concurrency=None, snap_start=False):
+    """Raise ValueError for combinations Lambda does not accept: SnapStart
+    cannot be used with provisioned concurrency, and for Python requires an
+    explicit runtime of python3.12 or later."""
+    if not snap_start:
+        return
+    if provisioned_concurrency:
+        raise ValueError('SnapStart cannot be used with provisioned concurrency')
+    if not runtime:
+        raise ValueError('SnapStart requires a runtime to be given, e.g., python{}.{}'.format(*SNAP_START_MIN_PYTHON))
+    match = re.match(r'python(\d+)\.(\d+)$', runtime)
+    if not match or tuple(int(v) for v in match.groups()) < SNAP_START_MIN_PYTHON:
+        raise ValueError('SnapStart is not supported for runtime {}, only python{}.{} and later'.format(
+            runtime, *SNAP_START_MIN_PYTHON))
+
+def create_resource_and_output(name, code_uri, handler, set_function_name=False, runtime=None, policies=None, properties=None,
+                               alias=None, provisioned_concurrency=None, snap_start=False):
+    """Create the SAM function resource and the output exporting its ARN.
+
+    Provisioned concurrency and SnapStart both apply to published versions, so
+    if either is requested, versions are published under an alias (by default,
+    'live'), and the exported ARN is the alias ARN. They cannot be combined, and
+    SnapStart needs a supported runtime; see check_function_options()."""
+    check_function_options(runtime, provisioned_concurrency, snap_start)
+    
     if not runtime:
         runtime = 'python2.7' if six.PY2 else 'python3.6'
     
@@ -33,12 +62,33 @@ def create_resource_and_output(name, code_uri, handler, set_function_name=False,
     if set_function_name:
         resource['Properties']['FunctionName'] = name
     
+    if (provisioned_concurrency or snap_start) and not alias:
+        alias = 'live'
+    
+    if alias:
+        resource['Properties']['AutoPublishAlias'] = alias
+    
+    if provisioned_concurrency:
+        resource['Properties']['ProvisionedConcurrencyConfig'] = {
+            'ProvisionedConcurrentExecutions': provisioned_concurrency,
+        }
+    
+    if snap_start:
+        resource['Properties']['SnapStart'] = {
+            'ApplyOn': 'PublishedVersions',
+        }
+    
     if properties:
         resource['Properties'].update(properties)
     
+    if alias:
+        arn = {'Ref': '{}.Alias'.format(name)}
+    else:
+        arn = {'Fn::GetAtt': [name, 'Arn']}
+    
     output = {
         '{}Arn'.format(name): {
-            'Value': {'Fn::GetAtt': [name, 'Arn']},
+            'Value': arn,
             'Export': {
                 'Name': 'CustomResource:{}'.format(name)
             }
@@ -87,77 +137,395 @@ def _get_config(path):
     return _config(name, code_uri, handler)
          
 
-def template_main():
+def _find_code_paths(paths, recursive=False):
+    """Return the code paths to package: the given files and directories, or
+    with recursive, every directory under the given directories that contains
+    a handler file (see _get_config)."""
+    if not recursive:
+        return list(paths)
+    code_paths = []
+    for path in paths:
+        if not os.path.isdir(path):
+            code_paths.append(path)
+            continue
+        for dir_path, dir_names, file_names in os.walk(path):
+            dir_names[:] = sorted(d for d in dir_names if not d.startswith('.') and d != '__pycache__')
+            name = os.path.basename(dir_path.rstrip(os.sep))
+            if any('{}.py'.format(f) in file_names for f in [name, 'index', 'handler']):
+                code_paths.append(dir_path)
+                # a handler directory is a unit; don't look for more inside it
+                dir_names[:] = []
+    return code_paths
+
+def _hash(data):
+    return hashlib.sha256(data).hexdigest()
+
+def _hash_file(path):
+    """The sha256 of the contents of the file, or None if it doesn't exist."""
+    if not os.path.isfile(path):
+        return None
+    with open(path, 'rb') as fp:
+        return _hash(fp.read())
+
+def _write_if_changed(path, data):
+    """Write the bytes to the file unless it already has exactly these
+    contents, replacing it atomically. Returns whether it was written."""
+    if _hash_file(path) == _hash(data):
+        return False
+    temp_path = '{}.{}.tmp'.format(path, os.getpid())
+    with open(temp_path, 'wb') as fp:
+        fp.write(data)
+    getattr(os, 'replace', os.rename)(temp_path, path)
+    return True
+
+def get_library_source():
+    """The contents of cfn_custom_resource.py, which is copied into each code
+    directory so that handlers can import it."""
+    return pkgutil.get_data(__name__.rsplit('.', 1)[0], 'cfn_custom_resource.py')
+
+def _package(config, kwargs, library_source):
+    """Copy the library into the code directory if it differs, and create the
+    resource and output. Returns (resource, output, whether the library was copied)."""
+    copied = _write_if_changed(os.path.join(config.code_uri, 'cfn_custom_resource.py'), library_source)
+    kwargs = dict(kwargs, name=config.name, handler=kwargs.get('handler') or config.handler)
+    resource, output = create_resource_and_output(**kwargs)
+    return resource, output, copied
+
+def _empty_template():
+    return {
+        'Transform': 'AWS::Serverless-2016-10-31',
+        'Resources': {},
+        'Outputs': {}
+    }
+
+def _serialize_template(template):
+    return (json.dumps(template, indent=2) + '\n').encode('utf-8')
+
+def template_main(argv=None):
     parser = argparse.ArgumentParser()
-    parser.add_argument('code_uri')
+    parser.add_argument('code_uris', nargs='+', metavar='code_uri',
+                        help='Handler files or directories')
+    parser.add_argument('--recursive', '-r', action='store_true',
+                        help='Package every handler directory under the given directories')
+    parser.add_argument('--jobs', '-j', type=int, default=8,
+                        help='The number of paths to process in parallel')
     parser.add_argument('--set-function-name', action='store_true')
     parser.add_argument('--handler')
     parser.add_argument('--runtime')
     parser.add_argument('--policy', action='append', dest='policies')
     parser.add_argument('--property', action='append', type=_property_argument, dest='properties')
+    parser.add_argument('--alias', help='Publish versions under this alias')
+    parser.add_argument('--provisioned-concurrency', type=int, metavar='N',
+                        help='Keep N execution environments initialized (implies --alias live)')
+    parser.add_argument('--snap-start', action='store_true',
+                        help='Enable SnapStart on published versions (implies --alias live, requires --runtime python3.12 or later)')
     
     parser.add_argument('--output', '-o')
     parser.add_argument('--add', '-a', action='store_true')
     parser.add_argument('--quiet', '-q', action='store_true')
     
-    args = parser.parse_args()
+    args = parser.parse_args(argv)
     
     def exit(code, message=None):
         if args.quiet:
             message = None
         parser.exit(code, message)
     
-    if not os.path.exists(args.code_uri):
-        exit(1, "CodeUri is invalid")
+    def info(message):
+        if not args.quiet:
+            sys.stdout.write(message + '\n')
     
     try:
-        config = _get_config(args.code_uri)
+        check_function_options(args.runtime, args.provisioned_concurrency, args.snap_start)
+    except ValueError as e:
+        exit(2, str(e))
+    
+    for code_uri in args.code_uris:
+        if not os.path.exists(code_uri):
+            exit(1, "CodeUri {} is invalid".format(code_uri))
+    
+    configs = []
+    try:
+        for code_path in _find_code_paths(args.code_uris, args.recursive):
+            configs.append(_get_config(code_path))
     except Exception as e:
         exit(2, str(e))
+    if not configs:
+        exit(2, 'No handlers found!')
     
-    template_dir = '.'
+    names = collections.Counter(config.name for config in configs)
+    duplicates = sorted(name for name, count in names.items() if count > 1)
+    if duplicates:
+        exit(2, 'Duplicate resource names: {}'.format(', '.join(duplicates)))
     
-    if not args.add:
-        template_name = '{}-template.json'.format(config.name)
-    else:
-        template_name = 'template.json'
+    template_dir = '.'
+    template_name = 'template.json' if args.add else None
     
     if args.output:
         if os.path.isdir(args.output):
             template_dir = args.output
+        elif len(configs) > 1 and not args.add:
+            exit(1, "--output must be a directory for multiple templates")
         else:
             template_dir, template_name = os.path.split(args.output)
     
-    template_path = os.path.join(template_dir, template_name)
-    
-    if args.add and os.path.exists(template_path):
-        with open(template_path, 'r') as fp:
-            template = json.load(fp)
-    else:
-        template = {
-            'Transform': 'AWS::Serverless-2016-10-31',
-            'Resources': {},
-            'Outputs': {}
-        }
-    
     kwargs = {
-        'name': config.name,
-        'code_uri': os.path.relpath(config.code_uri, template_dir),
-        'handler': config.handler,
+        'handler': args.handler,
+        'set_function_name': args.set_function_name,
+        'runtime': args.runtime,
+        'policies': args.policies,
+        'properties': dict(args.properties) if args.properties else None,
+        'alias': args.alias,
+        'provisioned_concurrency': args.provisioned_concurrency,
+        'snap_start': args.snap_start,
     }
     
-    ccr_path = os.path.join(config.code_uri, 'cfn_custom_resource.py')
-    if True: #not os.path.exists(ccr_path):
-        with pkg_resources.resource_stream(__name__, 'cfn_custom_resource.py') as source, open(ccr_path, 'wb') as dest:
-            shutil.copyfileobj(source, dest)
+    library_source = get_library_source()
     
-    resource, output = create_resource_and_output(**kwargs)
+    from concurrent import futures
+    with futures.ThreadPoolExecutor(max_workers=max(1, args.jobs)) as executor:
+        results = list(executor.map(
+            lambda config: _package(config, dict(kwargs, code_uri=os.path.relpath(config.code_uri, template_dir)), library_source),
+            configs))
+    
+    for config, (_, _, copied) in zip(configs, results):
+        if copied:
+            info('Updated {}'.format(os.path.join(config.code_uri, 'cfn_custom_resource.py')))
+    
+    if args.add:
+        template_path = os.path.join(template_dir, template_name)
+        if os.path.exists(template_path):
+            with open(template_path, 'r') as fp:
+                template = json.load(fp)
+        else:
+            template = _empty_template()
+        for resource, output, _ in results:
+            template['Resources'].update(resource)
+            template['Outputs'].update(output)
+        templates = [(template_path, template)]
+    else:
+        templates = []
+        for config, (resource, output, _) in zip(configs, results):
+            template = _empty_template()
+            template['Resources'].update(resource)
+            template['Outputs'].update(output)
+            templates.append((os.path.join(template_dir, template_name or '{}-template.json'.format(config.name)), template))
+    
+    for template_path, template in templates:
+        if _write_if_changed(template_path, _serialize_template(template)):
+            info('Wrote template to {}'.format(template_path))
+        else:
+            info('Template {} is unchanged'.format(template_path))
+
+# provided by the Lambda Python runtimes, so they needn't be bundled
+RUNTIME_PACKAGES = ('boto3', 'botocore', 's3transfer', 'jmespath', 'dateutil', 'awslambdaric')
+
+_ZIP_DATE_TIME = (1980, 1, 1, 0, 0, 0)
+
+def _is_stdlib(path):
+    import sysconfig
+    path = os.path.realpath(path)
+    if 'site-packages' in path or 'dist-packages' in path:
+        return False
+    for key in ['stdlib', 'platstdlib']:
+        stdlib = os.path.realpath(sysconfig.get_paths()[key])
+        if path.startswith(stdlib + os.sep):
+            return True
+    return False
+
+def find_import_closure(handler_file, path=None, excludes=RUNTIME_PACKAGES):
+    """Find the files of the modules the handler file imports, directly or
+    indirectly, other than the standard library and the excluded packages
+    (and their submodules), along with the data files at the top of each
+    package. Imports that are only made inside functions are included, since
+    they are found by scanning the code, not by running it. Extension modules
+    are included as they are, so they must be built for the Lambda platform.
+
+    The modules are searched for in the code directory and then in path
+    (by default, sys.path).
+
+    Returns a dict of archive names (paths relative to the directory on the
+    search path they were found in) to file paths, and a sorted list of the
+    modules that the code in the handler's directory imports but that could
+    not be found. Unresolved imports made by other packages are not listed,
+    since libraries commonly try optional modules."""
+    import modulefinder
+    code_dir = os.path.dirname(os.path.abspath(handler_file))
+    search_path = [code_dir] + [os.path.abspath(p or '.') for p in (path if path is not None else sys.path)]
+    finder = modulefinder.ModuleFinder(path=search_path, excludes=list(excludes))
+    finder.run_script(handler_file)
+
+    code_modules = set(['__main__'])
+    files = {}
+    for name, module in finder.modules.items():
+        file_path = module.__file__
+        if not file_path or not os.path.isfile(file_path):
+            continue
+        if name != '__main__' and _is_stdlib(file_path):
+            continue
+        file_path = os.path.abspath(file_path)
+        roots = [p for p in search_path if file_path.startswith(p.rstrip(os.sep) + os.sep)]
+        if not roots:
+            continue
+        root = max(roots, key=len)
+        arcname = os.path.relpath(file_path, root).replace(os.sep, '/')
+        files[arcname] = file_path
+        if root == code_dir:
+            code_modules.add(name)
+        if name != '__main__' and os.path.basename(file_path) == '__init__.py':
+            # data files of the package (e.g., certifi's CA bundle)
+            package_dir = os.path.dirname(file_path)
+            for file_name in os.listdir(package_dir):
+                data_path = os.path.join(package_dir, file_name)
+                if os.path.isfile(data_path) and not file_name.endswith(('.py', '.pyc', '.pyo', '.so', '.pyd')):
+                    files[os.path.dirname(arcname) + '/' + file_name] = data_path
 
-    template['Resources'].update(resource)
-    template['Outputs'].update(output)
+    missing = set()
+    for name, importers in finder.badmodules.items():
+        if not code_modules.intersection(importers):
+            continue
+        top = name.split('.', 1)[0]
+        if top in excludes or top in sys.builtin_module_names:
+            continue
+        if name.rpartition('.')[0] in finder.modules:
+            # probably a name imported from the package, not a submodule
+            continue
+        module = finder.modules.get(top)
+        if module is not None and (not module.__file__ or _is_stdlib(module.__file__)):
+            continue
+        missing.add(name)
+    return files, sorted(missing)
+
+def _compile(file_path, arcname):
+    """Compile the source to bytecode that is deterministic and never checked
+    against the source (PEP 552), so it is valid whatever the file times are
+    after extraction. Returns the archive name and contents of the .pyc."""
+    import py_compile, tempfile
+    fd, temp_path = tempfile.mkstemp(suffix='.pyc')
+    os.close(fd)
+    try:
+        kwargs = {}
+        if hasattr(py_compile, 'PycInvalidationMode'):
+            kwargs['invalidation_mode'] = py_compile.PycInvalidationMode.UNCHECKED_HASH
+        py_compile.compile(file_path, cfile=temp_path, dfile=arcname, doraise=True, **kwargs)
+        with open(temp_path, 'rb') as fp:
+            data = fp.read()
+    finally:
+        os.remove(temp_path)
+    if six.PY2:
+        return arcname + 'c', data
+    import importlib.util
+    return importlib.util.cache_from_source(arcname), data
+
+def bundle(code_uri, output, excludes=RUNTIME_PACKAGES, includes=(), compile=True, path=None):
+    """Write a deployment package for the handler in code_uri (a handler file
+    or a directory, see _get_config) to the zip file output, containing the
+    import closure of the handler (see find_import_closure), the files in the
+    code directory matching the glob patterns in includes, and, if compile is
+    True, bytecode compiled by this interpreter, which must be the same Python
+    version as the Lambda runtime to be used. Modules are searched for in path
+    (by default, sys.path).
+
+    The zip is deterministic: entries are sorted and have fixed times and
+    permissions, so the same inputs give the same bytes, and unchanged code
+    doesn't cause a new deployment. Returns a report dict with the entries
+    and their sizes, and the handler's imports that could not be found
+    ('missing'), which will fail on Lambda unless provided some other way."""
+    config = _get_config(code_uri)
+    code_dir = os.path.abspath(config.code_uri)
+    handler_file = os.path.join(code_dir, config.handler.rsplit('.', 1)[0] + '.py')
+
+    files, missing = find_import_closure(handler_file, path=path, excludes=excludes)
+    for dir_path, dir_names, file_names in os.walk(code_dir):
+        dir_names[:] = [d for d in dir_names if d != '__pycache__']
+        for file_name in file_names:
+            file_path = os.path.join(dir_path, file_name)
+            arcname = os.path.relpath(file_path, code_dir).replace(os.sep, '/')
+            if any(fnmatch.fnmatch(arcname, pattern) for pattern in includes):
+                files[arcname] = file_path
+
+    entries = {}
+    for arcname, file_path in files.items():
+        with open(file_path, 'rb') as fp:
+            entries[arcname] = fp.read()
+        if compile and arcname.endswith('.py'):
+            pyc_arcname, data = _compile(file_path, arcname)
+            entries[pyc_arcname] = data
+
+    report = {'output': output, 'handler': config.handler, 'entries': [], 'missing': missing}
+    with zipfile.ZipFile(output, 'w', zipfile.ZIP_DEFLATED) as zf:
+        for arcname in sorted(entries):
+            info = zipfile.ZipInfo(arcname, date_time=_ZIP_DATE_TIME)
+            info.compress_type = zipfile.ZIP_DEFLATED
+            info.external_attr = 0o644 << 16
+            info.create_system = 3
+            zf.writestr(info, entries[arcname])
+        for info in zf.infolist():
+            report['entries'].append({
+                'name': info.filename,
+                'size': info.file_size,
+                'compressed_size': info.compress_size,
+            })
+    report['size'] = os.path.getsize(output)
+    report['uncompressed_size'] = sum(entry['size'] for entry in report['entries'])
+    return report
+
+def format_bundle_report(report, top=10):
+    """Summarize a bundle report by top-level package."""
+    by_package = collections.defaultdict(lambda: [0, 0, 0])
+    for entry in report['entries']:
+        name = entry['name']
+        if name.startswith('__pycache__/'):
+            name = name[len('__pycache__/'):]
+        package = name.split('/', 1)[0] if '/' in name else name.split('.', 1)[0]
+        totals = by_package[package]
+        totals[0] += 1
+        totals[1] += entry['size']
+        totals[2] += entry['compressed_size']
+    lines = ['Wrote {output} for {handler}: {count} files, {size:,} bytes ({uncompressed_size:,} uncompressed)'.format(
+        count=len(report['entries']), **report)]
+    for package, (count, size, compressed_size) in sorted(by_package.items(), key=lambda item: -item[1][2])[:top]:
+        lines.append('  {:<32} {:>5} files {:>12,} bytes {:>12,} compressed'.format(package, count, size, compressed_size))
+    if report.get('missing'):
+        lines.append('Unresolved imports: {}'.format(', '.join(report['missing'])))
+    return '\n'.join(lines)
+
+def bundle_main(argv=None):
+    parser = argparse.ArgumentParser(description='Package a custom resource handler and its imports as a zip file')
+    parser.add_argument('code_uri', help='Handler file or directory')
+    parser.add_argument('--output', '-o', help='The zip file to write (default: {name}.zip)')
+    parser.add_argument('--exclude', action='append', default=[],
+                        help='Also exclude this package (by default, {} are excluded)'.format(', '.join(RUNTIME_PACKAGES)))
+    parser.add_argument('--include', action='append', default=[],
+                        help='Also include files in the code directory matching this glob pattern')
+    parser.add_argument('--path', action='append', default=[],
+                        help='Search this directory for imports, before sys.path')
+    parser.add_argument('--ignore-missing', action='append', default=[], metavar='MODULE',
+                        help="Don't fail if this module, imported by the handler, can't be found")
+    parser.add_argument('--no-compile', action='store_true', help="Don't precompile bytecode")
+    parser.add_argument('--json', action='store_true', help='Print the report as JSON')
+    parser.add_argument('--quiet', '-q', action='store_true')
+    
+    args = parser.parse_args(argv)
+    
+    try:
+        config = _get_config(args.code_uri)
+    except Exception as e:
+        parser.exit(2, None if args.quiet else str(e) + '\n')
+    
+    report = bundle(args.code_uri, args.output or '{}.zip'.format(config.name),
+                    excludes=RUNTIME_PACKAGES + tuple(args.exclude),
+                    includes=args.include,
+                    compile=not args.no_compile,
+                    path=args.path + sys.path)
     
-    with open(template_path, 'w') as fp:
-        json.dump(template, fp, indent=2)
+    if args.json:
+        sys.stdout.write(json.dumps(report, indent=2) + '\n')
+    elif not args.quiet:
+        sys.stdout.write(format_bundle_report(report) + '\n')
     
-    if not args.quiet:
-        sys.stdout.write('Wrote template to {}\n'.format(template_path))
+    missing = [name for name in report['missing']
+               if not any(name == ignored or name.startswith(ignored + '.') for ignored in args.ignore_missing)]
+    if missing:
+        parser.exit(1, None if args.quiet else
+                    'Unresolved imports: {}; use --path to find them, or --ignore-missing\n'.format(', '.join(missing)))
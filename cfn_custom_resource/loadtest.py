@@ -0,0 +1,297 @@
+"""Load testing for custom resource handlers.
+
+Drives a handler with a synthetic stream of CloudFormation requests, across
+a pool of threads or processes, with ResponseURLs served by a local HTTP sink,
+and reports throughput and latency percentiles for each request type.
+
+cfn-custom-resource-loadtest my_module.handler --requests 1000 --concurrency 16 \\
+    --mix Create=2,Update=1,Delete=1 --resource-type Custom::MyCustomResource \\
+    --properties '{"Key": "Value"}'
+
+This Source Code Form is subject to the terms of the Mozilla Public
+License, v. 2.0. If a copy of the MPL was not distributed with this
+file, You can obtain one at http://mozilla.org/MPL/2.0/.
+"""
+from __future__ import absolute_import, print_function, division
+
+import argparse
+import collections
+import importlib
+import json
+import random
+import sys
+import threading
+import time
+import timeit
+
+from six.moves import BaseHTTPServer, socketserver
+
+from . import utils
+
+REQUEST_TYPES = ('Create', 'Update', 'Delete')
+
+class _SinkServer(socketserver.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+    # the default of 5 drops connections under load, and the retries would
+    # be measured as response latency
+    request_queue_size = 1024
+
+class _SinkRequestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    # keep connections alive, as S3 does, so pooled senders reuse them
+    protocol_version = 'HTTP/1.1'
+
+    def do_PUT(self):
+        received = time.time()
+        length = int(self.headers.get('Content-Length') or 0)
+        body = self.rfile.read(length)
+        self.server.sink._record(self.path, body, received)
+        self.send_response(200)
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+
+    def log_message(self, format, *args):
+        pass
+
+class ResponseSink(object):
+    """A local HTTP server standing in for the presigned S3 URLs that
+    CloudFormation provides, recording each response and when it arrived.
+    Use url_for() to get the ResponseURL for a request."""
+    def __init__(self, host='127.0.0.1', port=0):
+        self._server = _SinkServer((host, port), _SinkRequestHandler)
+        self._server.sink = self
+        self._thread = None
+        self._lock = threading.Lock()
+        self.responses = {}
+
+    @property
+    def url(self):
+        host, port = self._server.server_address[:2]
+        return 'http://{}:{}'.format(host, port)
+
+    def url_for(self, request_id):
+        return '{}/{}'.format(self.url, request_id)
+
+    def _record(self, path, body, received):
+        try:
+            content = json.loads(body.decode('utf-8'))
+        except ValueError:
+            content = None
+        with self._lock:
+            self.responses[path.lstrip('/')] = (content, received)
+
+    def start(self):
+        self._thread = threading.Thread(target=self._server.serve_forever)
+        self._thread.daemon = True
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.stop()
+
+def parse_mix(value):
+    """Parse a request type mix like 'Create=2,Update=1,Delete=1' into a dict
+    of weights."""
+    mix = {}
+    for part in value.split(','):
+        request_type, _, weight = part.partition('=')
+        request_type = request_type.strip().capitalize()
+        if request_type not in REQUEST_TYPES:
+            raise ValueError('unknown request type {}'.format(request_type))
+        mix[request_type] = float(weight) if weight else 1.
+    return mix
+
+def generate_events(count, resource_type, properties, response_url_function,
+                    mix=None, stacks=1, seed=None):
+    """Generate a list of requests with request types drawn from mix (a dict of
+    weights, by default equal), spread over the given number of stacks.
+
+    response_url_function takes the request id and returns the ResponseURL."""
+    mix = mix or dict((request_type, 1.) for request_type in REQUEST_TYPES)
+    request_types = sorted(mix)
+    weights = [mix[request_type] for request_type in request_types]
+    rand = random.Random(seed)
+
+    events = []
+    for i in range(count):
+        request_type = _choose_weighted(rand, request_types, weights)
+        request_id = 'loadtest-{:08d}'.format(i)
+        stack_id = 'arn:aws:cloudformation:us-east-1:123456789012:stack/loadtest-{}/{:08d}-0000-0000-0000-000000000000'.format(
+            i % stacks, i % stacks)
+        events.append(utils.generate_request(request_type, resource_type, dict(properties),
+                                             response_url_function(request_id),
+                                             stack_id=stack_id,
+                                             request_id=request_id,
+                                             logical_resource_id='Resource{}'.format(i),
+                                             old_properties=dict(properties)))
+    return events
+
+def _choose_weighted(rand, choices, weights):
+    value = rand.uniform(0, sum(weights))
+    for choice, weight in zip(choices, weights):
+        value -= weight
+        if value <= 0:
+            return choice
+    return choices[-1]
+
+def load_handler(spec):
+    """Import a handler given like the Lambda handler setting, 'module.function'."""
+    module_name, _, name = spec.rpartition('.')
+    if not module_name:
+        raise ValueError('handler must be given as module.function')
+    return getattr(importlib.import_module(module_name), name)
+
+_HANDLERS = {}
+
+def _invoke(handler_spec, event, timeout):
+    """Invoke the handler on the event, returning the request type, the start
+    time, the duration, and the error, if any. The handler is loaded once per
+    thread or process."""
+    handler = _HANDLERS.get(handler_spec)
+    if handler is None:
+        handler = _HANDLERS.setdefault(handler_spec, load_handler(handler_spec))
+    context = utils.MockLambdaContext(timeout=timeout)
+    error = None
+    started = time.time()
+    start = timeit.default_timer()
+    try:
+        handler(event, context)
+    except Exception as e:
+        error = '{}: {}'.format(type(e).__name__, e)
+    duration = timeit.default_timer() - start
+    return event['RequestId'], event['RequestType'], started, duration, error
+
+def percentile(values, p):
+    """The nearest-rank percentile of the values, which must be sorted."""
+    if not values:
+        return None
+    rank = max(0, min(len(values) - 1, int(round(p / 100. * len(values))) - 1))
+    return values[rank]
+
+def _summarize(durations):
+    durations = sorted(durations)
+    summary = {'count': len(durations)}
+    if durations:
+        for p in (50, 90, 99):
+            summary['p{}_ms'.format(p)] = percentile(durations, p) * 1000
+        summary['max_ms'] = durations[-1] * 1000
+        summary['mean_ms'] = sum(durations) / len(durations) * 1000
+    return summary
+
+def run(handler_spec, events, sink, concurrency=8, processes=False, timeout=300, response_wait=10):
+    """Run the events against the handler and return a report dict.
+
+    For each request type, the report gives the latency of the handler
+    ('handler') and from the start of the handler until the response arrived at
+    the sink ('response'), the number of handler errors, and the number of
+    responses with each status."""
+    from concurrent import futures
+    executor_class = futures.ProcessPoolExecutor if processes else futures.ThreadPoolExecutor
+
+    start = timeit.default_timer()
+    with executor_class(max_workers=concurrency) as executor:
+        results = list(executor.map(_invoke, [handler_spec] * len(events), events, [timeout] * len(events)))
+    elapsed = timeit.default_timer() - start
+
+    deadline = time.time() + response_wait
+    while len(sink.responses) < len(events) and time.time() < deadline:
+        time.sleep(0.01)
+
+    handler_durations = collections.defaultdict(list)
+    response_durations = collections.defaultdict(list)
+    errors = collections.defaultdict(list)
+    statuses = collections.defaultdict(collections.Counter)
+    for request_id, request_type, started, duration, error in results:
+        handler_durations[request_type].append(duration)
+        if error:
+            errors[request_type].append(error)
+        content, received = sink.responses.get(request_id, (None, None))
+        if received is None:
+            statuses[request_type]['MISSING'] += 1
+            continue
+        statuses[request_type][(content or {}).get('Status', 'INVALID')] += 1
+        response_durations[request_type].append(max(0, received - started))
+
+    phases = {}
+    for request_type in sorted(handler_durations):
+        phases[request_type] = {
+            'handler': _summarize(handler_durations[request_type]),
+            'response': _summarize(response_durations[request_type]),
+            'errors': len(errors[request_type]),
+            'statuses': dict(statuses[request_type]),
+        }
+    all_errors = [error for request_type in sorted(errors) for error in errors[request_type]]
+    return {
+        'requests': len(events),
+        'concurrency': concurrency,
+        'pool': 'process' if processes else 'thread',
+        'elapsed_s': elapsed,
+        'throughput_rps': len(events) / elapsed if elapsed else None,
+        'phases': phases,
+        'sample_errors': all_errors[:5],
+    }
+
+def format_report(report):
+    lines = ['{requests} requests, {pool} pool of {concurrency}, {elapsed_s:.2f}s, {throughput_rps:.1f} requests/s'.format(**report)]
+    header = '{:<8} {:<9} {:>6} {:>9} {:>9} {:>9} {:>9}'.format('type', 'phase', 'count', 'p50 ms', 'p90 ms', 'p99 ms', 'max ms')
+    lines.append(header)
+    for request_type, phase_report in sorted(report['phases'].items()):
+        for phase in ('handler', 'response'):
+            summary = phase_report[phase]
+            if not summary['count']:
+                continue
+            lines.append('{:<8} {:<9} {:>6} {:>9.2f} {:>9.2f} {:>9.2f} {:>9.2f}'.format(
+                request_type, phase, summary['count'],
+                summary['p50_ms'], summary['p90_ms'], summary['p99_ms'], summary['max_ms']))
+        lines.append('{:<8} statuses: {} errors: {}'.format(
+            request_type,
+            ', '.join('{}={}'.format(k, v) for k, v in sorted(phase_report['statuses'].items())),
+            phase_report['errors']))
+    for error in report['sample_errors']:
+        lines.append('error: {}'.format(error))
+    return '\n'.join(lines)
+
+def main(args=None):
+    parser = argparse.ArgumentParser(description='Drive a custom resource handler with synthetic CloudFormation requests')
+    parser.add_argument('handler', help='The handler, as module.function')
+    parser.add_argument('--path', action='append', default=[], help='Add a directory to sys.path')
+    parser.add_argument('--requests', '-n', type=int, default=100)
+    parser.add_argument('--concurrency', '-c', type=int, default=8)
+    parser.add_argument('--processes', action='store_true', help='Use a process pool rather than threads')
+    parser.add_argument('--mix', type=parse_mix, help='Request type weights, e.g. Create=2,Update=1,Delete=1')
+    parser.add_argument('--resource-type', default='Custom::LoadTest')
+    parser.add_argument('--properties', type=json.loads, default={}, help='Resource properties as JSON')
+    parser.add_argument('--stacks', type=int, default=1, help='Spread requests over this many stacks')
+    parser.add_argument('--seed', type=int)
+    parser.add_argument('--timeout', type=int, default=300, help='The Lambda timeout for the mock context')
+    parser.add_argument('--json', action='store_true', help='Print the report as JSON')
+
+    args = parser.parse_args(args)
+
+    sys.path[:0] = args.path
+    try:
+        load_handler(args.handler)
+    except Exception as e:
+        parser.exit(1, 'Could not load handler {}: {}\n'.format(args.handler, e))
+
+    with ResponseSink() as sink:
+        events = generate_events(args.requests, args.resource_type, args.properties, sink.url_for,
+                                 mix=args.mix, stacks=args.stacks, seed=args.seed)
+        report = run(args.handler, events, sink,
+                     concurrency=args.concurrency,
+                     processes=args.processes,
+                     timeout=args.timeout)
+
+    if args.json:
+        print(json.dumps(report, indent=2, sort_keys=True))
+    else:
+        print(format_report(report))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,167 @@
+"""Router for serving many custom resource types from one Lambda function.
+
+router = ResourceRouter()
+
+@router.register
+class MyCustomResource(CloudFormationCustomResource):
+    # ...
+
+router.register(MyOtherCustomResource, some_arg)
+
+@router.create('Custom::MyFunctionResource')
+def create(resource):
+    # ...
+
+@router.delete('Custom::MyFunctionResource')
+def delete(resource):
+    # ...
+
+handler = router.get_handler()
+
+This Source Code Form is subject to the terms of the Mozilla Public
+License, v. 2.0. If a copy of the MPL was not distributed with this
+file, You can obtain one at http://mozilla.org/MPL/2.0/.
+"""
+from __future__ import absolute_import, print_function
+
+from .cfn_custom_resource import (CloudFormationCustomResource,
+                                  _unwrap_record, _handle_records, _get_batch_item_failures)
+from .decorator import DecoratorHandler
+
+class UnroutedResource(CloudFormationCustomResource):
+    """Handles requests for resource types that have no route, so that
+    CloudFormation gets a FAILED response rather than waiting for one."""
+    RESOURCE_TYPE_SPEC = None
+
+    def _fail(self):
+        raise Exception('no handler registered for resource type {}'.format(self.resource_type))
+
+    def create(self):
+        self._fail()
+
+    def update(self):
+        self._fail()
+
+    def delete(self):
+        self._fail()
+
+class ResourceRouter(object):
+    """Dispatches each request to the resource class registered for its
+    ResourceType, through a dict built at registration time.
+
+    Classes are registered for every type in their RESOURCE_TYPE_SPEC, and
+    their on_init() is called at registration. Sets of functions can also be
+    registered for a type with the create(), update(), and delete()
+    decorators, which work like those in cfn_custom_resource.decorator.
+
+    A new instance is created for each request, except for classes with
+    REUSE_INSTANCE, whose single instance is used for requests that are not
+    part of a batch. Requests for types with no route are handled by
+    unrouted_class, which fails them.
+    """
+    BATCH_MAX_WORKERS = CloudFormationCustomResource.BATCH_MAX_WORKERS
+
+    def __init__(self, unrouted_class=UnroutedResource):
+        self.unrouted_class = unrouted_class
+        self._routes = {}
+        self._instances = {}
+        self._function_classes = {}
+
+    def register(self, resource_class, *args, **kwargs):
+        """Route requests for the resource types of the class to it, creating
+        instances with the given arguments. Returns the class, so this can
+        be used as a class decorator."""
+        resource_types = resource_class._get_class_metadata().resource_types
+        if not resource_types:
+            raise ValueError('{} accepts any resource type and cannot be routed'.format(resource_class.__name__))
+        for resource_type in resource_types:
+            if resource_type in self._routes:
+                raise ValueError('resource type {} is already registered to {}'.format(
+                    resource_type, self._routes[resource_type][0].__name__))
+
+        resource_class._init_class()
+        for resource_type in resource_types:
+            self._routes[resource_type] = (resource_class, args, kwargs)
+        return resource_class
+
+    def _get_function_class(self, resource_type):
+        resource_type = CloudFormationCustomResource._process_resource_type_spec(resource_type)
+        if resource_type not in self._function_classes:
+            name = resource_type.split('::')[-1]
+            function_class = type(name, (DecoratorHandler,), {
+                'RESOURCE_TYPE_SPEC': resource_type,
+                '_create_func': None,
+                '_update_func': None,
+                '_delete_func': None,
+            })
+            self.register(function_class)
+            self._function_classes[resource_type] = function_class
+        return self._function_classes[resource_type]
+
+    def _function_decorator(self, resource_type, field):
+        function_class = self._get_function_class(resource_type)
+        def decorator(func):
+            setattr(function_class, field, func)
+            return func
+        return decorator
+
+    def create(self, resource_type):
+        """Decorator registering the create function for the resource type."""
+        return self._function_decorator(resource_type, '_create_func')
+
+    def update(self, resource_type):
+        """Decorator registering the update function for the resource type."""
+        return self._function_decorator(resource_type, '_update_func')
+
+    def delete(self, resource_type):
+        """Decorator registering the delete function for the resource type."""
+        return self._function_decorator(resource_type, '_delete_func')
+
+    @property
+    def resource_types(self):
+        return sorted(self._routes)
+
+    def get_resource(self, event, reuse=True):
+        """Return the resource object to handle the request in the event."""
+        route = self._routes.get(event.get('ResourceType'))
+        if route is None:
+            return self.unrouted_class()
+        resource_class, args, kwargs = route
+        if reuse and resource_class.REUSE_INSTANCE:
+            if resource_class not in self._instances:
+                self._instances[resource_class] = resource_class(*args, **kwargs)
+            return self._instances[resource_class]
+        return resource_class(*args, **kwargs)
+
+    def handle(self, event, context):
+        """Handle a single request, directly or in a single SNS record."""
+        if 'Records' in event:
+            if len(event['Records']) != 1:
+                raise ValueError('Event contains {} records, use handle_batch()'.format(len(event['Records'])))
+            event = _unwrap_record(event['Records'][0])
+        return self.get_resource(event).handle(event, context)
+
+    def handle_batch(self, records, context):
+        """Handle a list of SNS or SQS records concurrently, like
+        CloudFormationCustomResource.handle_batch(), routing each one."""
+        return _handle_records(records, context,
+                               lambda event: self.get_resource(event, reuse=False),
+                               self.BATCH_MAX_WORKERS)
+
+    def get_handler(self):
+        """Returns a handler for direct or SNS invocations, like
+        CloudFormationCustomResource.get_handler()."""
+        def handler(event, context):
+            if 'Records' in event and len(event['Records']) > 1:
+                return self.handle_batch(event['Records'], context)
+            return self.handle(event, context)
+        return handler
+
+    def get_sqs_handler(self):
+        """Returns a handler for SQS event sources, like
+        CloudFormationCustomResource.get_sqs_handler()."""
+        def handler(event, context):
+            if 'Records' not in event:
+                return self.handle(event, context)
+            return _get_batch_item_failures(self.handle_batch(event['Records'], context))
+        return handler
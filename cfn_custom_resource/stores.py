@@ -0,0 +1,154 @@
+"""Stores for use as CloudFormationCustomResource.RESPONSE_STORE and
+CloudFormationCustomResource.RESPONSE_BLOB_STORE.
+
+A response store records the response sent for each request, so that a
+duplicate delivery of the request can be answered with the same response
+without handling it again. A response store has two methods:
+* get(key) returns the response content dict stored for the key, or None
+* put(key, response_content) stores the response content dict
+
+A blob store holds outputs too large to fit in the response. It has one
+method, put(key, value), which stores the string value and returns a string
+referencing it, which becomes the output value.
+
+This Source Code Form is subject to the terms of the Mozilla Public
+License, v. 2.0. If a copy of the MPL was not distributed with this
+file, You can obtain one at http://mozilla.org/MPL/2.0/.
+"""
+from __future__ import absolute_import
+
+import collections
+import io
+import os
+import sqlite3
+import threading
+import time
+
+import six
+
+from .cfn_custom_resource import json_serializer
+
+class MemoryResponseStore(object):
+    """Keeps responses in memory, i.e., for the life of the Lambda container.
+    If max_size is set, the oldest responses are dropped beyond that."""
+    def __init__(self, max_size=1000):
+        self.max_size = max_size
+        self._responses = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            return self._responses.get(key)
+
+    def put(self, key, response_content):
+        with self._lock:
+            self._responses[key] = response_content
+            if self.max_size:
+                while len(self._responses) > self.max_size:
+                    self._responses.popitem(last=False)
+
+class SQLiteResponseStore(object):
+    """Keeps responses in a SQLite database file, mostly useful for local
+    testing, where it persists across runs."""
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+        self._connection = sqlite3.connect(path, check_same_thread=False)
+        with self._lock, self._connection:
+            self._connection.execute(
+                'CREATE TABLE IF NOT EXISTS responses (key TEXT PRIMARY KEY, response TEXT, created REAL)')
+
+    def get(self, key):
+        with self._lock:
+            row = self._connection.execute('SELECT response FROM responses WHERE key = ?', (key,)).fetchone()
+        if row is None:
+            return None
+        return json_serializer.loads(row[0])
+
+    def put(self, key, response_content):
+        with self._lock, self._connection:
+            self._connection.execute('INSERT OR REPLACE INTO responses VALUES (?, ?, ?)',
+                                     (key, json_serializer.dumps(response_content), time.time()))
+
+    def close(self):
+        self._connection.close()
+
+class DynamoDBResponseStore(object):
+    """Keeps responses in a DynamoDB table, whose partition key is a string
+    attribute (by default, named Key). If ttl is set, items get an ExpiresAt
+    attribute that many seconds in the future, for use as the table's TTL
+    attribute. If client is not given, the cached client from
+    CloudFormationCustomResource.get_boto3_client() is used."""
+    def __init__(self, table_name, key_attribute='Key', ttl=None, client=None):
+        self.table_name = table_name
+        self.key_attribute = key_attribute
+        self.ttl = ttl
+        self._client = client
+
+    @property
+    def client(self):
+        if self._client is None:
+            from .cfn_custom_resource import CloudFormationCustomResource
+            self._client = CloudFormationCustomResource.get_boto3_client('dynamodb')
+        return self._client
+
+    def get(self, key):
+        response = self.client.get_item(
+            TableName=self.table_name,
+            Key={self.key_attribute: {'S': key}},
+            ConsistentRead=True)
+        item = response.get('Item')
+        if item is None:
+            return None
+        return json_serializer.loads(item['Response']['S'])
+
+    def put(self, key, response_content):
+        item = {
+            self.key_attribute: {'S': key},
+            'Response': {'S': json_serializer.dumps(response_content)},
+        }
+        if self.ttl:
+            item['ExpiresAt'] = {'N': str(int(time.time() + self.ttl))}
+        self.client.put_item(TableName=self.table_name, Item=item)
+
+def _to_bytes(value):
+    """Encode a text value as UTF-8. On Python 2, str values are already
+    bytes, and are taken to be UTF-8."""
+    if isinstance(value, six.binary_type):
+        return value
+    return value.encode('utf-8')
+
+class S3BlobStore(object):
+    """Stores blobs as objects in an S3 bucket, under the given prefix, and
+    returns s3://bucket/key URIs. If client is not given, the cached client
+    from CloudFormationCustomResource.get_boto3_client() is used."""
+    def __init__(self, bucket, prefix='', client=None):
+        self.bucket = bucket
+        self.prefix = prefix
+        self._client = client
+
+    @property
+    def client(self):
+        if self._client is None:
+            from .cfn_custom_resource import CloudFormationCustomResource
+            self._client = CloudFormationCustomResource.get_boto3_client('s3')
+        return self._client
+
+    def put(self, key, value):
+        key = self.prefix + key
+        self.client.put_object(Bucket=self.bucket, Key=key, Body=_to_bytes(value))
+        return 's3://{}/{}'.format(self.bucket, key)
+
+class LocalDirectoryBlobStore(object):
+    """Stores blobs as files in a local directory, for testing, and returns
+    file:// URIs."""
+    def __init__(self, path):
+        self.path = path
+
+    def put(self, key, value):
+        path = os.path.abspath(os.path.join(self.path, *key.split('/')))
+        if not os.path.isdir(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        with io.open(path, 'wb') as fp:
+            fp.write(_to_bytes(value))
+        return 'file://' + path
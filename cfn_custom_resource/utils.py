@@ -5,11 +5,11 @@ License, v. 2.0. If a copy of the MPL was not distributed with this
 file, You can obtain one at http://mozilla.org/MPL/2.0/.
 """
 
+import collections
+import json
 import time
 import uuid
 
-import boto3
-
 EXAMPLE_REQUEST = {
    "RequestType" : "Create",
    "ResponseURL" : "https://pre-signed-S3-url-for-response",
@@ -55,6 +55,7 @@ def generate_request(request_type, resource_type, properties, response_url,
         bucket, key = response_url
         if key.endswith('RANDOM'):
             key = key[:-6] + str(uuid.uuid4())
+        import boto3
         response_url = boto3.client('s3').generate_presigned_url(
                 ClientMethod='put_object',
                 HttpMethod='PUT',
@@ -116,6 +117,34 @@ def generate_sns_event(message, topic_arn=None, subscription_arn=None):
         }
     }]}
 
+def generate_sqs_event(messages, queue_arn=None):
+    """Generate an SQS event for testing.
+
+    Args:
+        messages: A list of message bodies, as strings.
+    """
+    queue_arn = queue_arn or "arn:aws:sqs:us-east-1:123456789012:example-queue"
+
+    records = []
+    for message in messages:
+        records.append({
+            "messageId": str(uuid.uuid4()),
+            "receiptHandle": "EXAMPLE",
+            "body": message,
+            "attributes": {
+                "ApproximateReceiveCount": "1",
+                "SentTimestamp": "0",
+                "SenderId": "123456789012",
+                "ApproximateFirstReceiveTimestamp": "0"
+            },
+            "messageAttributes": {},
+            "md5OfBody": "EXAMPLE",
+            "eventSource": "aws:sqs",
+            "eventSourceARN": queue_arn,
+            "awsRegion": queue_arn.split(':')[3]
+        })
+    return {"Records": records}
+
 class ResponseCapturer(object):
     def __init__(self):
         self.resource = None
@@ -130,6 +159,18 @@ class ResponseCapturer(object):
     def set(self, resource):
         resource.send_response_function = self.capture_response
 
+class ContinuationCapturer(object):
+    """Captures the events for continuations, rather than invoking Lambda, so
+    that they can be run locally."""
+    def __init__(self):
+        self.events = []
+
+    def invoke(self, resource, event):
+        self.events.append(event)
+
+    def set(self, resource):
+        resource.continuation_invoker_function = self.invoke
+
 class MockLambdaContext(object):
     def __init__(self,
             function_name='FunctionName',
@@ -166,5 +207,50 @@ class MockLambdaContext(object):
 
     def get_remaining_time_in_millis(self):
         time_used = self._get_time() - self._start
-        time_left = self._timeout * 1000 - time_used
+        time_left = self._timeout - time_used
         return int(round(time_left * 1000))
+
+def parse_metrics(lines):
+    """Read the EMF records emitted by CloudFormationCustomResource (see
+    EMIT_METRICS) from log lines, e.g., a file of exported CloudWatch Logs
+    events. Anything before the JSON on a line (like a timestamp) is skipped,
+    as are lines that aren't EMF records. Yields each record as a dict."""
+    for line in lines:
+        start = line.find('{')
+        if start == -1 or '"_aws"' not in line:
+            continue
+        try:
+            record = json.loads(line[start:])
+        except ValueError:
+            continue
+        if isinstance(record, dict) and 'CloudWatchMetrics' in record.get('_aws', {}):
+            yield record
+
+def summarize_metrics(records, group_by=('ResourceType', 'RequestType')):
+    """Summarize EMF records, grouped by the given fields, giving the count,
+    mean, p50, p90, p99, and max of each metric."""
+    values = collections.defaultdict(lambda: collections.defaultdict(list))
+    for record in records:
+        group = tuple(record.get(field) for field in group_by)
+        for directive in record['_aws']['CloudWatchMetrics']:
+            for metric in directive['Metrics']:
+                if metric['Name'] in record:
+                    values[group][metric['Name']].append(record[metric['Name']])
+
+    def percentile(sorted_values, p):
+        return sorted_values[max(0, min(len(sorted_values) - 1, int(round(p / 100. * len(sorted_values))) - 1))]
+
+    summary = {}
+    for group, metrics in values.items():
+        group_summary = summary[group] = {}
+        for name, metric_values in metrics.items():
+            metric_values = sorted(metric_values)
+            group_summary[name] = {
+                'count': len(metric_values),
+                'mean': sum(metric_values) / float(len(metric_values)),
+                'p50': percentile(metric_values, 50),
+                'p90': percentile(metric_values, 90),
+                'p99': percentile(metric_values, 99),
+                'max': metric_values[-1],
+            }
+    return summary
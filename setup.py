@@ -22,6 +22,8 @@ setup(
     entry_points={
         'console_scripts': [
             'cfn-custom-resource-template = cfn_custom_resource.deployment:template_main',
+            'cfn-custom-resource-loadtest = cfn_custom_resource.loadtest:main',
+            'cfn-custom-resource-bundle = cfn_custom_resource.deployment:bundle_main',
         ],
     },
     packages=["cfn_custom_resource"],
@@ -30,7 +32,9 @@ setup(
     },
     install_requires=['boto3',
                       'botocore',
-                      'requests'],
+                      'requests',
+                      'six',
+                      'futures; python_version < "3"'],
     project_urls={
         "Source Code": "https://github.com/iRobotCorporation/cfn-custom-resource",
     },
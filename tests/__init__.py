@@ -1,10 +1,14 @@
 from __future__ import print_function
 
 import json
+import os
+import subprocess
+import sys
+import time
 import unittest
 import six
 
-from cfn_custom_resource import CloudFormationCustomResource, utils as ccr_utils, decorator
+from cfn_custom_resource import CloudFormationCustomResource, InProgress, JsonSerializer, Boto3Cache, Property, PropertyValidationError, utils as ccr_utils, decorator, deployment
 
 CloudFormationCustomResource.RAISE_ON_FAILURE = True
 
@@ -253,6 +257,1308 @@ class TestPhysicalResourceId(unittest.TestCase):
         
         self.assertEqual(obj.physical_resource_id, id_to_set)
 
+class TestReuseInstance(unittest.TestCase):
+    class CustomResourceReuseTest(CustomResourceTestBase):
+        REUSE_INSTANCE = True
+
+        instances = []
+
+        def __init__(self):
+            super(TestReuseInstance.CustomResourceReuseTest, self).__init__()
+            self.instances.append(self)
+
+        def create(self):
+            self.resource_outputs['Created'] = self.logical_resource_id
+
+        def update(self):
+            return {'Updated': self.logical_resource_id}
+
+        def delete(self):
+            pass
+
+    def test_reuse_instance(self):
+        handler = self.CustomResourceReuseTest.get_handler()
+        self.assertEqual(len(self.CustomResourceReuseTest.instances), 1)
+        instance = self.CustomResourceReuseTest.instances[0]
+
+        event = ccr_utils.generate_request('create', 'Custom::CustomResourceReuseTest', {}, CloudFormationCustomResource.DUMMY_RESPONSE_URL_SILENT,
+                                           logical_resource_id='First')
+        handler(event, ccr_utils.MockLambdaContext())
+        self.assertEqual(instance.resource_outputs, {'Created': 'First'})
+        first_id = instance.physical_resource_id
+
+        event = ccr_utils.generate_request('update', 'Custom::CustomResourceReuseTest', {}, CloudFormationCustomResource.DUMMY_RESPONSE_URL_SILENT,
+                                           logical_resource_id='Second', old_properties={})
+        handler(event, ccr_utils.MockLambdaContext())
+
+        self.assertEqual(len(self.CustomResourceReuseTest.instances), 1)
+        self.assertEqual(instance.resource_outputs, {'Updated': 'Second'})
+        self.assertNotEqual(instance.physical_resource_id, first_id)
+        self.assertEqual(instance.physical_resource_id, 'Second')
+
+    def test_class_metadata(self):
+        class CustomResourceTypeList(CustomResourceTestBase):
+            RESOURCE_TYPE_SPEC = ['Foo', 'Custom::Bar']
+
+        metadata = CustomResourceTypeList._get_class_metadata()
+        self.assertIs(CustomResourceTypeList._get_class_metadata(), metadata)
+        self.assertEqual(metadata.resource_types, frozenset(['Custom::Foo', 'Custom::Bar']))
+        self.assertIsNot(CustomResourceTestBase._get_class_metadata(), metadata)
+
+        obj = CustomResourceTypeList()
+        self.assertEqual(obj.resource_type_spec, ['Custom::Foo', 'Custom::Bar'])
+        self.assertTrue(obj.validate_resource_type('Custom::Bar'))
+        self.assertFalse(obj.validate_resource_type('Custom::CustomResourceTypeList'))
+
+class TestSendResponse(unittest.TestCase):
+    class FakeResponse(object):
+        def __init__(self, status_code):
+            self.status_code = status_code
+            self.text = ''
+
+        def raise_for_status(self):
+            import requests
+            if self.status_code >= 400:
+                raise requests.HTTPError('{} error'.format(self.status_code), response=self)
+
+    class FakeSession(object):
+        def __init__(self, results):
+            self.results = list(results)
+            self.calls = []
+
+        def put(self, url, data=None, timeout=None):
+            self.calls.append((url, data, timeout))
+            result = self.results.pop(0)
+            if isinstance(result, Exception):
+                raise result
+            return TestSendResponse.FakeResponse(result)
+
+    class CustomResourceSendTest(CustomResourceTestBase):
+        RESPONSE_RETRY_BASE_DELAY = 0
+        RESPONSE_MAX_ATTEMPTS = 3
+
+        def __init__(self):
+            super(TestSendResponse.CustomResourceSendTest, self).__init__()
+            self.send_response_function = self.send_response
+
+        def create(self):
+            pass
+
+    def _handle(self, results):
+        import requests
+        session = self.FakeSession([requests.ConnectionError('reset') if r is None else r for r in results])
+        self.CustomResourceSendTest.REQUESTS_SESSION = session
+        try:
+            event = ccr_utils.generate_request('create', 'Custom::CustomResourceSendTest', {}, 'https://example.com/response')
+            obj = self.CustomResourceSendTest()
+            obj.handle(event, ccr_utils.MockLambdaContext())
+        finally:
+            self.CustomResourceSendTest.REQUESTS_SESSION = None
+        return obj, session
+
+    def test_success(self):
+        obj, session = self._handle([200])
+        self.assertEqual(obj.response_attempts, 1)
+        url, data, timeout = session.calls[0]
+        self.assertEqual(url, 'https://example.com/response')
+        self.assertEqual(json.loads(data)['Status'], CloudFormationCustomResource.STATUS_SUCCESS)
+        self.assertLessEqual(timeout, self.CustomResourceSendTest.RESPONSE_TIMEOUT)
+
+    def test_retry_transient_failures(self):
+        obj, session = self._handle([None, 503, 200])
+        self.assertEqual(obj.response_attempts, 3)
+        self.assertEqual(len(session.calls), 3)
+
+    def test_no_retry_client_error(self):
+        obj, session = self._handle([403, 200])
+        self.assertEqual(obj.response_attempts, 1)
+        self.assertEqual(len(session.calls), 1)
+
+    def test_no_retry_redirect(self):
+        import requests
+        obj, session = self._handle([None, 304, 200])
+        self.assertEqual(obj.response_attempts, 2)
+        self.assertIsInstance(obj.response_error, requests.HTTPError)
+        self.assertEqual(obj.response_error.response.status_code, 304)
+
+    def test_max_attempts(self):
+        obj, session = self._handle([500, 500, 500, 200])
+        self.assertEqual(obj.response_attempts, 3)
+        self.assertEqual(len(session.calls), 3)
+
+    def test_deadline(self):
+        class CustomResourceDeadlineTest(self.CustomResourceSendTest):
+            RESPONSE_RETRY_BASE_DELAY = 10
+            RESPONSE_MAX_ATTEMPTS = None
+
+        obj = CustomResourceDeadlineTest()
+        obj.context = ccr_utils.MockLambdaContext(timeout=1)
+        CustomResourceDeadlineTest.REQUESTS_SESSION = self.FakeSession([500] * 100)
+        try:
+            import requests
+            with self.assertRaises(requests.HTTPError):
+                obj.send_response(obj, 'https://example.com/response', {})
+        finally:
+            CustomResourceDeadlineTest.REQUESTS_SESSION = None
+        self.assertLess(obj.response_attempts, 100)
+
+class TestBatch(unittest.TestCase):
+    class CustomResourceBatchTest(CustomResourceTestBase):
+        RAISE_ON_FAILURE = False
+
+        def create(self):
+            if self.resource_properties.get('Fail'):
+                raise ValueError('failed on purpose')
+            return {'Name': self.logical_resource_id}
+
+    def _sns_record(self, logical_resource_id, properties):
+        cfn_event = ccr_utils.generate_request('create', 'Custom::CustomResourceBatchTest', properties,
+                                               CloudFormationCustomResource.DUMMY_RESPONSE_URL_SILENT,
+                                               logical_resource_id=logical_resource_id)
+        record = ccr_utils.generate_sns_event(json.dumps(cfn_event))['Records'][0]
+        record['Sns']['MessageId'] = logical_resource_id
+        return record
+
+    def test_batch(self):
+        records = [self._sns_record('Resource{}'.format(i), {'Fail': i == 2}) for i in range(5)]
+        records.append({'Sns': {'MessageId': 'Garbage', 'Message': 'not json'}})
+        event = {'Records': records}
+
+        handler = self.CustomResourceBatchTest.get_handler()
+        outcomes = handler(event, ccr_utils.MockLambdaContext())
+
+        self.assertEqual([o['RecordId'] for o in outcomes], ['Resource{}'.format(i) for i in range(5)] + ['Garbage'])
+        self.assertEqual([o['Status'] for o in outcomes],
+                         ['SUCCESS', 'SUCCESS', 'FAILED', 'SUCCESS', 'SUCCESS', 'FAILED'])
+        self.assertEqual([o['ResponseSent'] for o in outcomes], [True] * 5 + [False])
+        self.assertIn('failed on purpose', outcomes[2]['Reason'])
+        self.assertEqual(outcomes[0]['LogicalResourceId'], 'Resource0')
+
+    def test_sqs(self):
+        def cfn_event(logical_resource_id, properties):
+            return json.dumps(ccr_utils.generate_request('create', 'Custom::CustomResourceBatchTest', properties,
+                                                         CloudFormationCustomResource.DUMMY_RESPONSE_URL_SILENT,
+                                                         logical_resource_id=logical_resource_id))
+        messages = [
+            cfn_event('Raw', {}),
+            json.dumps(ccr_utils.generate_sns_event(cfn_event('Wrapped', {}))['Records'][0]['Sns']),
+            cfn_event('Failed', {'Fail': True}),
+            'not json',
+        ]
+        event = ccr_utils.generate_sqs_event(messages)
+
+        handler = self.CustomResourceBatchTest.get_sqs_handler()
+        response = handler(event, ccr_utils.MockLambdaContext())
+
+        # a FAILED response was still sent, so only the unparseable message is redelivered
+        self.assertEqual(response, {'batchItemFailures': [{'itemIdentifier': event['Records'][3]['messageId']}]})
+
+class TestTimeoutWatchdog(unittest.TestCase):
+    class CustomResourceTimeoutTest(CustomResourceTestBase):
+        RAISE_ON_FAILURE = False
+        TIMEOUT_WATCHDOG_MARGIN_MILLIS = 1000
+
+        def create(self):
+            self.wait_for_a_while()
+            self.status = self.STATUS_SUCCESS
+
+        def wait_for_a_while(self):
+            import time
+            start = time.time()
+            while time.time() - start < 1:
+                time.sleep(0.01)
+
+    def test_timeout(self):
+        event = ccr_utils.generate_request('create', 'Custom::CustomResourceTimeoutTest', {}, CloudFormationCustomResource.DUMMY_RESPONSE_URL_SILENT)
+        obj = self.CustomResourceTimeoutTest()
+        obj.handle(event, ccr_utils.MockLambdaContext(timeout=1.2))
+
+        self.assertTrue(obj.timed_out)
+        self.assertEqual(obj.test_response_content['Status'], CloudFormationCustomResource.STATUS_FAILED)
+        self.assertIn('about to time out in wait_for_a_while', obj.test_response_content['Reason'])
+
+    def test_no_timeout(self):
+        event = ccr_utils.generate_request('create', 'Custom::CustomResourceTimeoutTest', {}, CloudFormationCustomResource.DUMMY_RESPONSE_URL_SILENT)
+        obj = self.CustomResourceTimeoutTest()
+        obj.handle(event, ccr_utils.MockLambdaContext(timeout=3))
+
+        self.assertFalse(obj.timed_out)
+        self.assertIsNone(obj._watchdog)
+        self.assertEqual(obj.test_response_content['Status'], CloudFormationCustomResource.STATUS_SUCCESS)
+
+    def test_disabled_by_default(self):
+        class CustomResourceTimeoutTest(self.CustomResourceTimeoutTest):
+            TIMEOUT_WATCHDOG_MARGIN_MILLIS = CloudFormationCustomResource.TIMEOUT_WATCHDOG_MARGIN_MILLIS
+        event = ccr_utils.generate_request('create', 'Custom::CustomResourceTimeoutTest', {}, CloudFormationCustomResource.DUMMY_RESPONSE_URL_SILENT)
+        obj = CustomResourceTimeoutTest()
+        obj.handle(event, ccr_utils.MockLambdaContext(timeout=1.2))
+
+        self.assertFalse(obj.timed_out)
+        self.assertEqual(obj.test_response_content['Status'], CloudFormationCustomResource.STATUS_SUCCESS)
+
+class TestContinuation(unittest.TestCase):
+    class CustomResourceContinuationTest(CustomResourceTestBase):
+        MAX_CONTINUATIONS = 5
+
+        def create(self):
+            done = (self.checkpoint or 0) + 1
+            if done < self.resource_properties['Steps']:
+                return InProgress(done)
+            return {'Steps': done, 'Continuations': self.continuation_count}
+
+    def _run(self, resource_class, properties):
+        event = ccr_utils.generate_request('create', 'Custom::CustomResourceContinuationTest', properties, CloudFormationCustomResource.DUMMY_RESPONSE_URL_SILENT)
+        capturer = ccr_utils.ContinuationCapturer()
+        physical_resource_ids = []
+        while True:
+            obj = resource_class()
+            capturer.set(obj)
+            obj.handle(event, ccr_utils.MockLambdaContext())
+            physical_resource_ids.append(obj.physical_resource_id)
+            if obj.test_response_content:
+                return obj, physical_resource_ids
+            event = capturer.events.pop()
+
+    def test_continuation(self):
+        obj, physical_resource_ids = self._run(self.CustomResourceContinuationTest, {'Steps': 3})
+        self.assertEqual(obj.test_response_content['Data'], {'Steps': '3', 'Continuations': '2'})
+        self.assertEqual(len(physical_resource_ids), 3)
+        self.assertEqual(len(set(physical_resource_ids)), 1)
+
+    def test_invoke_continuation(self):
+        invocations = []
+        class FakeLambdaClient(object):
+            def invoke(self, **kwargs):
+                invocations.append(kwargs)
+
+        class CustomResourceContinuationTest(self.CustomResourceContinuationTest):
+            BOTO3_SESSION = object()
+            BOTO3_CACHE = Boto3Cache()
+            BOTO3_CLIENT_FACTORY = staticmethod(lambda session, name, **kwargs: FakeLambdaClient())
+
+        event = ccr_utils.generate_request('create', 'Custom::CustomResourceContinuationTest', {'Steps': 2}, CloudFormationCustomResource.DUMMY_RESPONSE_URL_SILENT)
+        obj = CustomResourceContinuationTest()
+        obj.handle(event, ccr_utils.MockLambdaContext())
+        self.assertEqual(len(invocations), 1)
+        self.assertEqual(invocations[0]['InvocationType'], 'Event')
+        payload = json.loads(invocations[0]['Payload'].decode('utf-8'))
+        self.assertEqual(payload[obj.CONTINUATION_KEY], {'Checkpoint': 1, 'Count': 1})
+
+    def test_max_continuations(self):
+        class CustomResourceContinuationTest(self.CustomResourceContinuationTest):
+            RAISE_ON_FAILURE = False
+        obj, physical_resource_ids = self._run(CustomResourceContinuationTest, {'Steps': 10})
+        self.assertEqual(obj.test_response_content['Status'], CloudFormationCustomResource.STATUS_FAILED)
+        self.assertIn('maximum of 5 continuations', obj.test_response_content['Reason'])
+
+class TestBoto3Cache(unittest.TestCase):
+    class FakeClient(object):
+        def __init__(self, name, kwargs):
+            self.name = name
+            self.kwargs = kwargs
+
+    def _resource_class(self, cache):
+        created = []
+        def client_factory(session, name, **kwargs):
+            created.append(name)
+            return TestBoto3Cache.FakeClient(name, kwargs)
+
+        class CustomResourceCacheTest(CustomResourceTestBase):
+            BOTO3_SESSION = object()
+            BOTO3_CACHE = cache
+            BOTO3_CLIENT_FACTORY = staticmethod(client_factory)
+        return CustomResourceCacheTest, created
+
+    def test_keyed_on_region(self):
+        cls, created = self._resource_class(Boto3Cache())
+        client = cls.get_boto3_client('s3')
+        self.assertIs(cls.get_boto3_client('s3'), client)
+        west = cls.get_boto3_client('s3', region_name='us-west-2')
+        self.assertIsNot(west, client)
+        self.assertEqual(west.kwargs, {'region_name': 'us-west-2'})
+        self.assertIs(cls.get_boto3_client('s3', region_name='us-west-2'), west)
+        self.assertEqual(created, ['s3', 's3'])
+        self.assertEqual(cls.BOTO3_CACHE.stats()['hits'], 2)
+        self.assertEqual(cls.BOTO3_CACHE.stats()['misses'], 2)
+
+    def test_replaced_session(self):
+        import weakref
+        class FakeSession(object):
+            pass
+        class CustomResourceCacheTest(CustomResourceTestBase):
+            BOTO3_CACHE = Boto3Cache()
+            # like boto3 clients, don't keep the session alive
+            BOTO3_CLIENT_FACTORY = staticmethod(lambda session, name: weakref.ref(session))
+        for _ in range(50):
+            CustomResourceCacheTest.BOTO3_SESSION = FakeSession()
+            session_ref = CustomResourceCacheTest.get_boto3_client('s3')
+            self.assertIs(session_ref(), CustomResourceCacheTest.BOTO3_SESSION)
+
+    def test_preloaded_clients(self):
+        cls, created = self._resource_class(Boto3Cache())
+        preloaded = TestBoto3Cache.FakeClient('s3', {})
+        cls.BOTO3_CLIENTS = {'s3': preloaded}
+        cls.BOTO3_RESOURCES = {'dynamodb': preloaded}
+        self.assertIs(cls.get_boto3_client('s3'), preloaded)
+        self.assertIs(cls.get_boto3_resource('dynamodb'), preloaded)
+        self.assertIsNot(cls.get_boto3_client('s3', region_name='us-west-2'), preloaded)
+        self.assertEqual(created, ['s3'])
+
+    def test_config(self):
+        from botocore.config import Config
+        cls, created = self._resource_class(Boto3Cache())
+        client = cls.get_boto3_client('s3', config=Config(retries={'max_attempts': 3}))
+        self.assertIs(cls.get_boto3_client('s3', config=Config(retries={'max_attempts': 3})), client)
+        self.assertIsNot(cls.get_boto3_client('s3', config=Config(retries={'max_attempts': 5})), client)
+
+    def test_lru(self):
+        cls, created = self._resource_class(Boto3Cache(max_size=2))
+        cls.get_boto3_client('a')
+        cls.get_boto3_client('b')
+        cls.get_boto3_client('a')
+        cls.get_boto3_client('c')  # evicts b
+        cls.get_boto3_client('a')
+        cls.get_boto3_client('b')
+        self.assertEqual(created, ['a', 'b', 'c', 'b'])
+        self.assertEqual(cls.BOTO3_CACHE.stats()['evictions'], 2)
+        self.assertEqual(len(cls.BOTO3_CACHE), 2)
+
+    def test_threads(self):
+        import threading
+        cls, created = self._resource_class(Boto3Cache())
+        clients = []
+        threads = [threading.Thread(target=lambda: clients.append(cls.get_boto3_client('s3'))) for _ in range(10)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(created, ['s3'])
+        self.assertEqual(len(set(id(client) for client in clients)), 1)
+
+class TestPrewarm(unittest.TestCase):
+    def test_prewarm(self):
+        created = []
+        def client_factory(session, name, **kwargs):
+            created.append((name, kwargs))
+            if name == 'broken':
+                raise RuntimeError('no such service')
+            return object()
+
+        class CustomResourcePrewarmTest(CustomResourceTestBase):
+            BOTO3_SESSION = object()
+            BOTO3_CACHE = Boto3Cache()
+            BOTO3_CLIENT_FACTORY = staticmethod(client_factory)
+            PREWARM_CLIENTS = ['s3', ('ssm', {'region_name': 'us-west-2'}), 'broken']
+
+            init_calls = 0
+
+            @classmethod
+            def on_init(cls):
+                cls.init_calls += 1
+                super(CustomResourcePrewarmTest, cls).on_init()
+
+        CustomResourcePrewarmTest.get_handler()
+        CustomResourcePrewarmTest.get_handler()
+        self.assertEqual(CustomResourcePrewarmTest.init_calls, 1)
+        self.assertEqual(created, [('s3', {}), ('ssm', {'region_name': 'us-west-2'}), ('broken', {})])
+        self.assertEqual(len(CustomResourcePrewarmTest.BOTO3_CACHE), 2)
+
+class TestDeployment(unittest.TestCase):
+    def test_resource_and_output(self):
+        resource, output = deployment.create_resource_and_output('MyResource', 'src', 'index.handler')
+        self.assertNotIn('AutoPublishAlias', resource['MyResource']['Properties'])
+        self.assertEqual(output['MyResourceArn']['Value'], {'Fn::GetAtt': ['MyResource', 'Arn']})
+
+    def test_provisioned_concurrency(self):
+        resource, output = deployment.create_resource_and_output('MyResource', 'src', 'index.handler',
+                                                                 provisioned_concurrency=2)
+        properties = resource['MyResource']['Properties']
+        self.assertEqual(properties['AutoPublishAlias'], 'live')
+        self.assertEqual(properties['ProvisionedConcurrencyConfig'], {'ProvisionedConcurrentExecutions': 2})
+        self.assertNotIn('SnapStart', properties)
+        self.assertEqual(output['MyResourceArn']['Value'], {'Ref': 'MyResource.Alias'})
+
+    def test_snap_start(self):
+        resource, output = deployment.create_resource_and_output('MyResource', 'src', 'index.handler',
+                                                                 runtime='python3.12', snap_start=True)
+        properties = resource['MyResource']['Properties']
+        self.assertEqual(properties['AutoPublishAlias'], 'live')
+        self.assertEqual(properties['SnapStart'], {'ApplyOn': 'PublishedVersions'})
+        self.assertNotIn('ProvisionedConcurrencyConfig', properties)
+        self.assertEqual(output['MyResourceArn']['Value'], {'Ref': 'MyResource.Alias'})
+
+        for kwargs in [{'runtime': 'python3.12', 'provisioned_concurrency': 2},
+                       {}, {'runtime': 'python3.9'}, {'runtime': 'nodejs20.x'}]:
+            with self.assertRaises(ValueError):
+                deployment.create_resource_and_output('MyResource', 'src', 'index.handler', snap_start=True, **kwargs)
+
+    def _run_template_main(self, argv):
+        stdout = sys.stdout
+        sys.stdout = six.StringIO()
+        try:
+            deployment.template_main(argv)
+            return sys.stdout.getvalue()
+        finally:
+            sys.stdout = stdout
+
+    def test_template_main_batch(self):
+        import tempfile, shutil
+        temp_dir = tempfile.mkdtemp()
+        try:
+            for name in ['ResourceA', 'ResourceB']:
+                os.makedirs(os.path.join(temp_dir, 'src', 'group', name))
+                with open(os.path.join(temp_dir, 'src', 'group', name, 'index.py'), 'w') as fp:
+                    fp.write('handler = None\n')
+            out_dir = os.path.join(temp_dir, 'out')
+            os.makedirs(out_dir)
+            argv = [os.path.join(temp_dir, 'src'), '--recursive', '--add', '-o', out_dir]
+
+            output = self._run_template_main(argv)
+            self.assertEqual(output.count('Updated '), 2)
+            self.assertIn('Wrote template', output)
+            with open(os.path.join(out_dir, 'template.json')) as fp:
+                template = json.load(fp)
+            self.assertEqual(sorted(template['Resources']), ['ResourceA', 'ResourceB'])
+            self.assertEqual(template['Resources']['ResourceA']['Properties']['Handler'], 'index.handler')
+            self.assertEqual(template['Resources']['ResourceA']['Properties']['CodeUri'], os.path.join('..', 'src', 'group', 'ResourceA'))
+            self.assertTrue(os.path.isfile(os.path.join(temp_dir, 'src', 'group', 'ResourceB', 'cfn_custom_resource.py')))
+
+            output = self._run_template_main(argv)
+            self.assertNotIn('Updated ', output)
+            self.assertIn('is unchanged', output)
+        finally:
+            shutil.rmtree(temp_dir)
+
+    def test_bundle(self):
+        import tempfile, shutil, zipfile, hashlib
+        temp_dir = tempfile.mkdtemp()
+        try:
+            code_dir = os.path.join(temp_dir, 'MyResource')
+            os.makedirs(code_dir)
+            with open(os.path.join(code_dir, 'index.py'), 'w') as fp:
+                fp.write('import helper\n\ndef handler(event, context):\n    import boto3\n    return helper.VALUE\n')
+            with open(os.path.join(code_dir, 'helper.py'), 'w') as fp:
+                fp.write('VALUE = 1\n')
+            for name in ['config.json', 'notes.txt']:
+                with open(os.path.join(code_dir, name), 'w') as fp:
+                    fp.write('{}\n')
+
+            outputs = [os.path.join(temp_dir, name) for name in ['a.zip', 'b.zip']]
+            for output in outputs:
+                report = deployment.bundle(code_dir, output, includes=['*.json'])
+            names = [entry['name'] for entry in report['entries']]
+            self.assertEqual(names, sorted(names))
+            self.assertIn('index.py', names)
+            self.assertIn('helper.py', names)
+            self.assertIn('config.json', names)
+            self.assertNotIn('notes.txt', names)
+            if not six.PY2:
+                import importlib.util
+                self.assertIn(importlib.util.cache_from_source('helper.py'), names)
+            self.assertFalse([name for name in names if name.startswith('boto')])
+            self.assertEqual(report['missing'], [])
+
+            hashes = []
+            for output in outputs:
+                with open(output, 'rb') as fp:
+                    hashes.append(hashlib.sha256(fp.read()).hexdigest())
+            self.assertEqual(hashes[0], hashes[1])
+            with zipfile.ZipFile(outputs[0]) as zf:
+                self.assertEqual(zf.read('helper.py'), b'VALUE = 1\n')
+                self.assertEqual(set(info.date_time for info in zf.infolist()), set([(1980, 1, 1, 0, 0, 0)]))
+            self.assertIn('Wrote ', deployment.format_bundle_report(report))
+        finally:
+            shutil.rmtree(temp_dir)
+
+    def test_bundle_missing(self):
+        import tempfile, shutil
+        temp_dir = tempfile.mkdtemp()
+        try:
+            code_dir = os.path.join(temp_dir, 'MyResource')
+            os.makedirs(code_dir)
+            with open(os.path.join(code_dir, 'index.py'), 'w') as fp:
+                fp.write('import sys\nimport no_such_module_for_test\n\ndef handler(event, context):\n    pass\n')
+            output = os.path.join(temp_dir, 'a.zip')
+
+            report = deployment.bundle(code_dir, output)
+            self.assertEqual(report['missing'], ['no_such_module_for_test'])
+            self.assertIn('Unresolved imports: no_such_module_for_test', deployment.format_bundle_report(report))
+
+            with self.assertRaises(SystemExit) as cm:
+                deployment.bundle_main([code_dir, '-o', output, '--quiet'])
+            self.assertEqual(cm.exception.code, 1)
+            deployment.bundle_main([code_dir, '-o', output, '--quiet', '--ignore-missing', 'no_such_module_for_test'])
+        finally:
+            shutil.rmtree(temp_dir)
+
+class TestLogging(unittest.TestCase):
+    class Trap(object):
+        __slots__ = ()
+        count = [0]
+
+        def __repr__(self):
+            self.count[0] += 1
+            return 'Trap()'
+
+    class CustomResourceLoggingTest(CustomResourceTestBase):
+        STRUCTURED_LOGGING = True
+        LOG_MAX_VALUE_SIZE = 10
+
+        def create(self):
+            return {'Long': 'x' * 100}
+
+    class CaptureHandler(logging.Handler):
+        def __init__(self):
+            logging.Handler.__init__(self)
+            self.messages = []
+
+        def emit(self, record):
+            self.messages.append(record.getMessage())
+
+    def setUp(self):
+        self.logger = logging.getLogger('CloudFormationCustomResource')
+        self.level = self.logger.level
+        self.handler = self.CaptureHandler()
+        self.logger.addHandler(self.handler)
+
+    def tearDown(self):
+        self.logger.removeHandler(self.handler)
+        self.logger.setLevel(self.level)
+
+    def _handle(self, resource_class):
+        event = ccr_utils.generate_request('create', 'Custom::CustomResourceLoggingTest', {'Key': 'y' * 100},
+                                           CloudFormationCustomResource.DUMMY_RESPONSE_URL_SILENT)
+        context = ccr_utils.MockLambdaContext()
+        context.trap = self.Trap()
+        obj = resource_class()
+        obj.handle(event, context)
+        return obj
+
+    def test_lazy(self):
+        self.logger.setLevel(logging.WARNING)
+        self.Trap.count[0] = 0
+        class CustomResourceLoggingTest(self.CustomResourceLoggingTest):
+            STRUCTURED_LOGGING = False
+        for resource_class in [self.CustomResourceLoggingTest, CustomResourceLoggingTest]:
+            self._handle(resource_class)
+        self.assertEqual(self.Trap.count[0], 0)
+        self.assertEqual(self.handler.messages, [])
+
+    def test_structured(self):
+        self.logger.setLevel(logging.INFO)
+        self.Trap.count[0] = 0
+        obj = self._handle(self.CustomResourceLoggingTest)
+        self.assertEqual(self.Trap.count[0], 1)
+
+        entries = [json.loads(message) for message in self.handler.messages]
+        self.assertEqual([entry['phase'] for entry in entries], ['request', 'response'])
+        for entry in entries:
+            self.assertEqual(entry['request_id'], obj.request_id)
+            self.assertEqual(entry['stack_id'], obj.stack_id)
+        self.assertEqual(entries[0]['event']['ResourceProperties']['Key'], 'y' * 10 + '...<90 more characters>')
+        self.assertEqual(entries[0]['context']['trap'], 'Trap()')
+        self.assertEqual(entries[1]['response']['Data']['Long'], 'x' * 10 + '...<90 more characters>')
+
+class TestPropertyDiff(unittest.TestCase):
+    OLD = {
+        'Name': 'foo',
+        'Count': '1',
+        'Enabled': 'true',
+        'Tags': [{'Key': 'a', 'Value': '1'}, {'Key': 'b', 'Value': '2'}],
+        'Config': {'Timeout': '30', 'Memory': '128'},
+    }
+
+    NEW = {
+        'Name': 'foo',
+        'Count': 1,
+        'Enabled': True,
+        'Tags': [{'Key': 'a', 'Value': '1'}, {'Key': 'b', 'Value': '3'}, {'Key': 'c', 'Value': '4'}],
+        'Config': {'Timeout': '60'},
+        'New': 'value',
+    }
+
+    def test_diff(self):
+        from cfn_custom_resource import PropertyDiff
+        diff = PropertyDiff(self.OLD, self.NEW)
+        self.assertEqual(diff.added, set([('Tags', 2), ('New',)]))
+        self.assertEqual(diff.removed, set([('Config', 'Memory')]))
+        self.assertEqual(diff.changed, set([('Tags', 1, 'Value'), ('Config', 'Timeout')]))
+
+        self.assertTrue(diff)
+        self.assertTrue(diff.has_changed())
+        self.assertFalse(diff.has_changed('Name'))
+        self.assertFalse(diff.has_changed('Count'))
+        self.assertFalse(diff.has_changed('Enabled'))
+        self.assertTrue(diff.has_changed('Tags'))
+        self.assertFalse(diff.has_changed(('Tags', 0)))
+        self.assertTrue(diff.has_changed('Tags.1'))
+        self.assertFalse(diff.has_changed('Tags.1.Key'))
+        self.assertTrue(diff.has_changed(('Config', 'Memory')))
+        self.assertFalse(diff.has_changed('Missing'))
+
+        self.assertFalse(PropertyDiff(self.OLD, dict(self.OLD)))
+
+    def test_below_changed_value(self):
+        from cfn_custom_resource import PropertyDiff
+        self.assertTrue(PropertyDiff({}, {'Config': {'Timeout': '5'}}).has_changed('Config.Timeout'))
+        self.assertTrue(PropertyDiff({'A': 'x'}, {'A': {'B': 1}}).has_changed('A.B'))
+        removed = PropertyDiff({'Tags': [{'Key': 'a', 'Value': '1'}]}, {'Tags': []})
+        self.assertTrue(removed.has_changed('Tags.0.Value'))
+        self.assertTrue(removed.has_changed(('Tags', 0, 'Value')))
+        self.assertFalse(removed.has_changed('Other.Value'))
+
+    def test_dotted_key(self):
+        from cfn_custom_resource import PropertyDiff
+        diff = PropertyDiff({'app.name': 'a', 'app': {'name': 'b'}}, {'app.name': 'c', 'app': {'name': 'b'}})
+        self.assertTrue(diff.has_changed('app.name'))
+        self.assertFalse(diff.has_changed(('app', 'name')))
+
+    def test_has_property_changed(self):
+        obj = CustomResourceTestBase()
+        obj.old_resource_properties = self.OLD
+        obj.resource_properties = self.NEW
+        self.assertFalse(obj.has_property_changed('Name'))
+        self.assertTrue(obj.has_property_changed('Config'))
+        self.assertTrue(obj.has_property_changed('New'))
+        self.assertIs(obj.property_diff, obj.property_diff)
+
+        obj = CustomResourceTestBase()
+        obj.old_resource_properties = {'app.name': 'a'}
+        obj.resource_properties = {'app.name': 'b'}
+        self.assertTrue(obj.has_property_changed('app.name'))
+
+        obj.old_resource_properties = None
+        self.assertTrue(obj.has_property_changed('Name'))
+
+class TestPropertiesSchema(unittest.TestCase):
+    class CustomResourceSchemaTest(CustomResourceTestBase):
+        RAISE_ON_FAILURE = False
+
+        PROPERTIES_SCHEMA = {
+            'Name': Property(str, required=True),
+            'Count': Property(int, default=1),
+            'Ratio': float,
+            'Enabled': Property(bool, default=False),
+            'Subnets': Property([str], default=[]),
+            'Limits': {str: int},
+            'Config': Property({
+                'Timeout': Property(int, default=30),
+                'Retry': bool,
+            }),
+        }
+
+        def create(self):
+            self.create_called = True
+
+        def delete(self):
+            self.delete_called = True
+
+    def _handle(self, properties, request_type='create'):
+        event = ccr_utils.generate_request(request_type, 'Custom::CustomResourceSchemaTest', properties, CloudFormationCustomResource.DUMMY_RESPONSE_URL_SILENT)
+        obj = self.CustomResourceSchemaTest()
+        obj.create_called = False
+        obj.delete_called = False
+        obj.handle(event, ccr_utils.MockLambdaContext())
+        return obj
+
+    def test_coercion(self):
+        obj = self._handle({
+            'ServiceToken': 'arn:aws:lambda:us-east-1:123456789012:function:Foo',
+            'Name': 'foo',
+            'Count': '3',
+            'Ratio': '0.5',
+            'Enabled': 'True',
+            'Limits': {'a': '1', 'b': '2'},
+            'Config': {'Retry': 'false'},
+        })
+        self.assertTrue(obj.create_called)
+        properties = obj.properties
+        self.assertEqual(properties.Name, 'foo')
+        self.assertEqual(properties.Count, 3)
+        self.assertEqual(properties.Ratio, 0.5)
+        self.assertIs(properties.Enabled, True)
+        self.assertEqual(properties.Subnets, [])
+        self.assertEqual(properties.Limits, {'a': 1, 'b': 2})
+        self.assertEqual(properties.Config.Timeout, 30)
+        self.assertIs(properties.Config.Retry, False)
+        self.assertEqual(properties.ServiceToken, 'arn:aws:lambda:us-east-1:123456789012:function:Foo')
+        # the raw properties are untouched
+        self.assertEqual(obj.resource_properties['Count'], '3')
+
+    def test_invalid(self):
+        obj = self._handle({
+            'Count': 'three',
+            'Enabled': 'yes',
+            'Subnets': ['a', {}],
+        })
+        self.assertFalse(obj.create_called)
+        self.assertEqual(obj.status, CloudFormationCustomResource.STATUS_FAILED)
+        messages = ['Properties.Name: required', 'Properties.Count: expected int',
+                    'Properties.Enabled: expected a boolean', 'Properties.Subnets.1: expected a string']
+        for message in messages:
+            self.assertIn(message, obj.failure_reason)
+
+        with self.assertRaises(PropertyValidationError) as cm:
+            obj._properties_validator(obj.resource_properties)
+        self.assertEqual(len(cm.exception.errors), len(messages))
+        for message in messages:
+            self.assertTrue(any(error.startswith(message) for error in cm.exception.errors), message)
+
+    def test_invalid_delete(self):
+        obj = self._handle({'Count': 'three'}, 'delete')
+        self.assertTrue(obj.delete_called)
+        self.assertEqual(obj.status, CloudFormationCustomResource.STATUS_SUCCESS)
+        self.assertIsNone(obj.properties)
+
+class TestResponseStore(unittest.TestCase):
+    class CustomResourceStoreTest(CustomResourceTestBase):
+        def create(self):
+            self.create_calls.append(self.request_id)
+            return {'Calls': len(self.create_calls)}
+
+    def _check_store(self, store):
+        class CustomResourceStoreTest(self.CustomResourceStoreTest):
+            RESPONSE_STORE = store
+            create_calls = []
+
+        event = ccr_utils.generate_request('create', 'Custom::CustomResourceStoreTest', {}, CloudFormationCustomResource.DUMMY_RESPONSE_URL_SILENT)
+        responses = []
+        for _ in range(3):
+            obj = CustomResourceStoreTest()
+            obj.handle(event, ccr_utils.MockLambdaContext())
+            responses.append(obj.test_response_content)
+
+        self.assertEqual(len(CustomResourceStoreTest.create_calls), 1)
+        self.assertTrue(obj.replayed)
+        self.assertEqual(responses[1], responses[0])
+        self.assertEqual(responses[2], responses[0])
+
+        other_event = ccr_utils.generate_request('create', 'Custom::CustomResourceStoreTest', {}, CloudFormationCustomResource.DUMMY_RESPONSE_URL_SILENT)
+        obj = CustomResourceStoreTest()
+        obj.handle(other_event, ccr_utils.MockLambdaContext())
+        self.assertFalse(obj.replayed)
+        self.assertEqual(len(CustomResourceStoreTest.create_calls), 2)
+
+    def test_memory(self):
+        from cfn_custom_resource.stores import MemoryResponseStore
+        self._check_store(MemoryResponseStore())
+
+    def test_sqlite(self):
+        import tempfile, shutil
+        from cfn_custom_resource.stores import SQLiteResponseStore
+        temp_dir = tempfile.mkdtemp()
+        try:
+            store = SQLiteResponseStore(os.path.join(temp_dir, 'responses.db'))
+            self._check_store(store)
+            store.close()
+        finally:
+            shutil.rmtree(temp_dir)
+
+    def test_local_directory_blob_store(self):
+        import tempfile, shutil
+        from cfn_custom_resource.stores import LocalDirectoryBlobStore
+        temp_dir = tempfile.mkdtemp()
+        try:
+            store = LocalDirectoryBlobStore(temp_dir)
+            for value in [u'caf\u00e9', u'caf\u00e9'.encode('utf-8'), str('plain')]:
+                reference = store.put('stack/Resource/Output', value)
+                with open(reference[len('file://'):], 'rb') as fp:
+                    expected = value if isinstance(value, six.binary_type) else value.encode('utf-8')
+                    self.assertEqual(fp.read(), expected)
+        finally:
+            shutil.rmtree(temp_dir)
+
+class TestRouter(unittest.TestCase):
+    def _router(self):
+        from cfn_custom_resource.router import ResourceRouter
+        router = ResourceRouter()
+
+        @router.register
+        class Widget(CustomResourceTestBase):
+            RESOURCE_TYPE_SPEC = ['Widget', 'Gadget']
+            RAISE_ON_FAILURE = False
+
+            def create(self):
+                return {'Handler': 'Widget', 'Type': self.resource_type}
+
+        class Gizmo(CustomResourceTestBase):
+            RAISE_ON_FAILURE = False
+
+            def __init__(self, name):
+                super(Gizmo, self).__init__()
+                self.name = name
+
+            def create(self):
+                return {'Handler': self.name}
+
+        router.register(Gizmo, 'gizmo')
+
+        @router.create('FunctionResource')
+        def create(resource):
+            return {'Handler': 'function'}
+
+        return router
+
+    def _event(self, resource_type, request_type='create', **kwargs):
+        return ccr_utils.generate_request(request_type, resource_type, {}, CloudFormationCustomResource.DUMMY_RESPONSE_URL_SILENT, **kwargs)
+
+    def test_route(self):
+        router = self._router()
+        self.assertEqual(router.resource_types, ['Custom::FunctionResource', 'Custom::Gadget', 'Custom::Gizmo', 'Custom::Widget'])
+
+        capturer = ccr_utils.ResponseCapturer()
+        for resource_type, expected in [('Custom::Widget', 'Widget'), ('Custom::Gadget', 'Widget'),
+                                        ('Custom::Gizmo', 'gizmo'), ('Custom::FunctionResource', 'function')]:
+            event = self._event(resource_type)
+            resource = router.get_resource(event)
+            capturer.set(resource)
+            resource.handle(event, ccr_utils.MockLambdaContext())
+            self.assertEqual(capturer.response_content['Status'], CloudFormationCustomResource.STATUS_SUCCESS)
+            self.assertEqual(capturer.response_content['Data']['Handler'], expected)
+
+    def test_unrouted(self):
+        router = self._router()
+        router.unrouted_class = type('Unrouted', (router.unrouted_class,), {'RAISE_ON_FAILURE': False})
+        event = self._event('Custom::Unknown')
+        resource = router.get_resource(event)
+        capturer = ccr_utils.ResponseCapturer()
+        capturer.set(resource)
+        resource.handle(event, ccr_utils.MockLambdaContext())
+        self.assertEqual(capturer.response_content['Status'], CloudFormationCustomResource.STATUS_FAILED)
+        self.assertIn('no handler registered for resource type Custom::Unknown', capturer.response_content['Reason'])
+
+    def test_missing_function(self):
+        router = self._router()
+        event = self._event('Custom::FunctionResource', 'delete')
+        resource = router.get_resource(event)
+        capturer = ccr_utils.ResponseCapturer()
+        capturer.set(resource)
+        with self.assertRaises(Exception) as cm:
+            resource.handle(event, ccr_utils.MockLambdaContext())
+        self.assertIn('no delete function registered', str(cm.exception))
+
+    def test_duplicate(self):
+        router = self._router()
+        class Widget(CustomResourceTestBase):
+            pass
+        with self.assertRaises(ValueError):
+            router.register(Widget)
+
+    def test_batch(self):
+        router = self._router()
+        records = []
+        for resource_type in ['Custom::Widget', 'Custom::Gizmo', 'Custom::Unknown']:
+            records.append(ccr_utils.generate_sns_event(json.dumps(self._event(resource_type)))['Records'][0])
+        outcomes = router.get_handler()({'Records': records}, ccr_utils.MockLambdaContext())
+        self.assertEqual([o['Status'] for o in outcomes], ['SUCCESS', 'SUCCESS', 'FAILED'])
+
+class TestResponseSize(unittest.TestCase):
+    class CustomResourceSizeTest(CustomResourceTestBase):
+        RAISE_ON_FAILURE = False
+
+        def create(self):
+            return {
+                'Small': 'small',
+                'Large': 'x' * 3000,
+                'Larger': ['y' * 3000],
+            }
+
+        def update(self):
+            raise Exception('z' * 5000)
+
+    def _handle(self, resource_class, request_type='create'):
+        event = ccr_utils.generate_request(request_type, 'Custom::CustomResourceSizeTest', {}, CloudFormationCustomResource.DUMMY_RESPONSE_URL_SILENT,
+                                           old_properties={})
+        obj = resource_class()
+        obj.handle(event, ccr_utils.MockLambdaContext())
+        size = len(CloudFormationCustomResource.JSON_SERIALIZER.dumps(obj.test_response_content).encode('utf-8'))
+        self.assertLessEqual(size, CloudFormationCustomResource.MAX_RESPONSE_SIZE)
+        return obj
+
+    def test_offload(self):
+        import tempfile, shutil
+        from cfn_custom_resource.stores import LocalDirectoryBlobStore
+        temp_dir = tempfile.mkdtemp()
+        try:
+            class CustomResourceSizeTest(self.CustomResourceSizeTest):
+                RESPONSE_BLOB_STORE = LocalDirectoryBlobStore(temp_dir)
+            obj = self._handle(CustomResourceSizeTest)
+
+            data = obj.test_response_content['Data']
+            self.assertEqual(obj.test_response_content['Status'], CloudFormationCustomResource.STATUS_SUCCESS)
+            self.assertEqual(sorted(obj.offloaded_outputs), ['Larger'])
+            self.assertEqual(data['Small'], 'small')
+            self.assertEqual(data['Large'], 'x' * 3000)
+            self.assertTrue(data['Larger'].startswith('file://'))
+            with open(data['Larger'][len('file://'):]) as fp:
+                self.assertEqual(json.load(fp), ['y' * 3000])
+        finally:
+            shutil.rmtree(temp_dir)
+
+    def test_offload_failure(self):
+        class FailingBlobStore(object):
+            def put(self, key, value):
+                raise RuntimeError('AccessDenied')
+        class CustomResourceSizeTest(self.CustomResourceSizeTest):
+            RESPONSE_BLOB_STORE = FailingBlobStore()
+        obj = self._handle(CustomResourceSizeTest)
+        self.assertEqual(obj.test_response_content['Status'], CloudFormationCustomResource.STATUS_FAILED)
+        self.assertIn('exceeds the limit of 4096 bytes', obj.test_response_content['Reason'])
+        self.assertEqual(obj.offloaded_outputs, {})
+
+    def test_too_large(self):
+        obj = self._handle(self.CustomResourceSizeTest)
+        self.assertEqual(obj.test_response_content['Status'], CloudFormationCustomResource.STATUS_FAILED)
+        self.assertIn('exceeds the limit of 4096 bytes', obj.test_response_content['Reason'])
+        self.assertEqual(obj.test_response_content['Data'], {})
+
+    def test_truncate_reason(self):
+        obj = self._handle(self.CustomResourceSizeTest, 'update')
+        reason = obj.test_response_content['Reason']
+        self.assertTrue(reason.endswith('... (truncated)'))
+        self.assertIn('zzz', reason)
+
+    def test_truncate_reason_too_large(self):
+        class CustomResourceSizeTest(self.CustomResourceSizeTest):
+            def update(self):
+                self.resource_outputs['Big'] = 'x' * 6000
+                raise Exception('z' * 500)
+        obj = self._handle(CustomResourceSizeTest, 'update')
+        self.assertEqual(obj.test_response_content['Status'], CloudFormationCustomResource.STATUS_FAILED)
+        self.assertIn('exceeds the limit of 4096 bytes', obj.test_response_content['Reason'])
+        self.assertEqual(obj.test_response_content['Data'], {})
+
+class TestJsonSerializer(unittest.TestCase):
+    VALUE = {'Key': [1, 2.5, True, None, u'caf\u00e9', 'a/b', {'Nested': 'value'}]}
+
+    def _get_serializers(self):
+        serializers = []
+        for backend in JsonSerializer.BACKENDS:
+            try:
+                serializer = JsonSerializer(backend)
+                serializer.backend
+            except ImportError:
+                continue
+            serializers.append(serializer)
+        return serializers
+
+    def test_consistent_output(self):
+        expected = json.dumps(self.VALUE, ensure_ascii=False, separators=(',', ':'))
+        for serializer in self._get_serializers():
+            self.assertEqual(serializer.dumps(self.VALUE), expected, serializer.backend)
+            self.assertEqual(serializer.loads(expected), self.VALUE, serializer.backend)
+            self.assertEqual(serializer.loads(expected.encode('utf-8')), self.VALUE, serializer.backend)
+
+    def test_fallback(self):
+        for serializer in self._get_serializers():
+            self.assertEqual(serializer.dumps({1: 'one'}), '{"1":"one"}', serializer.backend)
+
+    def test_unknown_backend(self):
+        with self.assertRaises(ValueError):
+            JsonSerializer('simplejson')
+
+class TestPhysicalResourceIdGeneration(unittest.TestCase):
+    class CustomResourceIdTest(CustomResourceTestBase):
+        def create(self):
+            pass
+
+    def _get_id(self, resource_class, request_id=None, logical_resource_id=None):
+        event = ccr_utils.generate_request('create', 'Custom::CustomResourceIdTest', {}, CloudFormationCustomResource.DUMMY_RESPONSE_URL_SILENT,
+                                           request_id=request_id, logical_resource_id=logical_resource_id)
+        obj = resource_class()
+        obj.handle(event, ccr_utils.MockLambdaContext())
+        return obj.physical_resource_id
+
+    def test_random(self):
+        physical_resource_id = self._get_id(self.CustomResourceIdTest, request_id='request')
+        six.assertRegex(self, physical_resource_id, r'^examplestackname-[A-Za-z0-9]+-[A-Z2-7]{12}$')
+        self.assertNotEqual(physical_resource_id, self._get_id(self.CustomResourceIdTest, request_id='request'))
+
+    def test_deterministic(self):
+        class CustomResourceIdTest(self.CustomResourceIdTest):
+            PHYSICAL_RESOURCE_ID_STRATEGY = 'deterministic'
+        physical_resource_id = self._get_id(CustomResourceIdTest, request_id='request')
+        self.assertEqual(physical_resource_id, self._get_id(CustomResourceIdTest, request_id='request'))
+        self.assertNotEqual(physical_resource_id, self._get_id(CustomResourceIdTest, request_id='other'))
+
+    def test_template_max_len(self):
+        class CustomResourceIdTest(self.CustomResourceIdTest):
+            PHYSICAL_RESOURCE_ID_TEMPLATE = 'arn:aws:sns:{region}:{account_id}:{id}'
+            PHYSICAL_RESOURCE_ID_MAX_LEN = 60
+        physical_resource_id = self._get_id(CustomResourceIdTest, logical_resource_id='L' * 100)
+        self.assertEqual(len(physical_resource_id), 60)
+        self.assertTrue(physical_resource_id.startswith('arn:aws:sns:us-west-2:123456789012:'))
+
+    def test_cannot_fit(self):
+        class CustomResourceIdTest(self.CustomResourceIdTest):
+            PHYSICAL_RESOURCE_ID_TEMPLATE = 'arn:aws:sns:{region}:{account_id}:{id}'
+            PHYSICAL_RESOURCE_ID_MAX_LEN = 40
+            RAISE_ON_FAILURE = False
+        event = ccr_utils.generate_request('create', 'Custom::CustomResourceIdTest', {}, CloudFormationCustomResource.DUMMY_RESPONSE_URL_SILENT)
+        obj = CustomResourceIdTest()
+        obj.handle(event, ccr_utils.MockLambdaContext())
+        self.assertEqual(obj.status, CloudFormationCustomResource.STATUS_FAILED)
+        self.assertIn('cannot fit in 40 characters', obj.failure_reason)
+
+class CustomResourceLoadTest(CloudFormationCustomResource):
+    def create(self):
+        return {'Value': 'created'}
+
+    def update(self):
+        pass
+
+    def delete(self):
+        pass
+
+loadtest_handler = CustomResourceLoadTest.get_handler()
+
+class TestLoadTest(unittest.TestCase):
+    def test_generate_events(self):
+        from cfn_custom_resource import loadtest
+        events = loadtest.generate_events(50, 'Custom::CustomResourceLoadTest', {'Key': 'Value'}, lambda request_id: 'url/' + request_id,
+                                          mix=loadtest.parse_mix('Create=1,Delete=1'), stacks=5, seed=1)
+        self.assertEqual(len(events), 50)
+        self.assertEqual(set(e['RequestType'] for e in events), set(['Create', 'Delete']))
+        self.assertEqual(len(set(e['StackId'] for e in events)), 5)
+        self.assertEqual(events[0]['ResponseURL'], 'url/' + events[0]['RequestId'])
+        self.assertEqual(events, loadtest.generate_events(50, 'Custom::CustomResourceLoadTest', {'Key': 'Value'}, lambda request_id: 'url/' + request_id,
+                                                          mix=loadtest.parse_mix('Create=1,Delete=1'), stacks=5, seed=1))
+
+    def test_run(self):
+        from cfn_custom_resource import loadtest
+        with loadtest.ResponseSink() as sink:
+            events = loadtest.generate_events(30, 'Custom::CustomResourceLoadTest', {}, sink.url_for, seed=1)
+            report = loadtest.run('tests.loadtest_handler', events, sink, concurrency=4)
+        self.assertEqual(report['requests'], 30)
+        self.assertEqual(sum(phase['statuses'].get('SUCCESS', 0) for phase in report['phases'].values()), 30)
+        for phase in report['phases'].values():
+            self.assertEqual(phase['errors'], 0)
+            self.assertEqual(phase['handler']['count'], phase['response']['count'])
+            self.assertLessEqual(phase['handler']['p50_ms'], phase['handler']['max_ms'])
+        self.assertIn('requests/s', loadtest.format_report(report))
+
+class TestMetrics(unittest.TestCase):
+    class CustomResourceMetricsTest(CustomResourceTestBase):
+        EMIT_METRICS = True
+
+        def __init__(self, *args, **kwargs):
+            super(TestMetrics.CustomResourceMetricsTest, self).__init__(*args, **kwargs)
+            self.emitted = []
+            self.metrics_function = lambda resource: self.emitted.append(json.dumps(resource.get_metrics()))
+
+        def create(self):
+            time.sleep(0.01)
+
+        def delete(self):
+            pass
+
+    def test_timings(self):
+        event = ccr_utils.generate_request('create', 'Custom::CustomResourceMetricsTest', {}, CloudFormationCustomResource.DUMMY_RESPONSE_URL_SILENT)
+        obj = self.CustomResourceMetricsTest()
+        obj.handle(event, ccr_utils.MockLambdaContext())
+        self.assertEqual(list(obj.timings), ['start', 'validate', 'populate', 'dispatch', 'send', 'response', 'total'])
+        self.assertGreaterEqual(obj.timings['dispatch'], 0.01)
+        self.assertGreaterEqual(obj.timings['total'], sum(v for k, v in obj.timings.items() if k not in ('total', 'send')))
+        self.assertEqual(len(obj.emitted), 1)
+
+        record = json.loads(obj.emitted[0])
+        directive = record['_aws']['CloudWatchMetrics'][0]
+        self.assertEqual(directive['Dimensions'], [['ResourceType', 'RequestType']])
+        for metric in directive['Metrics']:
+            self.assertIn(metric['Name'], record)
+        self.assertEqual(record['Status'], 'SUCCESS')
+        self.assertGreaterEqual(record['DispatchTime'], 10)
+
+    def test_replay(self):
+        from cfn_custom_resource.stores import MemoryResponseStore
+        from cfn_custom_resource.cfn_custom_resource import _get_boto3_call_stats
+        class CustomResourceMetricsTest(self.CustomResourceMetricsTest):
+            RESPONSE_STORE = MemoryResponseStore()
+            INSTRUMENT_BOTO3 = True
+
+        event = ccr_utils.generate_request('create', 'Custom::CustomResourceMetricsTest', {}, CloudFormationCustomResource.DUMMY_RESPONSE_URL_SILENT)
+        CustomResourceMetricsTest().handle(event, ccr_utils.MockLambdaContext())
+        obj = CustomResourceMetricsTest()
+        obj.handle(event, ccr_utils.MockLambdaContext())
+        self.assertTrue(obj.replayed)
+        self.assertEqual(len(obj.emitted), 1)
+        self.assertIn('total', obj.timings)
+        self.assertIsNone(_get_boto3_call_stats())
+
+    def test_parse(self):
+        lines = ['2020-01-01T00:00:00.000Z\tsome log line']
+        for request_type in ['create', 'create', 'delete']:
+            event = ccr_utils.generate_request(request_type, 'Custom::CustomResourceMetricsTest', {}, CloudFormationCustomResource.DUMMY_RESPONSE_URL_SILENT)
+            obj = self.CustomResourceMetricsTest()
+            obj.handle(event, ccr_utils.MockLambdaContext())
+            lines.extend('2020-01-01T00:00:00.000Z\t' + line for line in obj.emitted)
+
+        records = list(ccr_utils.parse_metrics(lines))
+        self.assertEqual(len(records), 3)
+        summary = ccr_utils.summarize_metrics(records)
+        self.assertEqual(sorted(summary), [('Custom::CustomResourceMetricsTest', 'Create'), ('Custom::CustomResourceMetricsTest', 'Delete')])
+        create = summary[('Custom::CustomResourceMetricsTest', 'Create')]
+        self.assertEqual(create['TotalTime']['count'], 2)
+        self.assertGreaterEqual(create['DispatchTime']['p50'], 10)
+        self.assertEqual(create['ResponseAttempts']['max'], 0)
+
+class TestBoto3Instrumentation(unittest.TestCase):
+    def test_instrumentation(self):
+        import boto3.session
+        from botocore.stub import Stubber
+
+        class FakeHttpResponse(object):
+            status_code = 429
+
+        class CustomResourceInstrumentationTest(CustomResourceTestBase):
+            BOTO3_SESSION = boto3.session.Session(region_name='us-east-1', aws_access_key_id='AKID', aws_secret_access_key='SECRET')
+            BOTO3_CACHE = Boto3Cache()
+            INSTRUMENT_BOTO3 = True
+
+            def create(self):
+                client = self.get_boto3_client('s3')
+                with Stubber(client) as stubber:
+                    stubber.add_response('list_buckets', {'Buckets': [], 'ResponseMetadata': {'RetryAttempts': 2}})
+                    stubber.add_response('list_buckets', {'Buckets': []})
+                    stubber.add_client_error('head_bucket', 'NotFound', http_status_code=404)
+                    client.list_buckets()
+                    client.list_buckets()
+                    with self.test_class.assertRaises(Exception):
+                        client.head_bucket(Bucket='bucket')
+                client.meta.events.emit('needs-retry.s3.ListBuckets',
+                                        response=(FakeHttpResponse(), {}),
+                                        operation=client.meta.service_model.operation_model('ListBuckets'),
+                                        endpoint=None, attempts=1, caught_exception=None, request_dict={'context': {}})
+
+        event = ccr_utils.generate_request('create', 'Custom::CustomResourceInstrumentationTest', {}, CloudFormationCustomResource.DUMMY_RESPONSE_URL_SILENT)
+        obj = CustomResourceInstrumentationTest()
+        obj.test_class = self
+        obj.handle(event, ccr_utils.MockLambdaContext())
+
+        stats = obj.boto3_stats.to_dict()
+        self.assertEqual(list(stats), ['s3.ListBuckets', 's3.HeadBucket'])
+        self.assertEqual(stats['s3.ListBuckets']['calls'], 2)
+        self.assertEqual(stats['s3.ListBuckets']['retries'], 2)
+        self.assertEqual(stats['s3.ListBuckets']['throttles'], 1)
+        self.assertEqual(sum(stats['s3.ListBuckets']['histogram'].values()), 2)
+        self.assertEqual(stats['s3.HeadBucket']['errors'], 1)
+
+        metrics = obj.get_metrics()
+        self.assertEqual(metrics['Boto3Calls'], 3)
+        self.assertEqual(metrics['Boto3Throttles'], 1)
+
+        # calls outside of a request aren't recorded
+        client = CustomResourceInstrumentationTest.get_boto3_client('s3')
+        with Stubber(client) as stubber:
+            stubber.add_response('list_buckets', {'Buckets': []})
+            client.list_buckets()
+        self.assertEqual(obj.boto3_stats.total('calls'), 3)
+
+    def test_stats_cleared(self):
+        from cfn_custom_resource.cfn_custom_resource import _get_boto3_call_stats
+        class CustomResourceInstrumentationTest(CustomResourceTestBase):
+            INSTRUMENT_BOTO3 = True
+
+            def create(self):
+                pass
+
+        event = ccr_utils.generate_request('create', 'Custom::CustomResourceInstrumentationTest', {}, CloudFormationCustomResource.DUMMY_RESPONSE_URL_SILENT)
+        obj = CustomResourceInstrumentationTest()
+        obj.handle(event, ccr_utils.MockLambdaContext())
+        self.assertIsNotNone(obj.boto3_stats)
+        self.assertIsNone(_get_boto3_call_stats())
+
+        del event['ResourceType']
+        with self.assertRaises(KeyError):
+            obj.handle(event, ccr_utils.MockLambdaContext())
+        self.assertIsNone(_get_boto3_call_stats())
+
+class TestProfile(unittest.TestCase):
+    class CustomResourceProfileTest(CustomResourceTestBase):
+        def __init__(self, *args, **kwargs):
+            super(TestProfile.CustomResourceProfileTest, self).__init__(*args, **kwargs)
+            self.profiles = []
+            self.profile_function = lambda resource, profiler: self.profiles.append(profiler)
+
+        def create(self):
+            self.seen_properties = dict(self.resource_properties)
+            sorted(range(1000), key=lambda i: -i)
+
+        def update(self):
+            self.seen_properties = dict(self.resource_properties)
+            self.changed = self.has_property_changed('CfnCustomResourceProfile')
+
+    def _handle(self, resource_class, request_type, properties, old_properties=None):
+        event = ccr_utils.generate_request(request_type, 'Custom::CustomResourceProfileTest', properties, CloudFormationCustomResource.DUMMY_RESPONSE_URL_SILENT,
+                                           old_properties=old_properties)
+        obj = resource_class()
+        obj.handle(event, ccr_utils.MockLambdaContext())
+        return obj
+
+    def test_disabled(self):
+        obj = self._handle(self.CustomResourceProfileTest, 'create', {'Key': 'Value'})
+        self.assertFalse(obj.profiling)
+        self.assertEqual(obj.profiles, [])
+
+    def test_property(self):
+        obj = self._handle(self.CustomResourceProfileTest, 'create', {'Key': 'Value', 'CfnCustomResourceProfile': 'true'})
+        self.assertTrue(obj.profiling)
+        self.assertEqual(obj.seen_properties, {'Key': 'Value'})
+        self.assertEqual(len(obj.profiles), 1)
+        import pstats
+        stats = pstats.Stats(obj.profiles[0])
+        self.assertTrue(any(name == 'create' for _, _, name in stats.stats))
+
+        obj = self._handle(self.CustomResourceProfileTest, 'update', {'Key': 'Value'}, {'Key': 'Value', 'CfnCustomResourceProfile': 'true'})
+        self.assertFalse(obj.profiling)
+        self.assertFalse(obj.changed)
+
+    def test_environment_and_store(self):
+        class Store(object):
+            def __init__(self):
+                self.blobs = {}
+
+            def put(self, key, value):
+                self.blobs[key] = value
+                return 'memory://' + key
+
+        class CustomResourceProfileTest(CustomResourceTestBase):
+            PROFILE_BLOB_STORE = Store()
+
+            def create(self):
+                pass
+
+        os.environ['CFN_CUSTOM_RESOURCE_PROFILE'] = '1'
+        try:
+            obj = self._handle(CustomResourceProfileTest, 'create', {})
+        finally:
+            del os.environ['CFN_CUSTOM_RESOURCE_PROFILE']
+        self.assertTrue(obj.profiling)
+        blobs = CustomResourceProfileTest.PROFILE_BLOB_STORE.blobs
+        self.assertEqual(len(blobs), 1)
+        key, value = list(blobs.items())[0]
+        self.assertTrue(key.endswith('/{}/profile-0.txt'.format(obj.request_id)))
+        self.assertIn('create', value)
+
+class TestImportTime(unittest.TestCase):
+    # modules that are slow to import and must only be loaded on first use
+    DEFERRED_MODULES = ['boto3', 'botocore', 'requests', 'pkg_resources']
+
+    def test_deferred_imports(self):
+        code = '; '.join([
+            'import sys, json',
+            'import cfn_custom_resource',
+            'from cfn_custom_resource import CloudFormationCustomResource, utils, decorator',
+            'print(json.dumps(sorted(m for m in {!r} if m in sys.modules)))'.format(self.DEFERRED_MODULES),
+        ])
+        root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+        output = subprocess.check_output([sys.executable, '-c', code], cwd=root)
+        self.assertEqual(json.loads(output.decode('utf-8')), [])
+
+    def test_version(self):
+        import cfn_custom_resource
+        six.assertRegex(self, cfn_custom_resource.__version__, r'^\d+\.\d+\.\d+')
+
 class TestDecorator(unittest.TestCase):
     
     def test_decorator(self):
@@ -275,5 +1581,8 @@ class TestDecorator(unittest.TestCase):
         
         decorator.handler(event, ccr_utils.MockLambdaContext())
 
+if not six.PY2:
+    from .test_aio import TestAsync
+
 if __name__ == '__main__':
     unittest.main()
\ No newline at end of file
@@ -0,0 +1,84 @@
+"""Tests for cfn_custom_resource.aio, which needs Python 3 syntax, so they
+are kept separate and imported by the main test module when supported."""
+from __future__ import print_function
+
+import asyncio
+import time
+import unittest
+
+from cfn_custom_resource import CloudFormationCustomResource, utils as ccr_utils
+from cfn_custom_resource.aio import AsyncCloudFormationCustomResource
+
+class TestAsync(unittest.TestCase):
+    class FakeClient(object):
+        def __init__(self):
+            self.region = 'us-east-1'
+
+        def get_thing(self, Name):
+            time.sleep(0.2)
+            return {'Name': Name}
+
+    class CustomResourceAsyncTest(AsyncCloudFormationCustomResource):
+        BOTO3_SESSION_FACTORY = staticmethod(lambda: None)
+        BOTO3_CLIENT_FACTORY = staticmethod(lambda session, name: TestAsync.FakeClient())
+
+        def __init__(self):
+            super(TestAsync.CustomResourceAsyncTest, self).__init__()
+            self.send_response_function = self.capture_response
+            self.test_response_content = None
+
+        def capture_response(self, resource, url, response_content):
+            self.test_response_content = response_content
+
+        async def create(self):
+            client = self.get_async_boto3_client('asynctestservice')
+            self.region = client.region
+            names = self.resource_properties['Names']
+            responses = await asyncio.gather(*[client.get_thing(Name=name) for name in names])
+            return {'Names': ','.join(response['Name'] for response in responses)}
+
+        async def update(self):
+            raise ValueError('not updatable')
+
+        async def delete(self):
+            pass
+
+    def test_create(self):
+        names = ['a', 'b', 'c', 'd']
+        event = ccr_utils.generate_request('create', 'Custom::CustomResourceAsyncTest', {'Names': names},
+                                           CloudFormationCustomResource.DUMMY_RESPONSE_URL_SILENT)
+        obj = self.CustomResourceAsyncTest()
+
+        start = time.time()
+        obj.handle(event, ccr_utils.MockLambdaContext())
+        elapsed = time.time() - start
+
+        self.assertEqual(obj.status, CloudFormationCustomResource.STATUS_SUCCESS)
+        self.assertEqual(obj.test_response_content['Data'], {'Names': 'a,b,c,d'})
+        self.assertEqual(obj.region, 'us-east-1')
+        # the calls overlap, rather than taking 0.2 s each
+        self.assertLess(elapsed, 0.2 * len(names))
+
+    def test_failure(self):
+        event = ccr_utils.generate_request('update', 'Custom::CustomResourceAsyncTest', {'Names': []},
+                                           CloudFormationCustomResource.DUMMY_RESPONSE_URL_SILENT,
+                                           old_properties={})
+        class CustomResourceAsyncTest(self.CustomResourceAsyncTest):
+            RAISE_ON_FAILURE = False
+
+        obj = CustomResourceAsyncTest()
+        obj.handle(event, ccr_utils.MockLambdaContext())
+        self.assertEqual(obj.test_response_content['Status'], CloudFormationCustomResource.STATUS_FAILED)
+        self.assertIn('not updatable', obj.test_response_content['Reason'])
+
+    def test_boto3_stats_cleared(self):
+        from cfn_custom_resource.cfn_custom_resource import _get_boto3_call_stats
+        event = ccr_utils.generate_request('create', 'Custom::CustomResourceAsyncTest', {'Names': ['a']},
+                                           CloudFormationCustomResource.DUMMY_RESPONSE_URL_SILENT)
+        class CustomResourceAsyncTest(self.CustomResourceAsyncTest):
+            INSTRUMENT_BOTO3 = True
+
+        obj = CustomResourceAsyncTest()
+        obj.handle(event, ccr_utils.MockLambdaContext())
+        self.assertIsNotNone(obj.boto3_stats)
+        self.assertIsNone(_get_boto3_call_stats())